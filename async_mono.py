@@ -0,0 +1,283 @@
+import asyncio
+import inspect
+import io
+
+from mono_emulator import open_port
+from mono_protocol import TextProtocol
+from mono_session import MonochromatorSession, MonochromatorError, WaitFor, Pause, Callback
+from serial_reader import SerialReader, parse_line, DISCONNECTED, BINARY_MODE, SAMPLE
+
+#asyncio driver of MonochromatorSession: the same commands, replies and state as
+# MonochromatorCore, awaited instead of blocking and raising MonochromatorError
+# instead of logging it. Where the port has a file descriptor the loop can watch
+# (pyserial on Linux/macOS) replies are read by the event loop itself through
+# add_reader; otherwise (Windows, the emulator) one reader thread per instrument
+# forwards parsed lines into the loop. Commands run one at a time; stop() is not
+# queued behind them.
+class AsyncMonochromatorControl(MonochromatorSession):
+    def __init__(self, on_status=None, on_event=None, on_sample=None, state_cache_path=None):
+        # on_sample takes the streamed SAMPLE events instead of on_event and on_status
+        super().__init__(on_status, on_event, on_sample, state_cache_path)
+        self._loop = None
+        self._events = None
+        self._reader = None
+        self._fd = None  # File descriptor the loop watches when it reads the port itself
+        self._line_buffer = b""
+        self._decode = None  # Binary frame decoder used by _read_ready once negotiated
+        self._pending_decode = None
+        self._command_lock = None
+        self._sweep_stop = None
+
+    async def connect(self, port, baud_rate=9600, timeout=1):
+        if self.ser:
+            raise MonochromatorError("Already connected.")
+        self._loop = asyncio.get_running_loop()
+        self._events = asyncio.Queue()
+        self._command_lock = asyncio.Lock()
+        self._sweep_stop = asyncio.Event()
+        opening = self._loop.run_in_executor(None, open_port, port, baud_rate, timeout)
+        try:
+            self.ser = await asyncio.shield(opening)
+        except asyncio.CancelledError:
+            # The caller gave up (asyncio.wait_for timeout), close the port once it opens
+            opening.add_done_callback(_close_opened_port)
+            raise
+        self.port = port
+        self._fd = self._watch_port()
+        if self._fd is None:
+            self._reader = SerialReader(self.ser, on_event=self._forward_from_thread)
+            self._reader.start()
+        self._add_status(f"Connected to {port}, you can now initialize and start your Monochromator.")
+
+    #Let the event loop read the port. Returns the watched file descriptor, or None when
+    # the port has none (the emulator; pyserial on Windows raises UnsupportedOperation)
+    # or the loop cannot watch it (ProactorEventLoop); a reader thread is used then.
+    def _watch_port(self):
+        try:
+            fd = self.ser.fileno()
+        except (AttributeError, io.UnsupportedOperation, OSError):
+            return None
+        timeout = self.ser.timeout
+        self.ser.timeout = 0  # Non-blocking reads, the loop tells us when data is there
+        try:
+            self._loop.add_reader(fd, self._read_ready)
+        except NotImplementedError:
+            self.ser.timeout = timeout
+            return None
+        return fd
+
+    #Wait up to timeout seconds for the startup banner (it may already have been printed
+    # before we connected) and take over what the firmware still knows
+    async def initialize(self, timeout=2.0):
+        return await self._run(self._initialize(timeout))
+
+    #See MonochromatorSession._identify. Returns whether a monochromator answered.
+    async def identify(self, timeout=3.0):
+        return await self._run(self._identify(timeout))
+
+    #Returns the homing duration in seconds. Raises MonochromatorError when the firmware
+    # reports a failure (timeout, stop, sensor not found); the motor is then not homed.
+    async def home(self):
+        return await self._run(self._home())
+
+    #Speeds in steps/s, acceleration in steps/s^2, timeout in s; None keeps a setting.
+    # Returns the profile the firmware now uses.
+    async def set_homing_profile(self, fast_speed=None, slow_speed=None, acceleration=None, timeout=None):
+        return await self._run(self._set_homing_profile(fast_speed, slow_speed, acceleration, timeout))
+
+    async def select_grating(self, mode):
+        return await self._run(self._select_grating(mode))
+
+    #Returns True when the target was reached, False after an emergency stop. profile
+    # as in MonochromatorSession._set_wavelength.
+    async def set_wavelength(self, wavelength, profile=None):
+        return await self._run(self._set_wavelength(wavelength, profile))
+
+    #Move to an absolute step position, bypassing the wavelength fits
+    async def move_to_steps(self, steps, profile=None):
+        return await self._run(self._move_to_steps(steps, profile))
+
+    async def set_motion_profile(self, profile):
+        return await self._run(self._set_motion_profile(profile))
+
+    #See MonochromatorSession._sweep; on_point and on_progress may be plain functions or
+    # coroutine functions
+    async def sweep(self, start=None, stop=None, step=None, wavelengths=None, dwell=0.0, on_point=None,
+                    on_progress=None, optimize_order=False, approach=None, profile=None, max_settle=None):
+        return await self._run(self._sweep(start, stop, step, wavelengths, dwell, on_point, on_progress,
+                                           optimize_order, approach, profile, max_settle))
+
+    #Goes out immediately, also while another command is waiting for its reply
+    async def stop(self):
+        self._require(connected=True)
+        self._sweep_stop.set()
+        self._send_stop()
+
+    #Have the firmware send a photodiode sample every interval_ms during moves (see
+    # MonochromatorCore.start_streaming). Samples are handed to on_sample as they
+    # arrive.
+    async def start_streaming(self, channel=1, interval_ms=50):
+        return await self._run(self._stream(channel, interval_ms))
+
+    async def stop_streaming(self):
+        return await self._run(self._stream(0, 0))
+
+    #Switch to the framed binary protocol at baud_rate (see mono_protocol). Returns
+    # False, and keeps the text protocol, when the firmware does not support it.
+    async def use_binary_protocol(self, baud_rate=115200, timeout=2.0):
+        return await self._run(self._use_binary_protocol(baud_rate, timeout))
+
+    async def disconnect(self):
+        if not self.ser:
+            return
+        if self._reader:
+            await self._loop.run_in_executor(None, self._reader.stop)
+            self._reader = None
+        if self._fd is not None:
+            self._loop.remove_reader(self._fd)
+            self._fd = None
+        self._save_state()
+        self.ser.close()
+        self.ser = None
+        self.protocol = TextProtocol()
+        self._decode = self._pending_decode = None
+        self._line_buffer = b""
+        self._add_status("Disconnected from Arduino.")
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.disconnect()
+
+    #Runs command, a MonochromatorSession generator, to its end, one command at a time
+    async def _run(self, command):
+        self._require(connected=True)
+        async with self._command_lock:
+            self._drop_stale()
+            result = error = None
+            while True:
+                try:
+                    action = command.throw(error) if error else command.send(result)
+                except StopIteration as done:
+                    return done.value
+                except BaseException:
+                    self._finish_span(False)
+                    raise
+                result = error = None
+                try:
+                    result = await self._perform(action)
+                except (MonochromatorError, asyncio.CancelledError) as e:
+                    error = e
+
+    async def _perform(self, action):
+        if isinstance(action, WaitFor):
+            return await self._wait_for(action.kinds, action.timeout, action.answers)
+        if isinstance(action, Pause):
+            try:
+                await asyncio.wait_for(self._sweep_stop.wait(), action.seconds)
+            except asyncio.TimeoutError:
+                pass
+            return None
+        if isinstance(action, Callback):
+            return await _maybe_await(action.func(*action.args))
+        raise TypeError(f"Unknown action {action!r}")
+
+    def _write_port(self, data):
+        self.ser.write(data)
+
+    def _expect_binary(self, decode):
+        if self._reader:
+            self._reader.expect_binary(decode)
+        else:
+            self._pending_decode = decode
+
+    def _stop_requested(self):
+        return self._sweep_stop.is_set()
+
+    def _clear_stop(self):
+        self._sweep_stop.clear()
+
+    def _read_ready(self):
+        try:
+            data = self.ser.read(self.ser.in_waiting or 1)
+        except Exception as e:
+            self._loop.remove_reader(self._fd)
+            self._fd = None
+            self._add_status(f"Serial read failed: {e}")
+            return
+        if self._decode:
+            for event in self._decode(data):
+                self._dispatch(event)
+            return
+        self._line_buffer += data
+        while b"\n" in self._line_buffer:
+            raw, self._line_buffer = self._line_buffer.split(b"\n", 1)
+            line = raw.decode(errors="replace").strip()
+            if not line:
+                continue
+            event = parse_line(line)
+            self._dispatch(event)
+            if event.kind == BINARY_MODE and self._pending_decode:
+                # Everything after this line is framed
+                self._decode, self._pending_decode = self._pending_decode, None
+                rest, self._line_buffer = self._line_buffer, b""
+                for event in self._decode(rest):
+                    self._dispatch(event)
+                return
+
+    def _forward_from_thread(self, event):
+        self._loop.call_soon_threadsafe(self._dispatch, event)
+
+    #Handle every event as it arrives, also while no command runs, so samples and
+    # unsolicited lines are passed on right away instead of piling up. Only a running
+    # command (or the startup banner, before initialize) needs them queued as well.
+    def _dispatch(self, event):
+        if event.kind == SAMPLE and self.on_sample:
+            self.on_sample(event)
+            return
+        if event.kind != DISCONNECTED:
+            self._handle_event(event)
+        if event.kind == DISCONNECTED or self._command_lock.locked() or not self.arduino_initialized:
+            self._events.put_nowait(event)
+
+    #Forget events queued before the command that is starting; they cannot answer it.
+    # A disconnect is kept.
+    def _drop_stale(self):
+        if not self.arduino_initialized:
+            return
+        while not self._events.empty():
+            event = self._events.get_nowait()
+            if event.kind == DISCONNECTED:
+                self._events.put_nowait(event)
+                return
+
+    #Wait until an event of one of the given kinds that answers (see
+    # SerialReader.wait_for) arrives; _dispatch has already handled it. Returns None
+    # on timeout.
+    async def _wait_for(self, kinds, timeout=None, answers=None):
+        deadline = None if timeout is None else self._loop.time() + timeout
+        while True:
+            remaining = None if deadline is None else deadline - self._loop.time()
+            try:
+                if remaining is not None and remaining <= 0:
+                    raise asyncio.TimeoutError()
+                event = await asyncio.wait_for(self._events.get(), remaining)
+            except asyncio.TimeoutError:
+                return None
+            if event.kind == DISCONNECTED:
+                self._events.put_nowait(event)
+                raise MonochromatorError("Lost connection to the Arduino.")
+            if event.kind in kinds and (answers is None or answers(event)):
+                return event
+
+
+def _close_opened_port(opening):
+    if not opening.cancelled() and opening.exception() is None:
+        opening.result().close()
+
+
+async def _maybe_await(result):
+    if inspect.isawaitable(result):
+        return await result
+    return result
@@ -0,0 +1,194 @@
+import json
+import threading
+
+import numpy as np
+
+from mono_model import (VIS_MODE, IR_MODE, SWITCH_MODE, GRATING_MODES, VIS_OFFSET, VIS_SLOPE, IR_OFFSET, IR_SLOPE,
+                        SWITCH_WAVELENGTH, WAVELENGTH_RANGES, mode_index, wavelength_range)
+
+CALIBRATION_KINDS = ("poly", "spline")
+
+
+#Wavelength -> step model of one grating, fitted to measured (wavelength, steps)
+# reference points: a least squares polynomial of the given degree, or a natural
+# cubic spline through every point
+class GratingCalibration:
+    def __init__(self, wavelengths, steps, kind="poly", degree=1):
+        if kind not in CALIBRATION_KINDS:
+            raise ValueError(f"Unknown calibration kind {kind!r}, expected one of {CALIBRATION_KINDS}.")
+        wavelengths = np.asarray(wavelengths, dtype=float)
+        steps = np.asarray(steps, dtype=float)
+        if wavelengths.shape != steps.shape or wavelengths.ndim != 1:
+            raise ValueError("Reference wavelengths and steps must be two lists of the same length.")
+        order = np.argsort(wavelengths)
+        self.wavelengths = wavelengths[order]
+        self.steps = steps[order]
+        self.kind = kind
+        self.degree = degree
+        if kind == "poly":
+            if len(self.wavelengths) <= degree:
+                raise ValueError(f"A degree {degree} fit needs at least {degree + 1} reference points.")
+            self._poly = np.polynomial.Polynomial.fit(self.wavelengths, self.steps, degree)
+        else:
+            if len(self.wavelengths) < 2 or np.any(np.diff(self.wavelengths) <= 0):
+                raise ValueError("A spline needs at least 2 reference points with different wavelengths.")
+            self._moments = _spline_moments(self.wavelengths, self.steps)
+
+    #The fit the firmware uses: steps = (wavelength + offset) / slope
+    @classmethod
+    def linear(cls, offset, slope, low, high):
+        wavelengths = [low, high]
+        return cls(wavelengths, [(wavelength + offset) / slope for wavelength in wavelengths])
+
+    #Fractional step positions for an array of wavelengths
+    def __call__(self, wavelengths):
+        wavelengths = np.asarray(wavelengths, dtype=float)
+        if self.kind == "poly":
+            return self._poly(wavelengths)
+        return _spline_eval(self.wavelengths, self.steps, self._moments, wavelengths)
+
+    #Measured minus fitted steps at the reference points
+    def residuals(self):
+        return self.steps - self(self.wavelengths)
+
+    def to_dict(self):
+        return {"kind": self.kind, "degree": self.degree,
+                "wavelengths": self.wavelengths.tolist(), "steps": self.steps.tolist()}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["wavelengths"], data["steps"], data.get("kind", "poly"), data.get("degree", 1))
+
+
+#Host-side wavelength <-> step conversion for both gratings. Conversions go through a
+# lookup table per grating, sampled every lut_step nm over the grating's range and
+# built on first use; fitting a grating again throws its table away. Starts out with
+# the firmware's linear fits, so without measurements it moves exactly like
+# wavelength_selected (apart from rounding instead of truncating).
+class Calibration:
+    def __init__(self, gratings=None, lut_step=0.01):
+        self.gratings = gratings or {
+            VIS_MODE: GratingCalibration.linear(VIS_OFFSET, VIS_SLOPE, *WAVELENGTH_RANGES[VIS_MODE]),
+            IR_MODE: GratingCalibration.linear(IR_OFFSET, IR_SLOPE, *WAVELENGTH_RANGES[IR_MODE]),
+        }
+        self.lut_step = lut_step
+        self.version = 0  # Bumped whenever a grating is refitted
+        self._tables = {}
+        self._lock = threading.Lock()
+
+    #Fit grating (VIS_MODE/IR_MODE or its name) to measured reference points and
+    # drop its cached lookup table. Raises ValueError if the new model is not
+    # monotonic over the grating's range, as it could not be inverted.
+    def fit(self, grating, wavelengths, steps, kind="poly", degree=1):
+        grating = mode_index(grating)
+        model = GratingCalibration(wavelengths, steps, kind, degree)
+        table = self._build_table(grating, model)
+        with self._lock:
+            self.gratings[grating] = model
+            self._tables[grating] = table
+            self.version += 1
+        return model
+
+    #(wavelengths, steps) arrays sampled over the grating's range
+    def lookup_table(self, grating):
+        grating = mode_index(grating)
+        with self._lock:
+            table = self._tables.get(grating)
+            model = self.gratings[grating]
+        if table is None:
+            table = self._build_table(grating, model)
+            with self._lock:
+                # Keep it only if nobody refitted the grating in the meantime
+                if self.gratings[grating] is model:
+                    self._tables[grating] = table
+        return table
+
+    def _build_table(self, grating, model):
+        low, high = WAVELENGTH_RANGES[grating]
+        wavelengths = np.linspace(low, high, int(round((high - low) / self.lut_step)) + 1)
+        steps = model(wavelengths)
+        if np.any(np.diff(steps) <= 0):
+            raise ValueError(f"The {GRATING_MODES[grating]} calibration is not monotonic between {low} and {high} nm.")
+        return wavelengths, steps
+
+    #Absolute step targets (int64 array) for an array of wavelengths in the given
+    # mode, Switch Mode using the VIS grating below SWITCH_WAVELENGTH. Raises
+    # ValueError listing wavelengths outside the mode's range.
+    def wavelengths_to_steps(self, wavelengths, mode):
+        wavelengths = np.atleast_1d(np.asarray(wavelengths, dtype=float))
+        mode = mode_index(mode)
+        low, high = wavelength_range(mode)
+        invalid = wavelengths[~((wavelengths >= low) & (wavelengths <= high))]
+        if len(invalid):
+            raise ValueError(f"Wavelengths outside the {GRATING_MODES[mode]} range {low}-{high} nm: "
+                             f"{invalid[:5].tolist()}")
+        if mode == SWITCH_MODE:
+            vis = wavelengths < SWITCH_WAVELENGTH
+            steps = np.empty(len(wavelengths))
+            steps[vis] = np.interp(wavelengths[vis], *self.lookup_table(VIS_MODE))
+            steps[~vis] = np.interp(wavelengths[~vis], *self.lookup_table(IR_MODE))
+        else:
+            steps = np.interp(wavelengths, *self.lookup_table(mode))
+        return np.rint(steps).astype(np.int64)
+
+    #Wavelengths at an array of step positions on one grating
+    def steps_to_wavelengths(self, steps, grating):
+        table_wavelengths, table_steps = self.lookup_table(grating)
+        return np.interp(np.asarray(steps, dtype=float), table_steps, table_wavelengths)
+
+    #Calibrated spectrum_stream.steps_to_wavelengths: wavelengths at step positions in
+    # the given mode, NaN between the VIS and IR parts of Switch Mode
+    def positions_to_wavelengths(self, steps, mode):
+        steps = np.asarray(steps, dtype=float)
+        mode = mode_index(mode)
+        if mode != SWITCH_MODE:
+            return self.steps_to_wavelengths(steps, mode)
+        vis_max, ir_min = (np.interp(SWITCH_WAVELENGTH, *self.lookup_table(grating)) for grating in (VIS_MODE, IR_MODE))
+        return np.where(steps <= vis_max, self.steps_to_wavelengths(steps, VIS_MODE),
+                        np.where(steps >= ir_min, self.steps_to_wavelengths(steps, IR_MODE), np.nan))
+
+    def to_dict(self):
+        return {"lut_step": self.lut_step,
+                "gratings": {GRATING_MODES[grating]: model.to_dict() for grating, model in self.gratings.items()}}
+
+    @classmethod
+    def from_dict(cls, data):
+        calibration = cls(lut_step=data.get("lut_step", 0.01))
+        for name, model in data["gratings"].items():
+            calibration.gratings[mode_index(name)] = GratingCalibration.from_dict(model)
+        return calibration
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls.from_dict(json.load(f))
+
+
+#Second derivatives at the knots of the natural cubic spline through (x, y)
+def _spline_moments(x, y):
+    n = len(x)
+    moments = np.zeros(n)
+    if n < 3:
+        return moments
+    h = np.diff(x)
+    matrix = np.zeros((n - 2, n - 2))
+    index = np.arange(n - 2)
+    matrix[index, index] = 2 * (h[:-1] + h[1:])
+    matrix[index[1:], index[:-1]] = h[1:-1]
+    matrix[index[:-1], index[1:]] = h[1:-1]
+    slopes = np.diff(y) / h
+    moments[1:-1] = np.linalg.solve(matrix, 6 * np.diff(slopes))
+    return moments
+
+
+#Evaluate the spline at t; outside the knots the end segments are extended
+def _spline_eval(x, y, moments, t):
+    i = np.clip(np.searchsorted(x, t) - 1, 0, len(x) - 2)
+    h = x[i + 1] - x[i]
+    a = (x[i + 1] - t) / h
+    b = (t - x[i]) / h
+    return a * y[i] + b * y[i + 1] + ((a ** 3 - a) * moments[i] + (b ** 3 - b) * moments[i + 1]) * h * h / 6
@@ -0,0 +1,57 @@
+import queue
+import threading
+from concurrent.futures import Future
+
+
+#Runs submitted commands one at a time on a single worker thread, so only one
+# command at a time writes to the port and consumes its replies. Urgent commands
+# (emergency stop) do not go through the queue: the caller drops everything that has
+# not started yet with cancel_pending() and writes directly.
+class CommandScheduler(threading.Thread):
+    def __init__(self):
+        super().__init__(name="CommandScheduler", daemon=True)
+        self._commands = queue.Queue()
+        self._shutdown = threading.Event()
+        self.current = None  # Name of the command being run, None when idle
+
+    def submit(self, func, *args, **kwargs):
+        future = Future()
+        if self._shutdown.is_set():
+            future.cancel()
+        else:
+            self._commands.put((future, func, args, kwargs))
+        return future
+
+    #Cancel every queued command that has not started. Returns how many were dropped.
+    def cancel_pending(self):
+        cancelled = 0
+        while True:
+            try:
+                future, _, _, _ = self._commands.get_nowait()
+            except queue.Empty:
+                return cancelled
+            if future is None:
+                self._commands.put((None, None, None, None))
+                return cancelled
+            if future.cancel():
+                cancelled += 1
+
+    def shutdown(self):
+        self._shutdown.set()
+        self.cancel_pending()
+        self._commands.put((None, None, None, None))
+
+    def run(self):
+        while True:
+            future, func, args, kwargs = self._commands.get()
+            if future is None:
+                return
+            if not future.set_running_or_notify_cancel():
+                continue
+            self.current = getattr(func, "__name__", repr(func))
+            try:
+                future.set_result(func(*args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+            finally:
+                self.current = None
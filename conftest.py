@@ -0,0 +1,2 @@
+# test_main.py is the interactive console script, not a test module
+collect_ignore = ["test_main.py"]
@@ -0,0 +1,144 @@
+import asyncio
+
+from async_mono import AsyncMonochromatorControl, MonochromatorError
+from mono_core import MonochromatorCore
+
+
+#Pool of AsyncMonochromatorControl instances, one per instrument, all driven from one
+# event loop. Commands for different units run concurrently: each *_all method
+# starts the command on every unit and returns once all of them are done, with a
+# {port: result} dict in which failed units have their exception instead of a result.
+# on_status(port, message) receives the status messages of every unit.
+class InstrumentManager:
+    def __init__(self, baud_rate=9600, probe_timeout=3.0, on_status=None, on_event=None):
+        self.baud_rate = baud_rate
+        self.probe_timeout = probe_timeout
+        self.on_status = on_status
+        self.on_event = on_event  # Called with (port, FirmwareEvent)
+        self.units = {}  # port -> connected AsyncMonochromatorControl
+        self.last_status = {}  # port -> last status message of that unit
+        self.busy = {}  # port -> name of the command it is running, None when idle
+
+    def __len__(self):
+        return len(self.units)
+
+    #Probe ports (default: every serial port on the machine) in parallel and keep the
+    # ones a monochromator answers on. Ports already in the pool are skipped. Returns
+    # the ports that were added.
+    async def discover(self, ports=None):
+        if ports is None:
+            loop = asyncio.get_running_loop()
+            ports = await loop.run_in_executor(None, MonochromatorCore.list_available_ports)
+        ports = [port for port in ports if port not in self.units]
+        units = await asyncio.gather(*(self._probe(port) for port in ports))
+        found = []
+        for port, unit in zip(ports, units):
+            if unit:
+                self.units[port] = unit
+                self.busy[port] = None
+                found.append(port)
+        return found
+
+    async def _probe(self, port):
+        unit = AsyncMonochromatorControl(on_status=lambda message: self._status(port, message),
+                                         on_event=self._event_hook(port))
+        try:
+            await asyncio.wait_for(unit.connect(port, self.baud_rate), self.probe_timeout)
+            if await unit.identify(self.probe_timeout):
+                return unit
+            self._status(port, "No monochromator answered on this port.")
+        except asyncio.TimeoutError:
+            self._status(port, f"The port did not open within {self.probe_timeout} s.")
+        except (OSError, MonochromatorError) as e:
+            self._status(port, f"Could not open the port: {e}")
+        await unit.disconnect()
+        return None
+
+    def _event_hook(self, port):
+        if not self.on_event:
+            return None
+        return lambda event: self.on_event(port, event)
+
+    def _status(self, port, message):
+        self.last_status[port] = message
+        if self.on_status:
+            self.on_status(port, message)
+
+    #Run await getattr(unit, command)(*args, **kwargs) on the given ports (default all)
+    # concurrently and wait for every one of them: the "all units done" barrier.
+    async def run_all(self, command, *args, ports=None, **kwargs):
+        ports = list(self.units) if ports is None else ports
+        results = await asyncio.gather(*(self._run(port, command, args, kwargs) for port in ports),
+                                       return_exceptions=True)
+        return dict(zip(ports, results))
+
+    async def _run(self, port, command, args, kwargs):
+        self.busy[port] = command
+        try:
+            return await getattr(self.units[port], command)(*args, **kwargs)
+        except MonochromatorError as e:
+            self._status(port, str(e))
+            raise
+        finally:
+            self.busy[port] = None
+
+    async def home_all(self, ports=None):
+        return await self.run_all("home", ports=ports)
+
+    async def select_grating_all(self, mode, ports=None):
+        return await self.run_all("select_grating", mode, ports=ports)
+
+    #Returns once every unit reached the wavelength (True), was stopped (False) or failed
+    async def set_wavelength_all(self, wavelength, ports=None):
+        return await self.run_all("set_wavelength", wavelength, ports=ports)
+
+    #Sweep every unit through the same wavelengths. Unsynchronized, each unit runs its
+    # own sweep at its own pace (fastest overall). With synchronized every point is a
+    # barrier: all units move, and on_point(index, wavelength, {port: reached}) is
+    # called once they all got there (or failed), before any unit moves on. Returns
+    # {port: wavelengths reached}.
+    async def sweep_all(self, wavelengths, dwell=0.0, synchronized=False, on_point=None, ports=None):
+        ports = list(self.units) if ports is None else ports
+        if not synchronized:
+            return await self.run_all("sweep", wavelengths=wavelengths, dwell=dwell, ports=ports)
+        reached = {port: [] for port in ports}
+        active = list(ports)
+        for index, wavelength in enumerate(wavelengths):
+            results = await self.run_all("set_wavelength", wavelength, ports=active)
+            for port, result in results.items():
+                if result is True:
+                    reached[port].append(wavelength)
+            if on_point:
+                on_point(index, wavelength, results)
+            # Units that were stopped or failed drop out of the rest of the sweep
+            active = [port for port in active if results[port] is True]
+            if not active:
+                break
+            if dwell:
+                await asyncio.sleep(dwell)
+        return reached
+
+    #Emergency stop on every unit at once, also while they are running commands
+    async def stop_all(self):
+        await asyncio.gather(*(unit.stop() for unit in self.units.values()), return_exceptions=True)
+
+    #{port: dict} snapshot of every unit's state
+    def unit_status(self):
+        return {port: {
+            "homed": unit.motor_homed,
+            "grating_mode": unit.grating_mode,
+            "current_steps": unit.current_steps,
+            "busy": self.busy.get(port),
+            "last_status": self.last_status.get(port),
+        } for port, unit in self.units.items()}
+
+    async def disconnect_all(self):
+        units, self.units = self.units, {}
+        await asyncio.gather(*(unit.disconnect() for unit in units.values()), return_exceptions=True)
+        self.busy = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.disconnect_all()
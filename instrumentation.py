@@ -0,0 +1,229 @@
+import csv
+import json
+import math
+import threading
+import time
+
+# Phases of a command, in the order they happen:
+# write: ser.write() of the command
+# first_reply: end of the write until the first line (or frame) of the reply arrived;
+#   for a move whose first reply only comes once the target is reached (IR and
+#   Switch mode, step moves, the binary protocol) the predicted motion is taken off
+# motion: the move time the motion profile predicts, for commands that move the motor
+# execution: first until last reply line, i.e. firmware work and motion
+# host_delay: last reply line received until the waiting caller got hold of it
+# total: whole command as seen by the caller, including validation and the lock
+PHASES = ("write", "first_reply", "motion", "execution", "host_delay", "total")
+
+
+#Log-spaced latency histogram, buckets_per_decade buckets for every factor of 10
+# between min_value and max_value seconds. Percentiles are read off the buckets, so
+# they are accurate to about one bucket width (12% with the defaults).
+class LatencyHistogram:
+    def __init__(self, min_value=1e-6, max_value=1e4, buckets_per_decade=20):
+        self.min_value = min_value
+        self.buckets_per_decade = buckets_per_decade
+        self.counts = [0] * (int(math.log10(max_value / min_value) * buckets_per_decade) + 2)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        if value <= self.min_value:
+            bucket = 0
+        else:
+            bucket = min(int(math.log10(value / self.min_value) * self.buckets_per_decade) + 1, len(self.counts) - 1)
+        self.counts[bucket] += 1
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    #Upper edge of the bucket holding the given percentile (0-100), clamped to max
+    def percentile(self, percent):
+        if not self.count:
+            return None
+        wanted = percent / 100 * self.count
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= wanted:
+                return min(self.min_value * 10 ** (bucket / self.buckets_per_decade), self.max)
+        return self.max
+
+
+#Timings of one command. Created by Instrumentation.start; the controller reports the
+# write, every reply event and the end of the command.
+class CommandSpan:
+    active = True
+
+    def __init__(self, instrumentation, command):
+        self._instrumentation = instrumentation
+        self.command = command
+        self.started = time.monotonic()
+        self.wall_time = time.time()
+        self.write_started = None
+        self.write_finished = None
+        self.first_reply = None
+        self.last_reply = None
+        self.answers = None  # Predicate for the events that reply to the command
+        self.motion = None  # Predicted move time, see moving
+        self._move_ends = ()
+        self._reply_ends_move = False
+
+    #answers, if given, tells the replies to the command written from events that
+    # answer something else (see BinaryProtocol.answers), such as the prompt of the
+    # previous move of a pipelined sweep; only replies are timed
+    def wrote(self, started, finished, answers=None):
+        if self.write_started is None:
+            self.write_started = started
+            self.write_finished = finished
+            self.answers = answers
+
+    #The command moves the motor for about predicted seconds; events of the kinds in
+    # ends report that the move is over
+    def moving(self, predicted, ends):
+        self.motion = predicted
+        self._move_ends = ends
+
+    #Called with every FirmwareEvent received while the command runs
+    def event(self, event):
+        if self.answers is not None and not self.answers(event):
+            return
+        if self.first_reply is None:
+            self.first_reply = event.timestamp
+            self._reply_ends_move = event.kind in self._move_ends
+        self.last_reply = event.timestamp
+
+    def finish(self, ok=True):
+        finished = time.monotonic()
+        record = {"command": self.command, "time": self.wall_time, "ok": bool(ok)}
+        if self.motion is not None:
+            record["motion"] = self.motion
+        if self.write_finished is not None:
+            record["write"] = self.write_finished - self.write_started
+            if self.first_reply is not None:
+                first_reply = self.first_reply - self.write_finished
+                if self._reply_ends_move:
+                    first_reply -= self.motion
+                record["first_reply"] = max(0.0, first_reply)
+                record["execution"] = self.last_reply - self.first_reply
+                record["host_delay"] = max(0.0, finished - self.last_reply)
+        record["total"] = finished - self.started
+        self._instrumentation.record(record)
+        return record
+
+
+#Stand-in returned while instrumentation is disabled; every call is a no-op
+class _NullSpan:
+    active = False
+
+    def wrote(self, started, finished, answers=None):
+        pass
+
+    def moving(self, predicted, ends):
+        pass
+
+    def event(self, event):
+        pass
+
+    def finish(self, ok=True):
+        return None
+
+
+NULL_SPAN = _NullSpan()
+
+
+#Collects CommandSpans into one LatencyHistogram per command and phase and passes
+# every finished record to the hooks (plain callables, such as the exporters below).
+# Disabled it hands out NULL_SPAN and records nothing.
+class Instrumentation:
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.histograms = {}  # (command, phase) -> LatencyHistogram
+        self.hooks = []
+        self._lock = threading.Lock()
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def start(self, command):
+        if not self.enabled:
+            return NULL_SPAN
+        return CommandSpan(self, command)
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+        return hook
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    #Add a finished record; also for timings measured outside a span
+    def record(self, record):
+        if not self.enabled:
+            return
+        with self._lock:
+            for phase in PHASES:
+                if phase in record:
+                    key = (record["command"], phase)
+                    if key not in self.histograms:
+                        self.histograms[key] = LatencyHistogram()
+                    self.histograms[key].add(record[phase])
+        for hook in list(self.hooks):
+            hook(record)
+
+    def reset(self):
+        with self._lock:
+            self.histograms = {}
+
+    #Text table of count, mean, median, 95th percentile and maximum in ms per command
+    # and phase
+    def report(self):
+        with self._lock:
+            rows = sorted(self.histograms.items(), key=lambda item: (item[0][0], PHASES.index(item[0][1])))
+            lines = [f"{'command':<16}{'phase':<13}{'count':>7}{'mean':>10}{'p50':>10}{'p95':>10}{'max':>10}"]
+            for (command, phase), histogram in rows:
+                lines.append(f"{command:<16}{phase:<13}{histogram.count:>7}"
+                             + "".join(f"{value * 1000:>10.1f}" for value in (
+                                 histogram.mean, histogram.percentile(50), histogram.percentile(95), histogram.max)))
+        if len(lines) == 1:
+            return "No command timings recorded."
+        return "\n".join(lines) + "\n(all times in ms)"
+
+
+#Hook appending every record as one JSON object per line
+class JsonLinesExporter:
+    def __init__(self, path):
+        self._file = open(path, "a", buffering=1)
+
+    def __call__(self, record):
+        self._file.write(json.dumps(record) + "\n")
+
+    def close(self):
+        self._file.close()
+
+
+#Hook appending every record as a CSV row, phases in seconds
+class CsvExporter:
+    FIELDS = ("time", "command", "ok") + PHASES
+
+    def __init__(self, path):
+        self._file = open(path, "a", newline="", buffering=1)
+        self._writer = csv.DictWriter(self._file, self.FIELDS)
+        if self._file.tell() == 0:
+            self._writer.writeheader()
+
+    def __call__(self, record):
+        self._writer.writerow(record)
+
+    def close(self):
+        self._file.close()
@@ -0,0 +1,202 @@
+import queue
+import tkinter as tk
+from tkinter import ttk
+
+import numpy as np
+
+from spectrum_stream import positions_to_wavelengths
+
+PLOT_REFRESH_MS = 50  # At most 20 redraws per second
+MAX_SAMPLES_PER_FRAME = 20000  # Taken from the queue per redraw, the rest waits for the next one
+
+
+#Min/max envelope of a stream of (x, y) points in a fixed number of columns. The x
+# range starts initial_span wide at the first point and doubles, merging neighbouring
+# columns, whenever a point falls outside it. Memory and drawing cost depend on
+# columns only, not on how many points were added.
+class DecimatedSeries:
+    def __init__(self, columns=4096, initial_span=1.0):
+        self.columns = columns + columns % 2  # Even, so columns merge in pairs
+        self.initial_span = initial_span
+        self.clear()
+
+    def clear(self):
+        self.x0 = None  # x of the left edge of the first column
+        self.width = self.initial_span / self.columns  # x span of one column
+        self.ymin = np.full(self.columns, np.inf)
+        self.ymax = np.full(self.columns, -np.inf)
+        self.count = 0
+
+    #Add arrays of points; points with a NaN coordinate are skipped
+    def add(self, x, y):
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        valid = ~(np.isnan(x) | np.isnan(y))
+        x, y = x[valid], y[valid]
+        if not len(x):
+            return
+        if self.x0 is None:
+            self.x0 = x.min()
+        while x.min() < self.x0:
+            self._grow(left=True)
+        while x.max() >= self.x0 + self.width * self.columns:
+            self._grow(left=False)
+        index = np.minimum(((x - self.x0) / self.width).astype(int), self.columns - 1)
+        np.minimum.at(self.ymin, index, y)
+        np.maximum.at(self.ymax, index, y)
+        self.count += len(x)
+
+    #Double the x range towards the left or the right
+    def _grow(self, left):
+        ymin = np.minimum(self.ymin[0::2], self.ymin[1::2])
+        ymax = np.maximum(self.ymax[0::2], self.ymax[1::2])
+        self.ymin.fill(np.inf)
+        self.ymax.fill(-np.inf)
+        half = self.columns // 2
+        if left:
+            self.x0 -= self.width * self.columns
+            self.ymin[half:], self.ymax[half:] = ymin, ymax
+        else:
+            self.ymin[:half], self.ymax[:half] = ymin, ymax
+        self.width *= 2
+
+    #(x, ymin, ymax) of the columns holding points, merged further down to at most
+    # pixels columns; None while the series is empty
+    def envelope(self, pixels):
+        filled = np.flatnonzero(np.isfinite(self.ymin))
+        if not len(filled):
+            return None
+        first, last = filled[0], filled[-1] + 1
+        group = max(1, -(-(last - first) // pixels))
+        starts = np.arange(first, last, group)
+        ymin = np.minimum.reduceat(self.ymin[first:last], starts - first)
+        ymax = np.maximum.reduceat(self.ymax[first:last], starts - first)
+        x = self.x0 + (starts + np.minimum(group, last - starts) / 2) * self.width
+        filled = np.isfinite(ymin)
+        return x[filled], ymin[filled], ymax[filled]
+
+
+#Canvas drawing a DecimatedSeries: every pixel column gets a stroke from the smallest
+# to the largest y that fell into it, so spikes stay visible however many points
+# there are. Both axes scale to the data.
+class EnvelopePlot:
+    MARGIN = 45  # Pixels left free around the plot area for the axis labels
+
+    def __init__(self, parent, title, x_unit, y_unit, color="blue", width=360, height=200, columns=4096,
+                 initial_span=1.0):
+        self.x_unit = x_unit
+        self.y_unit = y_unit
+        self.series = DecimatedSeries(columns, initial_span)
+        self.canvas = tk.Canvas(parent, width=width, height=height, background="white", highlightthickness=0)
+        self._frame = self.canvas.create_rectangle(0, 0, 0, 0, outline="gray")
+        self._line = self.canvas.create_line(0, 0, 0, 0, fill=color)
+        self._title = self.canvas.create_text(0, 4, text=title, anchor=tk.N)
+        self._y_high = self.canvas.create_text(0, 0, anchor=tk.E)
+        self._y_low = self.canvas.create_text(0, 0, anchor=tk.E)
+        self._x_low = self.canvas.create_text(0, 0, anchor=tk.NW)
+        self._x_high = self.canvas.create_text(0, 0, anchor=tk.NE)
+        self.canvas.bind("<Configure>", lambda event: self.redraw())
+
+    def grid(self, **kwargs):
+        self.canvas.grid(**kwargs)
+
+    def clear(self):
+        self.series.clear()
+        self.redraw()
+
+    def redraw(self):
+        width, height = self.canvas.winfo_width(), self.canvas.winfo_height()
+        left, top = self.MARGIN, self.MARGIN // 2
+        right, bottom = max(left + 1, width - 10), max(top + 1, height - self.MARGIN // 2)
+        self.canvas.coords(self._frame, left, top, right, bottom)
+        self.canvas.coords(self._title, width / 2, 4)
+        envelope = self.series.envelope(right - left)
+        if envelope is None:
+            self.canvas.coords(self._line, 0, 0, 0, 0)
+            for item in (self._y_high, self._y_low, self._x_low, self._x_high):
+                self.canvas.itemconfig(item, text="")
+            return
+        x, ymin, ymax = envelope
+        x_low, x_high = x[0], x[-1]
+        y_low, y_high = ymin.min(), ymax.max()
+        x_scale = (right - left) / (x_high - x_low) if x_high > x_low else 0
+        y_scale = (bottom - top) / (y_high - y_low) if y_high > y_low else 0
+        px = left + (x - x_low) * x_scale
+        coords = np.empty((len(x), 4))
+        coords[:, 0] = coords[:, 2] = px
+        coords[:, 1] = bottom - (ymin - y_low) * y_scale
+        coords[:, 3] = bottom - (ymax - y_low) * y_scale
+        coords = coords.ravel()
+        if len(coords) == 4 and coords[1] == coords[3]:
+            coords[3] -= 1  # A single point still shows up
+        self.canvas.coords(self._line, coords.tolist())
+        self.canvas.coords(self._y_high, left - 4, top)
+        self.canvas.itemconfig(self._y_high, text=f"{y_high:.6g} {self.y_unit}")
+        self.canvas.coords(self._y_low, left - 4, bottom)
+        self.canvas.itemconfig(self._y_low, text=f"{y_low:.6g}")
+        self.canvas.coords(self._x_low, left, bottom + 2)
+        self.canvas.itemconfig(self._x_low, text=f"{x_low:.6g}")
+        self.canvas.coords(self._x_high, right, bottom + 2)
+        self.canvas.itemconfig(self._x_high, text=f"{x_high:.6g} {self.x_unit}")
+
+
+#Live plots of photodiode reading against wavelength and motor position against
+# time. feed() is the controller's on_sample hook and runs on the serial reader
+# thread: it only queues the sample. The Tk loop takes the queued samples at most
+# every PLOT_REFRESH_MS and redraws when something new arrived, so the GUI stays
+# responsive however fast samples come in.
+class LivePlotPanel:
+    def __init__(self, parent, mode="Switch Mode", calibration=None):
+        self.frame = ttk.Frame(parent)
+        self.mode = mode  # Grating mode used to turn step positions into wavelengths
+        self.calibration = calibration  # calibration.Calibration used instead of the firmware fits when set
+        self.queue = queue.SimpleQueue()
+        self._time_origin = None  # Firmware time of the first sample, s
+        self.spectrum_plot = EnvelopePlot(self.frame, "Detector signal", "nm", "ADC", color="blue")
+        self.position_plot = EnvelopePlot(self.frame, "Motor position", "s", "steps", color="dark green")
+        self.spectrum_plot.grid(row=0, column=0, sticky=(tk.W, tk.E, tk.N, tk.S))
+        self.position_plot.grid(row=0, column=1, sticky=(tk.W, tk.E, tk.N, tk.S))
+        self.frame.columnconfigure(0, weight=1)
+        self.frame.columnconfigure(1, weight=1)
+        self.frame.rowconfigure(0, weight=1)
+        self.frame.after(PLOT_REFRESH_MS, self._refresh)
+
+    def grid(self, **kwargs):
+        self.frame.grid(**kwargs)
+
+    def feed(self, event):
+        self.queue.put(event.value)  # (millis, steps, reading)
+
+    #Drop everything plotted and queued so far and convert the next samples for mode
+    # and calibration when they are given; call from the Tk thread
+    def clear(self, mode=None, calibration=None):
+        if mode is not None:
+            self.mode = mode
+        if calibration is not None:
+            self.calibration = calibration
+        self._take(None)
+        self._time_origin = None
+        self.spectrum_plot.clear()
+        self.position_plot.clear()
+
+    def _take(self, limit):
+        samples = []
+        try:
+            while limit is None or len(samples) < limit:
+                samples.append(self.queue.get_nowait())
+        except queue.Empty:
+            pass
+        return samples
+
+    def _refresh(self):
+        samples = self._take(MAX_SAMPLES_PER_FRAME)
+        if samples:
+            millis, steps, reading = np.array(samples, dtype=float).T
+            seconds = millis / 1000
+            if self._time_origin is None:
+                self._time_origin = seconds[0]
+            self.spectrum_plot.series.add(positions_to_wavelengths(steps, self.mode, self.calibration), reading)
+            self.position_plot.series.add(seconds - self._time_origin, steps)
+            self.spectrum_plot.redraw()
+            self.position_plot.redraw()
+        self.frame.after(PLOT_REFRESH_MS, self._refresh)
@@ -0,0 +1,197 @@
+import argparse
+import asyncio
+import itertools
+import json
+import sys
+import time
+
+from async_mono import MonochromatorError
+from instrumentation import LatencyHistogram
+from mono_server import DEFAULT_HOST, DEFAULT_PORT, MAX_REQUEST_BYTES, parse_tcp_address
+
+
+#asyncio client for mono_server. Requests are pipelined: send() writes the request at
+# once and returns a future for its result, so any number can be in flight;
+# request() waits for the result. Errors the server reports are raised as
+# MonochromatorError. Broadcasts (after subscribe) go to on_event(message).
+class MonochromatorClient:
+    def __init__(self, on_event=None):
+        self.on_event = on_event
+        self.number = None  # Client number the server gave this connection
+        self._reader = None
+        self._writer = None
+        self._ids = itertools.count(1)
+        self._pending = {}  # request id -> future
+        self._receiver = None
+
+    #TCP to host:port, or the Unix socket at path when it is given
+    async def connect(self, host=DEFAULT_HOST, port=DEFAULT_PORT, path=None):
+        if path:
+            self._reader, self._writer = await asyncio.open_unix_connection(path, limit=MAX_REQUEST_BYTES)
+        else:
+            self._reader, self._writer = await asyncio.open_connection(host, port, limit=MAX_REQUEST_BYTES)
+        hello = json.loads(await self._reader.readline())
+        self.number = hello["client"]
+        self._receiver = asyncio.ensure_future(self._receive())
+
+    def send(self, cmd, **args):
+        if not self._writer:
+            raise MonochromatorError("Not connected to a server.")
+        request_id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+        self._writer.write(json.dumps({"id": request_id, "cmd": cmd, "args": args}).encode() + b"\n")
+        return future
+
+    async def request(self, cmd, **args):
+        return await self.send(cmd, **args)
+
+    async def _receive(self):
+        try:
+            while True:
+                line = await self._reader.readline()
+                if not line:
+                    break
+                message = json.loads(line)
+                future = self._pending.pop(message.get("id"), None) if "id" in message else None
+                if future is not None:
+                    if future.done():
+                        continue
+                    if message["ok"]:
+                        future.set_result(message["result"])
+                    else:
+                        future.set_exception(MonochromatorError(message["error"]))
+                elif "event" in message and self.on_event:
+                    self.on_event(message)
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            pending, self._pending = self._pending, {}
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(MonochromatorError("Connection to the server closed."))
+
+    async def close(self):
+        if self._writer:
+            self._writer.close()
+            try:
+                await self._writer.wait_closed()
+            except ConnectionError:
+                pass
+            self._writer = None
+        if self._receiver:
+            await self._receiver
+            self._receiver = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+
+#Hammer a server with clients each sending requests queries (default "state"),
+# pipeline of them in flight at a time, while subscribers watch every broadcast.
+# Returns {"requests", "seconds", "rate", "mean", "p50", "p95", "max", "events"} with
+# the latencies in seconds.
+async def load_test(host=DEFAULT_HOST, port=DEFAULT_PORT, path=None, clients=20, requests=500, pipeline=10,
+                    subscribers=0, command="state"):
+    histogram = LatencyHistogram()
+    received = 0
+    watchers = []
+
+    def count(message):
+        nonlocal received
+        received += 1
+
+    for _ in range(subscribers):
+        watcher = MonochromatorClient(on_event=count)
+        await watcher.connect(host, port, path)
+        await watcher.request("subscribe", read_only=True)
+        watchers.append(watcher)
+
+    async def run_client():
+        async with MonochromatorClient() as client:
+            await client.connect(host, port, path)
+            in_flight = set()
+            for _ in range(requests):
+                if len(in_flight) >= pipeline:
+                    _, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                in_flight.add(asyncio.ensure_future(timed(client)))
+            if in_flight:
+                await asyncio.wait(in_flight)
+
+    async def timed(client):
+        started = time.perf_counter()
+        await client.request(command)
+        histogram.add(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    try:
+        await asyncio.gather(*(run_client() for _ in range(clients)))
+    finally:
+        for watcher in watchers:
+            await watcher.close()
+    seconds = time.perf_counter() - started
+    return {"requests": histogram.count, "seconds": seconds, "rate": histogram.count / seconds,
+            "mean": histogram.mean, "p50": histogram.percentile(50), "p95": histogram.percentile(95),
+            "max": histogram.max, "events": received}
+
+
+async def _run(args, address):
+    host, port, path = address
+    if args.load_test:
+        result = await load_test(host, port, path, args.load_test, args.requests, args.pipeline, args.subscribers,
+                                 args.command or "state")
+        print(f"{result['requests']} requests from {args.load_test} clients in {result['seconds']:.2f} s, "
+              f"{result['rate']:.0f}/s; latency mean {result['mean'] * 1000:.2f} ms, "
+              f"p50 {result['p50'] * 1000:.2f} ms, p95 {result['p95'] * 1000:.2f} ms, "
+              f"max {result['max'] * 1000:.2f} ms; {result['events']} broadcasts received.")
+        return 0
+    printer = lambda message: print(json.dumps(message), flush=True)
+    async with MonochromatorClient(on_event=printer) as client:
+        await client.connect(host, port, path)
+        if args.watch:
+            await client.request("subscribe", read_only=not args.command)
+        if args.command:
+            try:
+                printer(await client.request(args.command, **args.args))
+            except MonochromatorError as e:
+                print(f"Error: {e}", file=sys.stderr)
+                return 1
+        if args.watch:
+            await client._receiver
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Talk to a mono_server.")
+    parser.add_argument("command", nargs="?", help="command to send, such as state, home or set_wavelength")
+    parser.add_argument("args", nargs="?", help='its arguments as a JSON object, such as \'{"wavelength": 550}\'')
+    parser.add_argument("--tcp", default=f"{DEFAULT_HOST}:{DEFAULT_PORT}", help="server host:port (default %(default)s)")
+    parser.add_argument("--unix", help="connect to this Unix socket instead")
+    parser.add_argument("--watch", action="store_true", help="print all broadcasts until the server goes away")
+    parser.add_argument("--load-test", type=int, metavar="CLIENTS", help="run a load test with this many clients")
+    parser.add_argument("--requests", type=int, default=500, help="requests per load test client")
+    parser.add_argument("--pipeline", type=int, default=10, help="requests in flight per load test client")
+    parser.add_argument("--subscribers", type=int, default=0, help="read-only subscribers during the load test")
+    args = parser.parse_args(argv)
+    if not (args.command or args.watch or args.load_test):
+        parser.error("give a command, --watch or --load-test")
+
+    try:
+        args.args = json.loads(args.args or "{}")
+    except ValueError as e:
+        parser.error(f"the arguments are not valid JSON: {e}")
+    host, port = parse_tcp_address(args.tcp)
+    try:
+        return asyncio.run(_run(args, (host, port, args.unix)))
+    except (OSError, MonochromatorError) as e:
+        print(f"Could not talk to the server: {e}", file=sys.stderr)
+        return 1
+    except KeyboardInterrupt:
+        return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
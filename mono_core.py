@@ -0,0 +1,317 @@
+import threading
+import time
+
+from command_scheduler import CommandScheduler
+from mono_emulator import open_port
+from mono_protocol import TextProtocol
+from mono_session import MonochromatorSession, MonochromatorError, FirmwareError, WaitFor, Pause, Callback
+from status_log import StatusLog
+from serial_reader import SerialReader
+
+#Controller for one monochromator with no GUI or console dependencies, so it imports
+# quickly and runs headless. The protocol itself lives in MonochromatorSession; this
+# class runs its commands blocking, on the calling (scheduler) thread, and reports
+# errors as status messages instead of raising. Frontends plug in through callbacks:
+# on_status(message) gets every status message (also kept in status_log),
+# on_event(event) every FirmwareEvent, on_sample(event) every streamed sample (on the
+# serial reader thread), on_idle() is called while a command waits for the Arduino
+# (GUI refresh, key checks) and confirm(question) -> bool is asked before changing
+# the grating mode (no confirm: go ahead).
+# max_status_lines caps the in-memory log; pass status_history_path to keep the full
+# history in a file. state_cache_path keeps the last known state of every port
+# between sessions.
+class MonochromatorCore(MonochromatorSession):
+    def __init__(self, port=None, baud_rate=9600, timeout=1, max_status_lines=1000, status_history_path=None,
+                 state_cache_path=None, on_status=None, on_event=None, on_idle=None, confirm=None,
+                 on_sample=None):
+        self.status_log = StatusLog(max_status_lines, status_history_path)
+        self.status_messages = self.status_log.lines
+        self.status_log.append("First select a COM port.")
+        super().__init__(on_status, on_event, on_sample, state_cache_path)
+        self.reader = None  # Background thread that owns ser.readline()
+        self.on_idle = on_idle
+        self.confirm = confirm
+        self._state_restored = False  # Homed state taken over from the firmware, homing skipped once
+        self.sweep_stop = threading.Event()  # Set by emergency_stop to abort a running sweep
+        self.spectrum = None  # SpectrumBuffer filled with photodiode samples streamed during moves
+        self.recording = None  # scan_store.ScanWriter the streamed samples are also written to
+
+        # Frontends submit commands here so a single worker owns the port; only
+        # emergency_stop bypasses it
+        self.scheduler = CommandScheduler()
+        self.scheduler.start()
+        self._write_lock = threading.Lock()
+
+        if port:
+            self.connect_to_monochromator(port, baud_rate, timeout)
+
+    #Queue func(*args, **kwargs) on the scheduler. An exception it raises goes to the
+    # status log instead of vanishing with the returned future.
+    def submit(self, func, *args, **kwargs):
+        future = self.scheduler.submit(func, *args, **kwargs)
+        name = getattr(func, "__name__", repr(func))
+        future.add_done_callback(lambda done: self._report_failure(name, done))
+        return future
+
+    def _report_failure(self, name, future):
+        if not future.cancelled() and future.exception() is not None:
+            self._add_status(f"{name} failed: {type(future.exception()).__name__}: {future.exception()}")
+
+    @staticmethod
+    def list_available_ports():
+        import serial.tools.list_ports
+        return [port.device for port in serial.tools.list_ports.comports()]
+
+
+    #Connecting to the COM port, without communicating with the Arduino
+    def connect_to_monochromator(self, selected_port, baud_rate=9600, timeout=1):
+        if selected_port:
+            self.ser = open_port(selected_port, baud_rate, timeout)  # EMULATOR_PORT gives a simulated Arduino
+            self.port = selected_port
+            self.reader = SerialReader(self.ser)
+            self.reader.start()
+            time.sleep(0.1)  # Give some time for the connection to establish
+            self._add_status(f"Connected to {selected_port}, you can now initialize and start your Monochromator.")
+        else:
+            self._add_status("Please select a COM port.")
+
+    #Assumes the COM port is connected and prepeares the Arduino to receive commands
+    def initialize_arduino(self):
+        if not self.ser:
+            self._add_status("COM port is not selected.")
+            return
+        time.sleep(0.1)  # Allow some time for Arduino to initialize and send data
+
+        # Take all the lines the reader has collected so far
+        responses = [event.line for event in self.reader.drain()]
+
+        # Combine all the responses into one status message
+        if responses:
+            combined_response = "\n".join(responses)
+            self._add_status(combined_response)
+    
+        self.arduino_initialized = True
+        self._state_restored = self._run(self._restore_state(), False)
+
+    #With force=False, the first call after the homed state was taken over from the
+    # firmware is skipped. Returns the homing duration in seconds, None when the motor
+    # was not homed.
+    def home_motor(self, force=False):
+        if self._state_restored and not force and self.ser:
+            self._state_restored = False
+            self._add_status("The motor is still homed, homing skipped. Home again to home it anyway.")
+            return None
+        self._state_restored = False
+        return self._run(self._home())
+
+    #Speeds of the two homing phases in steps/s, acceleration in steps/s^2 and the
+    # timeout after which the firmware gives up, in seconds. None keeps a setting.
+    def set_homing_profile(self, fast_speed=None, slow_speed=None, acceleration=None, timeout=None):
+        return self._run(self._set_homing_profile(fast_speed, slow_speed, acceleration, timeout))
+
+    def select_grating_mode(self, mode):
+        if self.grating_selected and self.ser and self.arduino_initialized and self.motor_homed:
+            # Ask the user if they want to change the grating mode
+            if self.confirm and not self.confirm("A grating mode is already selected. Are you sure you want to change it?"):
+                self._add_status("Grating mode change cancelled.")
+                return  # Exit the method if the user does not want to change the mode
+        if self._run(self._select_grating(mode)) and self.spectrum is not None:
+            self.spectrum.mode = mode
+
+    #profile (a MotionProfile or the name of one in motion_profiles) switches the
+    # firmware to that profile for this and the following moves. Returns True when the
+    # target was reached, False otherwise.
+    def set_wavelength(self, wavelength, profile=None):
+        return self._run(self._set_wavelength(wavelength, profile), False)
+
+    #Move to an absolute step position, bypassing the wavelength fits
+    def move_to_steps(self, steps, profile=None):
+        return self._run(self._move_to_steps(steps, profile), False)
+
+    #Make profile (a MotionProfile or the name of one in motion_profiles) the one the
+    # firmware moves with and wait for its confirmation
+    def set_motion_profile(self, profile):
+        self._run(self._set_motion_profile(profile))
+
+    #Use the wavelength -> step calibration saved at path (see calibration.py) for all
+    # further moves
+    def load_calibration(self, path):
+        # numpy is only needed once a calibration is used
+        from calibration import Calibration
+        try:
+            self.calibration = Calibration.load(path)
+        except (OSError, ValueError, KeyError) as e:
+            self._add_status(f"Could not load the calibration from {path}: {e}")
+            return
+        if self.spectrum is not None:
+            self.spectrum.calibration = self.calibration
+        self._add_status(f"Loaded the wavelength calibration from {path}.")
+
+    #See MonochromatorSession._sweep; without on_progress the progress goes to the
+    # status log. Returns the wavelengths that were reached, in visiting order.
+    def sweep(self, start=None, stop=None, step=None, wavelengths=None, dwell=0.0, on_point=None, on_progress=None,
+              optimize_order=False, approach=None, profile=None, max_settle=None):
+        return self._run(self._sweep(start, stop, step, wavelengths, dwell, on_point,
+                                     on_progress or self._add_sweep_progress, optimize_order, approach, profile,
+                                     max_settle), [])
+
+    def _add_sweep_progress(self, done, total, elapsed, eta):
+        self._add_status(f"Scan point {done}/{total}, elapsed {elapsed:.1f} s, remaining about {eta:.1f} s.")
+
+    #Ask the firmware to send a photodiode sample every interval_ms during moves and
+    # collect them in self.spectrum. channel 1 is S1 (A0), 2 is S2 (A5). With
+    # record_path every sample is also appended to that scan file (see scan_store.py)
+    # until stop_streaming.
+    def start_streaming(self, channel=1, interval_ms=50, capacity=100000, record_path=None):
+        if not self.ser:
+            self._add_status("COM port is not selected.")
+            return
+        if self.spectrum is None or self.spectrum.capacity != capacity:
+            # numpy is only needed once streaming is used
+            from spectrum_stream import SpectrumBuffer
+            self.spectrum = SpectrumBuffer(capacity, self.grating_mode or "Switch Mode", self.calibration)
+        if record_path:
+            from scan_store import ScanWriter
+            self._close_recording()
+            self.recording = ScanWriter(record_path, self.grating_mode or "Switch Mode", self.calibration,
+                                        metadata={"channel": channel, "interval_ms": interval_ms})
+            self._add_status(f"Recording samples to {record_path}.")
+        self.reader.on_sample = self._sample
+        self._run(self._stream(channel, interval_ms))
+
+    def stop_streaming(self):
+        self._run(self._stream(0, 0))
+        self._close_recording()
+
+    #SerialReader on_sample hook: keep, record and pass on every streamed sample
+    def _sample(self, event):
+        self.spectrum.append_event(event)
+        recording = self.recording
+        if recording:
+            recording.append_event(event)
+        if self.on_sample:
+            self.on_sample(event)
+
+    def _close_recording(self):
+        if self.recording:
+            recording, self.recording = self.recording, None
+            recording.close()
+            self._add_status(f"Saved {recording.count} samples to {recording.path}.")
+
+    #Record a whole spectrum in one continuous move from start to stop nm while the
+    # firmware streams photodiode samples. Returns (wavelength, reading) arrays.
+    def acquire_spectrum(self, start, stop, channel=1, interval_ms=50):
+        if not self.grating_selected:
+            self._add_status("Please select prefered grating ro work with and then move to desired wavelength.")
+            return None
+        self.set_wavelength(start)
+        self.start_streaming(channel, interval_ms)
+        self.spectrum.clear()
+        self.set_wavelength(stop)
+        self.stop_streaming()
+        wavelength, reading = self.spectrum.spectrum()
+        self._add_status(f"Recorded {len(wavelength)} samples between {start} and {stop} nm.")
+        return wavelength, reading
+
+    def emergency_stop(self):
+        if not self.ser:
+            self._add_status("COM port is not selected.")
+            return
+        if not self.arduino_initialized:
+            self._add_status("The arduino is off, please press START.")
+            return
+        if not self.motor_homed and not self.homing:
+            self._add_status("Please home the motor first to start operation.")
+            return
+        # Drop everything that is still queued and put the stop on the wire right away,
+        # even while another command is running. The acknowledgement is picked up by the
+        # set_wavelength or sweep call that is waiting on the move being stopped.
+        self.sweep_stop.set()
+        cancelled = self.scheduler.cancel_pending()
+        if cancelled:
+            self._add_status(f"Cancelled {cancelled} queued command(s).")
+        self._send_stop()
+
+    #Switch the link to the framed binary protocol at baud_rate. Firmware that does not
+    # know the binary command keeps talking text and nothing changes.
+    def use_binary_protocol(self, baud_rate=115200):
+        if self._run(self._use_binary_protocol(baud_rate)) is False:
+            self._add_status("The Arduino does not support the binary protocol, staying with text commands.")
+
+    #Runs command, a MonochromatorSession generator, to its end, blocking. Returns its
+    # result, or failed after logging the error it raised.
+    def _run(self, command, failed=None):
+        result = error = None
+        while True:
+            try:
+                action = command.throw(error) if error else command.send(result)
+            except FirmwareError:
+                return failed  # Its reply is already in the status log
+            except MonochromatorError as e:
+                self._finish_span(False)
+                self._add_status(str(e))
+                return failed
+            except StopIteration as done:
+                return done.value
+            result = error = None
+            try:
+                result = self._perform(action)
+            except MonochromatorError as e:
+                error = e
+
+    def _perform(self, action):
+        if isinstance(action, WaitFor):
+            event = self.reader.wait_for(action.kinds, timeout=action.timeout, on_event=self._handle_event,
+                                         on_idle=self.on_idle, answers=action.answers)
+            if event is None and self.reader.closed:
+                raise MonochromatorError("Lost connection to the Arduino.")
+            return event
+        if isinstance(action, Pause):
+            return self.sweep_stop.wait(action.seconds)
+        if isinstance(action, Callback):
+            return action.func(*action.args)
+        raise TypeError(f"Unknown action {action!r}")
+
+    #The emergency stop shares the write lock with the commands, so it only waits for
+    # a write in progress, never for the firmware's replies
+    def _write_port(self, data):
+        with self._write_lock:
+            self.ser.write(data)
+
+    def _expect_binary(self, decode):
+        self.reader.expect_binary(decode)
+
+    def _stop_requested(self):
+        return self.sweep_stop.is_set()
+
+    def _clear_stop(self):
+        self.sweep_stop.clear()
+
+    def get_status(self):
+        return self.status_log.text()
+
+    def _add_status(self, message):
+        self.status_log.append(message)
+        if self.on_status:
+            self.on_status(message)
+
+    def disconnect(self):
+        if self.ser:
+            try:
+                if self.reader:
+                    self.reader.stop()
+                if self.recording:
+                    self.recording.close()
+                    self.recording = None
+                self._save_state()
+                self.ser.close()
+                self._add_status("Disconnected from Arduino.")
+            except Exception as e:
+                self._add_status(f"Error disconnecting: {e}")
+            finally:
+                self.ser = None
+                self.reader = None
+                self.protocol = TextProtocol()
+        else:
+            self._add_status("No serial connection to disconnect.")
+        self.status_log.close()
\ No newline at end of file
@@ -0,0 +1,590 @@
+import math
+import re
+import struct
+import threading
+import time
+
+from mono_model import (GRATING_MODES, VIS_MODE, IR_MODE, SWITCH_MODE, MAX_SPEED, ACCELERATION, MAX_PROFILE_SPEED,
+                        MAX_PROFILE_ACCELERATION, HOMING_FAST_SPEED,
+                        HOMING_SLOW_SPEED, HOMING_ACCELERATION, HOMING_TIMEOUT, HOMING_BACKOFF, HOMING_MAX_TRAVEL,
+                        HOMING_PROGRESS_INTERVAL, wavelength_to_steps, position_to_wavelength, move_time, distance_at,
+                        accelerate_time, accelerate_distance, transfer_time)
+from mono_protocol import (FrameDecoder, encode_frame, OP_PING, OP_HOME, OP_MODE, OP_WAVELENGTH, OP_STOP, OP_STREAM,
+                           ST_PONG, ST_HOMING, ST_HOMED, ST_MODE_SELECTED, ST_INVALID_MODE, ST_TARGET_REACHED,
+                           ST_INVALID_WAVELENGTH, ST_EMERGENCY_STOP, ST_SAMPLE, ST_STREAMING, ST_BUSY,
+                           ST_UNKNOWN_COMMAND, OP_STEPS, ST_POSITION_REACHED, ST_INVALID_POSITION, OP_STATE,
+                           ST_STATE, OP_HOMING_PROFILE, ST_HOMING_PROGRESS, ST_HOMING_FAILED, ST_HOMING_PROFILE,
+                           HOMING_PHASES, HOMING_FAULTS, OP_MOTION_PROFILE, ST_MOTION_PROFILE)
+
+EMULATOR_PORT = "EMULATOR"  # Port name that connect_to_monochromator maps to the emulator
+
+ARDUINO_TX_BUFFER = 64  # Serial.print only blocks once this many bytes are waiting to go out
+ARDUINO_SERIAL_TIMEOUT = 1.0  # Default Serial.setTimeout, used by readStringUntil
+MAX_TARGET_STEPS = 13500  # Highest position steps_selected accepts
+
+
+class _PortClosed(Exception):
+    pass
+
+
+# Phases and fault reasons of homeStepperMotor(), as numbered in the binary protocol
+_COARSE, _FINE = 1, 2
+_TIMEOUT, _STOPPED, _NO_SENSOR = 1, 2, 3
+
+
+def _to_float(text):
+    # Arduino String.toFloat(): leading number, 0 if there is none
+    match = re.match(r"\s*[-+]?(\d+\.?\d*|\.\d+)", text)
+    return float(match.group(0)) if match else 0.0
+
+
+#Default photodiode signal: a dark level with a few Gaussian emission lines
+def default_spectrum(wavelength):
+    if wavelength is None:
+        return 20
+    lines = ((435.8, 8.0, 700), (546.1, 6.0, 900), (810.0, 15.0, 500), (1529.6, 20.0, 600))
+    return 20 + sum(height * math.exp(-0.5 * ((wavelength - center) / width) ** 2)
+                    for center, width, height in lines)
+
+
+def _to_int(text):
+    match = re.match(r"\s*[-+]?\d+", text)
+    return int(match.group(0)) if match else 0
+
+
+#Open selected_port, or an emulated Arduino when it is EMULATOR_PORT or, to run
+# several at once, EMULATOR_PORT followed by ":<name>".
+# Real ports are opened without asserting DTR: on most Arduino boards DTR resets the
+# board, which would make the firmware forget that the motor is homed. Some drivers
+# (Linux with HUPCL set on the tty) still pulse DTR while opening; boards on those
+# keep their state across reconnects only with the auto-reset disabled (a 10 uF
+# capacitor between RESET and GND, or the board's RESET-EN jumper cut).
+def open_port(selected_port, baud_rate=9600, timeout=1, **emulator_options):
+    if selected_port == EMULATOR_PORT or selected_port.startswith(EMULATOR_PORT + ":"):
+        return EmulatedSerial(selected_port, baud_rate, timeout, **emulator_options)
+    import serial
+    ser = serial.Serial()
+    ser.port = selected_port
+    ser.baudrate = baud_rate
+    ser.timeout = timeout
+    ser.dtr = False
+    ser.open()
+    return ser
+
+
+#Pure-Python stand-in for the Arduino running monochromator_3modes.ino, with the
+# subset of the serial.Serial interface the controllers use. Serial transfer time at
+# baud_rate and the AccelStepper speed/acceleration profile are modelled; time_scale
+# below 1 runs the whole simulation proportionally faster than real time.
+class EmulatedSerial:
+    def __init__(self, port=EMULATOR_PORT, baudrate=9600, timeout=1, time_scale=1.0,
+                 home_distance=2000, photodiode_reading=305, boot_time=0.0, spectrum=default_spectrum):
+        self.port = port
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.time_scale = time_scale
+        self.is_open = True
+
+        self.photodiode_reading = photodiode_reading  # Value printed after homing
+        self.physical_position = float(home_distance)  # Steps above the S2 photodiode edge
+        self.origin = 0.0  # Physical position of AccelStepper's step 0
+        self.grating_mode = VIS_MODE
+        self.homed = False
+        self.grating_selected = False
+        self.spectrum = spectrum  # Photodiode reading as a function of wavelength (None between gratings)
+        self.stream_channel = 0
+        self.stream_interval = 50  # ms
+        self.binary = False  # Switched on by "binary <baud>"
+        self.motion_profile = [MAX_SPEED, ACCELERATION]  # Used by wavelength and step moves
+        self.homing_profile = [HOMING_FAST_SPEED, HOMING_SLOW_SPEED, HOMING_ACCELERATION, HOMING_TIMEOUT]
+        self._next_homing_progress = 0.0
+        self._frame_decoder = FrameDecoder()
+        self._frames = []
+        self._reply_seq = 0
+
+        self._cond = threading.Condition()
+        self._t0 = time.monotonic()
+        self._host_tx_free = 0.0  # When the last byte written by the host reaches the Arduino
+        self._arduino_tx_free = 0.0  # When the last byte printed by the Arduino reaches the host
+        self._to_arduino = []  # (arrival time, bytes) chunks written by the host
+        self._rx_buffer = b""  # Bytes that have reached the Arduino but are not a full line yet
+        self._to_host = []  # (arrival time, bytes) lines printed by the Arduino
+        self._host_buffer = b""  # Bytes that have reached the host
+
+        self._firmware = threading.Thread(target=self._run_firmware, args=(boot_time,),
+                                          name="EmulatedArduino", daemon=True)
+        self._firmware.start()
+
+    @property
+    def position(self):
+        return int(round(self.physical_position - self.origin))
+
+    # ---- serial.Serial interface -------------------------------------------------
+
+    def write(self, data):
+        self._check_open()
+        with self._cond:
+            now = self._now()
+            self._host_tx_free = max(now, self._host_tx_free) + transfer_time(len(data), self.baudrate)
+            self._to_arduino.append((self._host_tx_free, bytes(data)))
+            self._cond.notify_all()
+        return len(data)
+
+    def readline(self):
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        with self._cond:
+            while True:
+                self._check_open()
+                self._collect_host_bytes()
+                if b"\n" in self._host_buffer:
+                    line, self._host_buffer = self._host_buffer.split(b"\n", 1)
+                    return line + b"\n"
+                if not self._wait(deadline, self._to_host):
+                    line, self._host_buffer = self._host_buffer, b""
+                    return line
+
+    def read(self, size=1):
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        with self._cond:
+            while True:
+                self._check_open()
+                self._collect_host_bytes()
+                if len(self._host_buffer) >= size or not self._wait(deadline, self._to_host):
+                    data, self._host_buffer = self._host_buffer[:size], self._host_buffer[size:]
+                    return data
+
+    @property
+    def in_waiting(self):
+        with self._cond:
+            self._collect_host_bytes()
+            return len(self._host_buffer)
+
+    def reset_input_buffer(self):
+        with self._cond:
+            self._collect_host_bytes()
+            self._host_buffer = b""
+
+    def flush(self):
+        pass
+
+    def close(self):
+        with self._cond:
+            self.is_open = False
+            self._cond.notify_all()
+        if threading.current_thread() is not self._firmware:
+            self._firmware.join(timeout=1)
+
+    # ---- simulated clock and wire ------------------------------------------------
+
+    def _now(self):
+        return (time.monotonic() - self._t0) / self.time_scale
+
+    def _check_open(self):
+        if not self.is_open:
+            raise OSError("Attempting to use a port that is not open")
+
+    # Wait on the condition until the real-time deadline or the next chunk in pending
+    # lands. Returns False once the deadline has passed.
+    def _wait(self, deadline, pending):
+        timeout = None if deadline is None else deadline - time.monotonic()
+        if timeout is not None and timeout <= 0:
+            return False
+        if pending:
+            arrival = (pending[0][0] - self._now()) * self.time_scale
+            timeout = arrival if timeout is None else min(timeout, arrival)
+        self._cond.wait(timeout=None if timeout is None else max(timeout, 0))
+        return True
+
+    def _collect_host_bytes(self):
+        now = self._now()
+        while self._to_host and self._to_host[0][0] <= now:
+            self._host_buffer += self._to_host.pop(0)[1]
+
+    # ---- firmware side -----------------------------------------------------------
+
+    def _sleep(self, seconds):
+        deadline = time.monotonic() + seconds * self.time_scale
+        with self._cond:
+            while self.is_open and self._wait(deadline, []):
+                pass
+            if not self.is_open:
+                raise _PortClosed()
+
+    #Next complete line from the host, or with the binary protocol the next
+    # (seq, op, payload) frame. None once sim_timeout seconds have passed.
+    def _read_command(self, sim_timeout=None):
+        deadline = None if sim_timeout is None else time.monotonic() + sim_timeout * self.time_scale
+        with self._cond:
+            while True:
+                if not self.is_open:
+                    raise _PortClosed()
+                now = self._now()
+                while self._to_arduino and self._to_arduino[0][0] <= now:
+                    self._rx_buffer += self._to_arduino.pop(0)[1]
+                if self.binary:
+                    self._frames += self._frame_decoder.feed(self._rx_buffer)
+                    self._rx_buffer = b""
+                    if self._frames:
+                        return self._frames.pop(0)
+                elif b"\n" in self._rx_buffer:
+                    line, self._rx_buffer = self._rx_buffer.split(b"\n", 1)
+                    return line.decode(errors="replace").strip()
+                if not self._wait(deadline, self._to_arduino):
+                    return None
+
+    _read_line = _read_command
+
+    def _println(self, text=""):
+        self._send((str(text) + "\r\n").encode())
+
+    def _send_frame(self, op, payload=b""):
+        self._send(encode_frame(self._reply_seq, op, payload))
+
+    def _send(self, data):
+        with self._cond:
+            now = self._now()
+            self._arduino_tx_free = max(now, self._arduino_tx_free) + transfer_time(len(data), self.baudrate)
+            self._to_host.append((self._arduino_tx_free, data))
+            self._cond.notify_all()
+            # Serial.println blocks while the TX buffer is full
+            backlog = self._arduino_tx_free - now - transfer_time(ARDUINO_TX_BUFFER, self.baudrate)
+        if backlog > 0:
+            self._sleep(backlog)
+
+    def _run_firmware(self, boot_time):
+        try:
+            if boot_time:
+                self._sleep(boot_time)
+            self._println("Your Monochromator is now initialized and on.")
+            self._println("Before starting operation please first home the motor.")
+            while True:
+                command = self._read_command()
+                if self.binary:
+                    self._handle_frame(*command)
+                else:
+                    self._handle(command)
+        except _PortClosed:
+            pass
+
+    def _handle(self, command):
+        if command == "home":
+            self._println("Homing command received.")
+            self._home()
+        elif command == "mode_selected":
+            self._select_mode()
+        elif command.startswith("stream"):
+            self._set_streaming(command)
+        elif command.startswith("wavelength_selected"):
+            self._move_to_wavelength(_to_float(command[20:]))
+        elif command.startswith("motion_profile"):
+            self._set_motion_profile(*(_to_int(field) for field in (command[15:].split() + ["0"] * 2)[:2]))
+        elif command.startswith("homing_profile"):
+            self._set_homing_profile(*(_to_int(field) for field in (command[15:].split() + ["0"] * 4)[:4]))
+        elif command == "state":
+            self._send_state()
+        elif command.startswith("steps_selected"):
+            self._move_to_steps(_to_int(command[15:]))
+        elif command.startswith("binary"):
+            baud = _to_int(command[7:]) or 9600
+            self._println(f"Binary protocol at {baud} baud.")
+            # The host changes self.baudrate on its side; both ends share the attribute
+            self.binary = True
+        # Anything else, including a stray "stop", is ignored like in loop()
+
+    def _handle_frame(self, seq, op, payload):
+        self._reply_seq = seq
+        if op == OP_PING:
+            self._send_frame(ST_PONG)
+        elif op == OP_HOME:
+            self._send_frame(ST_HOMING)
+            self._home()
+        elif op == OP_MODE and len(payload) == 1:
+            self._apply_mode(payload[0])
+        elif op == OP_WAVELENGTH and len(payload) == 4:
+            self._move_to_wavelength(struct.unpack("<i", payload)[0] / 100)
+        elif op == OP_MOTION_PROFILE and len(payload) == 4:
+            self._set_motion_profile(*struct.unpack("<HH", payload))
+        elif op == OP_HOMING_PROFILE and len(payload) == 8:
+            self._set_homing_profile(*struct.unpack("<HHHH", payload))
+        elif op == OP_STATE:
+            self._send_state()
+        elif op == OP_STEPS and len(payload) == 4:
+            self._move_to_steps(struct.unpack("<i", payload)[0])
+        elif op == OP_STREAM and len(payload) == 3:
+            self._apply_streaming(*struct.unpack("<BH", payload))
+        elif op != OP_STOP:
+            self._send_frame(ST_UNKNOWN_COMMAND)
+
+    #homeStepperMotor(): out of S2 if it is already blocked, coarse search backwards
+    # until it blocks, back off HOMING_BACKOFF steps and a fine approach at the slow
+    # speed. Positions <= 0 are inside the sensor.
+    def _home(self):
+        started = self._now()
+        self._next_homing_progress = started + HOMING_PROGRESS_INTERVAL
+        fault = None
+        if self.physical_position <= 0:
+            fault = self._homing_move(1 - self.physical_position, "search", _COARSE, started)
+        if fault is None:
+            if self.physical_position > HOMING_MAX_TRAVEL:
+                # run() reaches the end of the search without the sensor tripping
+                fault = self._homing_move(-HOMING_MAX_TRAVEL, "move", _COARSE, started) or _NO_SENSOR
+            else:
+                fault = (self._homing_move(-self.physical_position, "search", _COARSE, started)
+                         or self._homing_move(1, "creep", _FINE, started)
+                         or self._homing_move(HOMING_BACKOFF, "move", _FINE, started)
+                         or self._homing_move(-self.physical_position, "creep", _FINE, started))
+        if fault is not None:
+            self.homed = False
+            if self.binary:
+                self._send_frame(ST_HOMING_FAILED, bytes((fault,)))
+            else:
+                self._println(f"Homing failed: {HOMING_FAULTS[fault]}.")
+            return
+        self.physical_position = 0.0
+        self.origin = self.physical_position
+        self.homed = True
+        if self.binary:
+            self._send_frame(ST_HOMED, struct.pack("<H", self.photodiode_reading))
+            return
+        self._println(f"Photodiode S2: {self.photodiode_reading}")
+        self._println("Homed to initial position.")
+        self._println("You can now select the grating you wish to operate with.")
+
+    #One leg of the homing: "search" accelerates towards the fast speed until stopped,
+    # "creep" runs at the constant slow speed and "move" is a move() with the fast profile.
+    # Sends progress and honours stop and the homing timeout. Returns the fault, None
+    # when the leg finished.
+    def _homing_move(self, distance, kind, phase, started):
+        fast, slow, acceleration, timeout = self.homing_profile
+        if kind == "move":
+            duration = move_time(distance, fast, acceleration)
+            covered = lambda t: distance_at(t, distance, fast, acceleration)
+        elif kind == "creep":
+            duration = abs(distance) / slow
+            covered = lambda t: min(abs(distance), slow * t)
+        else:
+            duration = accelerate_time(distance, fast, acceleration)
+            covered = lambda t: min(abs(distance), accelerate_distance(t, fast, acceleration))
+        start = self.physical_position
+        direction = 1 if distance >= 0 else -1
+        began = self._now()
+        while True:
+            now = self._now()
+            self.physical_position = float(round(start + direction * covered(now - began)))
+            if now - began >= duration:
+                self.physical_position = start + distance
+                return None
+            if now - started > timeout:
+                return _TIMEOUT
+            if now >= self._next_homing_progress:
+                self._next_homing_progress = now + HOMING_PROGRESS_INTERVAL
+                if self.binary:
+                    self._send_frame(ST_HOMING_PROGRESS, struct.pack("<Bi", phase, self.position))
+                else:
+                    self._println(f"Homing: {HOMING_PHASES[phase]}, position {self.position}")
+                continue
+            wake = min(began + duration, self._next_homing_progress, started + timeout + 0.001)
+            command = self._read_command(max(wake - now, 0))
+            if command is not None and self.binary:
+                homing_seq, self._reply_seq = self._reply_seq, command[0]
+                if command[1] != OP_STOP:
+                    self._send_frame(ST_BUSY)
+                    self._reply_seq = homing_seq
+                    continue
+            if command == "stop" or (self.binary and command is not None):
+                self.physical_position = float(round(start + direction * covered(self._now() - began)))
+                return _STOPPED
+
+    #motion_profile: 0 keeps a setting, others are clamped to the firmware's limits
+    def _set_motion_profile(self, max_speed, acceleration):
+        if max_speed > 0:
+            self.motion_profile[0] = min(max_speed, MAX_PROFILE_SPEED)
+        if acceleration > 0:
+            self.motion_profile[1] = min(acceleration, MAX_PROFILE_ACCELERATION)
+        max_speed, acceleration = self.motion_profile
+        if self.binary:
+            self._send_frame(ST_MOTION_PROFILE, struct.pack("<HH", max_speed, acceleration))
+        else:
+            self._println(f"Motion profile: speed {max_speed}, acceleration {acceleration}")
+
+    #homing_profile: 0 keeps a setting; the timeout is in seconds
+    def _set_homing_profile(self, fast, slow, acceleration, timeout):
+        for index, value in enumerate((fast, slow, acceleration, timeout)):
+            if value > 0:
+                self.homing_profile[index] = value
+        fast, slow, acceleration, timeout = self.homing_profile
+        if self.binary:
+            self._send_frame(ST_HOMING_PROFILE, struct.pack("<HHHH", fast, slow, acceleration, timeout))
+        else:
+            self._println(f"Homing profile: fast {fast}, slow {slow}, acceleration {acceleration}, timeout {timeout}")
+
+    def _select_mode(self):
+        while True:
+            # readStringUntil gives up after the serial timeout and "".toInt() is 0
+            line = self._read_line(ARDUINO_SERIAL_TIMEOUT)
+            if self._apply_mode(_to_int(line or "")):
+                return
+
+    def _apply_mode(self, selection):
+        if selection not in (VIS_MODE, IR_MODE, SWITCH_MODE):
+            if self.binary:
+                self._send_frame(ST_INVALID_MODE)
+            else:
+                self._println("Invalid selection. Please choose an existing operating mode:")
+            return False
+        self.grating_mode = selection
+        self.grating_selected = True
+        if self.binary:
+            self._send_frame(ST_MODE_SELECTED, bytes((selection,)))
+        else:
+            self._println(f"Grating mode selected. You are now operating with the {GRATING_MODES[selection]}")
+        return True
+
+    def _send_state(self):
+        mode = self.grating_mode if self.grating_selected else -1
+        if self.binary:
+            self._send_frame(ST_STATE, struct.pack("<BBi", self.homed, mode & 0xFF, self.position))
+        else:
+            self._println(f"State: homed {int(self.homed)}, mode {mode}, position {self.position}")
+
+    def _set_streaming(self, command):
+        separator = command.find(" ", 7)
+        self._apply_streaming(_to_int(command[7:]), _to_int(command[separator + 1:]) if separator > 0 else 0)
+
+    def _apply_streaming(self, channel, interval):
+        if interval > 0:
+            self.stream_interval = interval
+        self.stream_channel = channel if channel in (1, 2) else 0
+        if self.binary:
+            self._send_frame(ST_STREAMING, struct.pack("<BH", self.stream_channel, self.stream_interval))
+        elif self.stream_channel:
+            self._println(f"Streaming photodiode S{channel} every {self.stream_interval} ms.")
+        else:
+            self._println("Streaming off.")
+
+    def _send_sample(self):
+        if not self.stream_channel:
+            return
+        reading = min(1023, max(0, int(self.spectrum(position_to_wavelength(self.position, self.grating_mode)))))
+        millis = int(self._now() * 1000)
+        if self.binary:
+            self._send_frame(ST_SAMPLE, struct.pack("<IiH", millis & 0xFFFFFFFF, self.position, reading))
+        else:
+            self._println(f"S,{millis},{self.position},{reading}")
+
+    def _move_to_wavelength(self, wavelength):
+        try:
+            target = wavelength_to_steps(wavelength, self.grating_mode)
+        except ValueError:
+            if self.binary:
+                self._send_frame(ST_INVALID_WAVELENGTH)
+            elif self.grating_mode == VIS_MODE:
+                self._println("Invalid wavelength for VIS Grating. Please enter a wavelength between 350 and 1000 nm:")
+            elif self.grating_mode == IR_MODE:
+                self._println("Invalid wavelength for IR Grating. Please enter a wavelength between 587 and 2000 nm:")
+            else:
+                self._println("Invalid wavelength for switching mode. Please enter a wavelength between 350 and 2000 nm:")
+            return
+        if self.grating_mode == VIS_MODE and not self.binary:
+            self._println(f"Moving to wavelength: {wavelength:.2f}")
+        if not self._run_to_target(target):
+            return
+        if self.binary:
+            self._send_frame(ST_TARGET_REACHED, struct.pack("<i", int(wavelength * 100 + 0.5)))
+            return
+        self._println(f"Target wavelength reached. Current wavelength is: {wavelength:.2f}")
+        self._println("You can now enter a new wavelength or choose another grating to work with.")
+
+    def _move_to_steps(self, target):
+        if not 0 <= target <= MAX_TARGET_STEPS:
+            if self.binary:
+                self._send_frame(ST_INVALID_POSITION)
+            else:
+                self._println(f"Invalid position. Please enter a step position between 0 and {MAX_TARGET_STEPS}")
+            return
+        if not self._run_to_target(target):
+            return
+        if self.binary:
+            self._send_frame(ST_POSITION_REACHED, struct.pack("<i", self.position))
+            return
+        self._println(f"Target position reached. Current position is: {self.position}")
+        self._println("You can now enter a new wavelength or choose another grating to work with.")
+
+    #runToTarget(): the move with samples around it, reporting an emergency stop.
+    # Returns False if stopped.
+    def _run_to_target(self, target):
+        self._send_sample()
+        if not self._run_to(target, *self.motion_profile):
+            if self.binary:
+                self._send_frame(ST_EMERGENCY_STOP)
+                self._send_sample()
+                return False
+            self._println("Emergency stop initiated.")
+            self._send_sample()
+            self._println("You can now enter a new wavelength or choose another grating to work with.")
+            return False
+        self._send_sample()
+        return True
+
+    #moveTo() + run() loop. Lines arriving mid-move are consumed; "stop" halts the
+    # motor where it is, anything else is dropped (answered with ST_BUSY in binary).
+    # While streaming, a sample is sent every stream_interval ms. Returns False if stopped.
+    def _run_to(self, target, max_speed=MAX_SPEED, acceleration=ACCELERATION):
+        start = self.physical_position
+        distance = (target + self.origin) - start
+        direction = 1 if distance >= 0 else -1
+        duration = move_time(distance, max_speed, acceleration)
+        began = self._now()
+        next_sample = began + self.stream_interval / 1000
+        while True:
+            now = self._now()
+            self.physical_position = float(round(start + direction * distance_at(now - began, distance,
+                                                                                  max_speed, acceleration)))
+            remaining = duration - (now - began)
+            if remaining <= 0:
+                self.physical_position = start + distance
+                return True
+            if self.stream_channel:
+                if now >= next_sample:
+                    self._send_sample()
+                    next_sample = max(next_sample + self.stream_interval / 1000, self._now())
+                    continue
+                remaining = min(remaining, next_sample - now)
+            command = self._read_command(remaining)
+            if command is not None and self.binary:
+                move_seq, self._reply_seq = self._reply_seq, command[0]
+                if command[1] != OP_STOP:
+                    self._send_frame(ST_BUSY)
+                    self._reply_seq = move_seq
+                    continue
+            if command == "stop" or (self.binary and command is not None):
+                covered = distance_at(self._now() - began, distance, max_speed, acceleration)
+                self.physical_position = float(round(start + direction * covered))
+                return False
+
+
+#Scripted session against the emulator, printing when every reply arrived
+if __name__ == "__main__":
+    import sys
+    from serial_reader import SerialReader, HOMED, MODE_SELECTED, READY
+
+    time_scale = float(sys.argv[1]) if len(sys.argv) > 1 else 1.0
+    ser = EmulatedSerial(time_scale=time_scale)
+    reader = SerialReader(ser)
+    reader.start()
+    started = time.monotonic()
+
+    def show(event):
+        print(f"{(time.monotonic() - started) / time_scale:9.3f} s  {event.line}")
+
+    reader.wait_for("initialized", on_event=show)
+    ser.write(b"home\n")
+    reader.wait_for(HOMED, on_event=show)
+    ser.write(b"mode_selected\n")
+    ser.write(b"2\n")
+    reader.wait_for(MODE_SELECTED, on_event=show)
+    for wavelength in (400, 600, 700, 1200, 500):
+        ser.write(f"wavelength_selected {wavelength}\n".encode())
+        reader.wait_for(READY, on_event=show)
+    reader.stop()
+    ser.close()
@@ -1,7 +1,13 @@
 import tkinter as tk
 from tkinter import ttk
+from live_plot import LivePlotPanel
 from mono_class import MonochromatorControl
-import threading
+
+# Photodiode streaming interval while a plotted scan runs. A text sample line is up
+# to 26 bytes, so at 9600 baud (960 bytes/s) anything faster than 50 ms fills the
+# Arduino's TX buffer and stalls the motor; 15 byte binary frames at 115200 baud
+# leave room for 20 ms.
+PLOT_SAMPLE_INTERVAL_MS = {"text": 50, "binary": 20}
 
 class MonochromatorGUI:
     def __init__(self, root):
@@ -19,45 +25,95 @@ class MonochromatorGUI:
         ttk.Button(self.mainframe, text="Connect", command=lambda: self.monochromator.connect_to_monochromator(self.combobox.get())).grid(row=0, column=2, sticky=tk.W)
 
         # Add the "Start Arduino" button
-        ttk.Button(self.mainframe, text="Start Arduino", command=lambda: self.monochromator.initialize_arduino()).grid(row=1, column=2, sticky=tk.W)
+        ttk.Button(self.mainframe, text="Start Arduino", command=lambda: self.monochromator.submit(self.monochromator.initialize_arduino)).grid(row=1, column=2, sticky=tk.W)
 
         # Add the "Home Motor" button
-        ttk.Button(self.mainframe, text="Home Motor", command=lambda: self.monochromator.home_motor()).grid(row=1, column=3, sticky=tk.W)
+        ttk.Button(self.mainframe, text="Home Motor", command=lambda: self.monochromator.submit(self.monochromator.home_motor)).grid(row=1, column=3, sticky=tk.W)
 
         # Add the dropdown menu for grating mode selection
         ttk.Label(self.mainframe, text="Select Grating Mode:").grid(row=2, column=0, sticky=tk.W)
         self.grating_modes = ["VIS Grating", "IR Grating", "Switch Mode"]
         self.grating_combobox = ttk.Combobox(self.mainframe, values=self.grating_modes)
         self.grating_combobox.grid(row=2, column=1, sticky=(tk.W, tk.E))
-        ttk.Button(self.mainframe, text="Set Mode", command=lambda: threading.Thread(target=self.monochromator.select_grating_mode, args=(self.grating_combobox.get(),)).start()).grid(row=2, column=2, sticky=tk.W)
+        ttk.Button(self.mainframe, text="Set Mode", command=lambda: self.monochromator.submit(self.monochromator.select_grating_mode, self.grating_combobox.get())).grid(row=2, column=2, sticky=tk.W)
 
         ttk.Label(self.mainframe, text="Enter Target Wavelength:").grid(row=4, column=0, columnspan=2, sticky=tk.W)
 
         self.wavelength_entry = ttk.Entry(self.mainframe, width=7)
         self.wavelength_entry.grid(row=5, column=0, sticky=(tk.W, tk.E))
-        ttk.Button(self.mainframe, text="Set Wavelength", command=lambda: threading.Thread(target=self.monochromator.set_wavelength, args=(self.wavelength_entry.get(),)).start()).grid(row=5, column=1, sticky=tk.W)
-
-        ttk.Button(self.mainframe, text="Emergency Stop", command=lambda: threading.Thread(target=self.monochromator.emergency_stop).start()).grid(row=6, column=0, columnspan=2, sticky=tk.W)
+        ttk.Button(self.mainframe, text="Set Wavelength", command=lambda: self.monochromator.submit(self.monochromator.set_wavelength, self.wavelength_entry.get())).grid(row=5, column=1, sticky=tk.W)
+
+        ttk.Button(self.mainframe, text="Emergency Stop", command=lambda: self.monochromator.emergency_stop()).grid(row=6, column=0, columnspan=2, sticky=tk.W)
+
+        # Add the wavelength scan controls
+        ttk.Label(self.mainframe, text="Scan Start / Stop / Step (nm):").grid(row=7, column=0, columnspan=2, sticky=tk.W)
+        self.scan_start_entry = ttk.Entry(self.mainframe, width=7)
+        self.scan_start_entry.grid(row=8, column=0, sticky=(tk.W, tk.E))
+        self.scan_stop_entry = ttk.Entry(self.mainframe, width=7)
+        self.scan_stop_entry.grid(row=8, column=1, sticky=(tk.W, tk.E))
+        self.scan_step_entry = ttk.Entry(self.mainframe, width=7)
+        self.scan_step_entry.grid(row=8, column=2, sticky=(tk.W, tk.E))
+        self.scan_optimize = tk.BooleanVar(value=False)
+        ttk.Checkbutton(self.mainframe, text="Optimize order", variable=self.scan_optimize).grid(row=8, column=3, sticky=tk.W)
+        ttk.Label(self.mainframe, text="Dwell per point (s):").grid(row=9, column=0, sticky=tk.W)
+        self.scan_dwell_entry = ttk.Entry(self.mainframe, width=7)
+        self.scan_dwell_entry.grid(row=9, column=1, sticky=(tk.W, tk.E))
+        ttk.Button(self.mainframe, text="Scan", command=self.start_scan).grid(row=9, column=2, sticky=tk.W)
+        self.scan_plot = tk.BooleanVar(value=True)
+        ttk.Checkbutton(self.mainframe, text="Live plot", variable=self.scan_plot).grid(row=9, column=3, sticky=tk.W)
 
         # Create a Text widget for the status area
         self.status_text = tk.Text(self.mainframe, height=10, wrap=tk.WORD, state=tk.DISABLED)
-        self.status_text.grid(row=7, column=0, columnspan=3, sticky=(tk.W, tk.E, tk.N, tk.S))
+        self.status_text.grid(row=10, column=0, columnspan=3, sticky=(tk.W, tk.E, tk.N, tk.S))
 
         # Add a vertical scrollbar for the Text widget
         self.status_scrollbar = ttk.Scrollbar(self.mainframe, orient=tk.VERTICAL, command=self.status_text.yview)
-        self.status_scrollbar.grid(row=7, column=3, sticky=(tk.N, tk.S))
+        self.status_scrollbar.grid(row=10, column=3, sticky=(tk.N, tk.S))
 
         self.status_text.configure(yscrollcommand=self.status_scrollbar.set)
 
+        # Live plots of the samples streamed during a scan
+        self.live_plot = LivePlotPanel(self.mainframe)
+        self.live_plot.grid(row=11, column=0, columnspan=4, sticky=(tk.W, tk.E, tk.N, tk.S))
+
         # Adjust window resize behavior
         root.columnconfigure(0, weight=1)
         root.rowconfigure(0, weight=1)
         self.mainframe.columnconfigure(0, weight=1)
         self.mainframe.columnconfigure(1, weight=1)
         self.mainframe.columnconfigure(2, weight=1)
+        self.mainframe.rowconfigure(11, weight=1)
 
         # Initialize MonochromatorControl with GUI reference
         self.monochromator = MonochromatorControl(gui=self)
+        self.monochromator.on_sample = self.live_plot.feed
+
+    def start_scan(self):
+        try:
+            start = float(self.scan_start_entry.get())
+            stop = float(self.scan_stop_entry.get())
+            step = float(self.scan_step_entry.get())
+            dwell = float(self.scan_dwell_entry.get() or 0)
+        except ValueError:
+            self.monochromator._add_status("Please enter numbers for the scan start, stop, step and dwell.")
+            return
+        sweep = self.monochromator.sweep
+        if self.scan_plot.get():
+            self.live_plot.clear(self.monochromator.grating_mode, self.monochromator.calibration)
+            sweep = self._plotted_sweep
+        self.monochromator.submit(sweep, start=start, stop=stop, step=step, dwell=dwell,
+                                            optimize_order=self.scan_optimize.get())
+
+    #Runs in the scheduler's worker: sweep while the photodiode streams to the live plot
+    def _plotted_sweep(self, **kwargs):
+        if not self.monochromator.grating_selected:
+            self.monochromator.sweep(**kwargs)  # Reports what is missing
+            return
+        self.monochromator.start_streaming(interval_ms=PLOT_SAMPLE_INTERVAL_MS[self.monochromator.protocol.name])
+        try:
+            self.monochromator.sweep(**kwargs)
+        finally:
+            self.monochromator.stop_streaming()
 
 if __name__ == "__main__":
     root = tk.Tk()
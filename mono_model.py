@@ -0,0 +1,185 @@
+import math
+
+# Host-side copy of the numbers hardcoded in monochromator_3modes.ino
+
+GRATING_MODES = ["VIS Grating", "IR Grating", "Switch Mode"]  # Index is the value sent after mode_selected
+VIS_MODE = 0
+IR_MODE = 1
+SWITCH_MODE = 2
+
+# AccelStepper settings from setup()
+MAX_SPEED = 500  # steps/s
+ACCELERATION = 50  # steps/s^2
+# Limits of motion_profile, which replaces the two values above
+MAX_PROFILE_SPEED = 4000  # steps/s
+MAX_PROFILE_ACCELERATION = 20000  # steps/s^2
+
+# Default homing profile of homeStepperMotor(), changed with homing_profile
+HOMING_FAST_SPEED = 500  # steps/s, coarse search for the S2 photodiode
+HOMING_SLOW_SPEED = 50  # steps/s, fine approach to its edge
+HOMING_ACCELERATION = 200  # steps/s^2
+HOMING_TIMEOUT = 60  # s, the firmware gives up and reports a failure after this
+HOMING_BACKOFF = 30  # Steps moved out of the sensor between the two phases
+HOMING_MAX_TRAVEL = 20000  # Steps the coarse search goes before reporting no sensor
+HOMING_PROGRESS_INTERVAL = 0.25  # s between progress reports
+
+# Linear fits used by moveToWavelength(): steps = (wavelength + offset) / slope
+VIS_OFFSET = 389.2407
+VIS_SLOPE = 1.1127
+IR_OFFSET = 4715.4390
+IR_SLOPE = 0.5099
+SWITCH_WAVELENGTH = 650  # Switch Mode uses the VIS fit below this and the IR fit above
+
+WAVELENGTH_RANGES = {
+    VIS_MODE: (350, 1000),
+    IR_MODE: (587, 2000),
+    SWITCH_MODE: (350, 2000),
+}
+
+
+def mode_index(mode):
+    if isinstance(mode, str):
+        return GRATING_MODES.index(mode)
+    return int(mode)
+
+
+def wavelength_range(mode):
+    return WAVELENGTH_RANGES[mode_index(mode)]
+
+
+def is_valid_wavelength(wavelength, mode):
+    low, high = wavelength_range(mode)
+    return low <= wavelength <= high
+
+
+#The grating the firmware uses for a wavelength: the selected one, or in Switch Mode
+# the one on the side of SWITCH_WAVELENGTH the wavelength falls on
+def grating_for(wavelength, mode):
+    mode = mode_index(mode)
+    if mode == SWITCH_MODE:
+        return VIS_MODE if wavelength < SWITCH_WAVELENGTH else IR_MODE
+    return mode
+
+
+#Same conversion as moveToWavelength(), including the truncation to int.
+# Raises ValueError for wavelengths the firmware would reject.
+def wavelength_to_steps(wavelength, mode):
+    mode = mode_index(mode)
+    if not is_valid_wavelength(wavelength, mode):
+        low, high = wavelength_range(mode)
+        raise ValueError(f"Invalid wavelength {wavelength} for {GRATING_MODES[mode]}, expected {low}-{high} nm.")
+    if grating_for(wavelength, mode) == VIS_MODE:
+        return int((wavelength + VIS_OFFSET) / VIS_SLOPE)
+    return int((wavelength + IR_OFFSET) / IR_SLOPE)
+
+
+#Inverse of the fit for one grating, for turning step positions back into wavelengths
+def steps_to_wavelength(steps, grating):
+    if mode_index(grating) == VIS_MODE:
+        return steps * VIS_SLOPE - VIS_OFFSET
+    return steps * IR_SLOPE - IR_OFFSET
+
+
+# Step positions bounding the two halves of Switch Mode; the motor only passes
+# through the positions in between while moving from one grating to the other
+SWITCH_VIS_MAX_STEPS = (SWITCH_WAVELENGTH + VIS_OFFSET) / VIS_SLOPE
+SWITCH_IR_MIN_STEPS = (SWITCH_WAVELENGTH + IR_OFFSET) / IR_SLOPE
+
+
+#Wavelength at a step position in the given mode, None for positions between the
+# VIS and IR parts of Switch Mode
+def position_to_wavelength(steps, mode):
+    mode = mode_index(mode)
+    if mode != SWITCH_MODE:
+        return steps_to_wavelength(steps, mode)
+    if steps <= SWITCH_VIS_MAX_STEPS:
+        return steps_to_wavelength(steps, VIS_MODE)
+    if steps >= SWITCH_IR_MIN_STEPS:
+        return steps_to_wavelength(steps, IR_MODE)
+    return None
+
+
+#Wavelengths that are converted with the given grating's fit in this mode
+def grating_range(grating, mode):
+    grating = mode_index(grating)
+    low, high = wavelength_range(mode)
+    if mode_index(mode) == SWITCH_MODE:
+        if grating == VIS_MODE:
+            return low, SWITCH_WAVELENGTH
+        return SWITCH_WAVELENGTH, high
+    return low, high
+
+
+#Time for a rest-to-rest AccelStepper move over distance steps (trapezoidal profile,
+# triangular when the move is too short to reach max_speed)
+def move_time(distance, max_speed=MAX_SPEED, acceleration=ACCELERATION):
+    distance = abs(distance)
+    if distance == 0:
+        return 0.0
+    if distance >= max_speed * max_speed / acceleration:
+        return distance / max_speed + max_speed / acceleration
+    return 2 * math.sqrt(distance / acceleration)
+
+
+#Distance covered t seconds into the move above
+def distance_at(t, distance, max_speed=MAX_SPEED, acceleration=ACCELERATION):
+    distance = abs(distance)
+    total = move_time(distance, max_speed, acceleration)
+    if t <= 0:
+        return 0.0
+    if t >= total:
+        return float(distance)
+    # Peak speed is max_speed for a trapezoid, lower for a triangle
+    peak = min(max_speed, math.sqrt(distance * acceleration))
+    ramp = peak / acceleration
+    if t <= ramp:
+        return 0.5 * acceleration * t * t
+    ramp_distance = 0.5 * peak * ramp
+    if t <= total - ramp:
+        return ramp_distance + peak * (t - ramp)
+    left = total - t
+    return distance - 0.5 * acceleration * left * left
+
+
+#Time to cover distance from rest towards a target that is never reached, as in the
+# homing search where the firmware stops the motor when the photodiode trips
+def accelerate_time(distance, max_speed=MAX_SPEED, acceleration=ACCELERATION):
+    distance = abs(distance)
+    ramp_distance = max_speed * max_speed / (2 * acceleration)
+    if distance <= ramp_distance:
+        return math.sqrt(2 * distance / acceleration)
+    return max_speed / acceleration + (distance - ramp_distance) / max_speed
+
+
+#Inverse of accelerate_time: distance covered t seconds into such a search
+def accelerate_distance(t, max_speed=MAX_SPEED, acceleration=ACCELERATION):
+    if t <= 0:
+        return 0.0
+    ramp = max_speed / acceleration
+    if t <= ramp:
+        return 0.5 * acceleration * t * t
+    return 0.5 * max_speed * ramp + max_speed * (t - ramp)
+
+
+#Expected duration of the two-phase homing from distance steps above the sensor
+# edge: coarse search, back-off out of the sensor and fine approach
+def homing_time(distance, fast_speed=HOMING_FAST_SPEED, slow_speed=HOMING_SLOW_SPEED,
+                acceleration=HOMING_ACCELERATION):
+    coarse = accelerate_time(distance, fast_speed, acceleration) if distance > 0 else 0.0
+    return (coarse + move_time(HOMING_BACKOFF, fast_speed, acceleration)
+            + (HOMING_BACKOFF + 1) / slow_speed)
+
+
+#Wire time of nbytes at baud_rate with 8N1 framing (10 bits per byte)
+def transfer_time(nbytes, baud_rate=9600):
+    return nbytes * 10 / baud_rate
+
+
+#Inclusive list of wavelengths from start to stop every step nm, in either direction
+def sweep_wavelengths(start, stop, step):
+    step = abs(step)
+    if step == 0:
+        raise ValueError("Scan step must not be zero.")
+    direction = 1 if stop >= start else -1
+    count = int(math.floor(abs(stop - start) / step + 1e-9)) + 1
+    return [round(start + direction * i * step, 6) for i in range(count)]
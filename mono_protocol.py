@@ -0,0 +1,275 @@
+import itertools
+import struct
+import threading
+
+from mono_model import GRATING_MODES
+from serial_reader import (FirmwareEvent, PONG, HOMING_STARTED, HOMED, HOMING_PROGRESS, HOMING_FAILED,
+                           HOMING_PROFILE, MOTION_PROFILE, MODE_SELECTED, INVALID_MODE, TARGET_REACHED,
+                           POSITION_REACHED, READY, INVALID_WAVELENGTH, INVALID_POSITION, STATE, EMERGENCY_STOP,
+                           SAMPLE, STREAMING, MESSAGE)
+
+# Framing shared with monochromator_3modes.ino:
+# 0xA5, sequence number, opcode, payload length, payload, CRC-8 (poly 0x07) over
+# sequence number..payload. Numbers are little endian.
+FRAME_START = 0xA5
+MAX_PAYLOAD = 16
+
+OP_PING = 0x01
+OP_HOME = 0x02
+OP_MODE = 0x03
+OP_WAVELENGTH = 0x04
+OP_STOP = 0x05
+OP_STREAM = 0x06
+OP_STEPS = 0x07
+OP_STATE = 0x08
+OP_HOMING_PROFILE = 0x09
+OP_MOTION_PROFILE = 0x0A
+
+ST_PONG = 0x80
+ST_HOMING = 0x81
+ST_HOMED = 0x82
+ST_MODE_SELECTED = 0x83
+ST_INVALID_MODE = 0x84
+ST_TARGET_REACHED = 0x85
+ST_INVALID_WAVELENGTH = 0x86
+ST_EMERGENCY_STOP = 0x87
+ST_SAMPLE = 0x88
+ST_STREAMING = 0x89
+ST_BUSY = 0x8A
+ST_BAD_FRAME = 0x8B
+ST_UNKNOWN_COMMAND = 0x8C
+ST_POSITION_REACHED = 0x8D
+ST_INVALID_POSITION = 0x8E
+ST_STATE = 0x8F
+ST_HOMING_PROGRESS = 0x90
+ST_HOMING_FAILED = 0x91
+ST_HOMING_PROFILE = 0x92
+ST_MOTION_PROFILE = 0x93
+
+HOMING_PHASES = {1: "coarse search", 2: "fine approach"}
+HOMING_FAULTS = {1: "timeout", 2: "stopped", 3: "sensor not found"}
+
+READY_LINE = "You can now enter a new wavelength or choose another grating to work with."
+
+
+def crc8(data, crc=0):
+    for value in data:
+        crc ^= value
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x07) & 0xFF if crc & 0x80 else (crc << 1) & 0xFF
+    return crc
+
+
+def encode_frame(seq, op, payload=b""):
+    body = bytes((seq & 0xFF, op, len(payload))) + payload
+    return bytes((FRAME_START,)) + body + bytes((crc8(body),))
+
+
+#Reassembles (seq, op, payload) frames from a byte stream, resynchronising on the
+# start byte and dropping frames with a bad CRC
+class FrameDecoder:
+    def __init__(self):
+        self.buffer = bytearray()
+        self.bad_frames = 0
+
+    def feed(self, data):
+        self.buffer += data
+        frames = []
+        while True:
+            start = self.buffer.find(FRAME_START)
+            if start < 0:
+                self.buffer.clear()
+                return frames
+            del self.buffer[:start]
+            if len(self.buffer) < 4:
+                return frames
+            length = self.buffer[3]
+            if length > MAX_PAYLOAD:
+                del self.buffer[:1]
+                continue
+            if len(self.buffer) < length + 5:
+                return frames
+            body = bytes(self.buffer[1:length + 4])
+            if crc8(body) != self.buffer[length + 4]:
+                self.bad_frames += 1
+                del self.buffer[:1]
+                continue
+            del self.buffer[:length + 5]
+            frames.append((body[0], body[1], body[3:]))
+
+
+#(kind, line, value) of the events a status frame stands for: the kinds and values
+# come straight from the opcode and payload and match what parse_line makes of the
+# text protocol's lines; line is the text equivalent, for the status log only
+def status_events(op, payload):
+    if op == ST_PONG:
+        return [(PONG, "Pong.", None)]
+    if op == ST_HOMING:
+        return [(HOMING_STARTED, "Homing command received.", None)]
+    if op == ST_HOMED:
+        reading, = struct.unpack("<H", payload)
+        return [(MESSAGE, f"Photodiode S2: {reading}", None), (MESSAGE, "Homed to initial position.", None),
+                (HOMED, "You can now select the grating you wish to operate with.", None)]
+    if op == ST_HOMING_PROGRESS:
+        phase, position = struct.unpack("<Bi", payload)
+        return [(HOMING_PROGRESS, f"Homing: {HOMING_PHASES.get(phase, 'fine approach')}, position {position}",
+                 ("coarse" if phase == 1 else "fine", position))]
+    if op == ST_HOMING_FAILED:
+        reason = HOMING_FAULTS.get(payload[0], "sensor not found")
+        return [(HOMING_FAILED, f"Homing failed: {reason}.", reason)]
+    if op == ST_HOMING_PROFILE:
+        fast, slow, acceleration, timeout = struct.unpack("<HHHH", payload)
+        return [(HOMING_PROFILE, f"Homing profile: fast {fast}, slow {slow}, acceleration {acceleration}, "
+                                 f"timeout {timeout}",
+                 {"fast": fast, "slow": slow, "acceleration": acceleration, "timeout": timeout})]
+    if op == ST_MOTION_PROFILE:
+        speed, acceleration = struct.unpack("<HH", payload)
+        return [(MOTION_PROFILE, f"Motion profile: speed {speed}, acceleration {acceleration}",
+                 {"speed": speed, "acceleration": acceleration})]
+    if op == ST_MODE_SELECTED:
+        mode = GRATING_MODES[payload[0]]
+        return [(MODE_SELECTED, f"Grating mode selected. You are now operating with the {mode}", mode)]
+    if op == ST_INVALID_MODE:
+        return [(INVALID_MODE, "Invalid selection. Please choose an existing operating mode:", None)]
+    if op == ST_TARGET_REACHED:
+        centi_nm, = struct.unpack("<i", payload)
+        return [(TARGET_REACHED, f"Target wavelength reached. Current wavelength is: {centi_nm / 100:.2f}",
+                 centi_nm / 100), (READY, READY_LINE, None)]
+    if op == ST_INVALID_WAVELENGTH:
+        return [(INVALID_WAVELENGTH, "Invalid wavelength for the selected grating.", None)]
+    if op == ST_POSITION_REACHED:
+        steps, = struct.unpack("<i", payload)
+        return [(POSITION_REACHED, f"Target position reached. Current position is: {steps}", steps),
+                (READY, READY_LINE, None)]
+    if op == ST_STATE:
+        homed, mode, position = struct.unpack("<BBi", payload)
+        return [(STATE, f"State: homed {homed}, mode {-1 if mode == 255 else mode}, position {position}",
+                 {"homed": homed == 1, "mode": None if mode == 255 else mode, "position": position})]
+    if op == ST_INVALID_POSITION:
+        return [(INVALID_POSITION, "Invalid position for the motor.", None)]
+    if op == ST_EMERGENCY_STOP:
+        return [(EMERGENCY_STOP, "Emergency stop initiated.", None), (READY, READY_LINE, None)]
+    if op == ST_SAMPLE:
+        millis, steps, reading = struct.unpack("<IiH", payload)
+        return [(SAMPLE, f"S,{millis},{steps},{reading}", (millis, steps, reading))]
+    if op == ST_STREAMING:
+        channel, interval = struct.unpack("<BH", payload)
+        return [(STREAMING, f"Streaming photodiode S{channel} every {interval} ms." if channel else "Streaming off.",
+                 None)]
+    if op == ST_BUSY:
+        return [(MESSAGE, "Command ignored while the motor is moving.", None)]
+    if op == ST_BAD_FRAME:
+        return [(MESSAGE, "The Arduino received a corrupted frame.", None)]
+    return [(MESSAGE, f"The Arduino did not recognise command 0x{op:02X}.", None)]
+
+
+def _any_reply(event):
+    return True
+
+
+#The original line-based protocol. Every method returns the bytes to write.
+class TextProtocol:
+    name = "text"
+    decode = None  # SerialReader keeps reading lines
+
+    def home(self):
+        return b'home\n'
+
+    #Speed in steps/s and acceleration in steps/s^2 of the following moves; 0 keeps a setting
+    def motion_profile(self, max_speed=0, acceleration=0):
+        return f'motion_profile {int(max_speed)} {int(acceleration)}\n'.encode()
+
+    #Speeds in steps/s, acceleration in steps/s^2, timeout in s; 0 keeps a setting
+    def homing_profile(self, fast_speed=0, slow_speed=0, acceleration=0, timeout=0):
+        return f'homing_profile {int(fast_speed)} {int(slow_speed)} {int(acceleration)} {int(timeout)}\n'.encode()
+
+    def select_mode(self, mode_index):
+        return f'mode_selected\n{mode_index}\n'.encode()
+
+    def wavelength(self, wavelength):
+        return f'wavelength_selected {wavelength}\n'.encode()
+
+    def steps(self, steps):
+        return f'steps_selected {int(steps)}\n'.encode()
+
+    def state(self):
+        return b'state\n'
+
+    def stop(self):
+        return b'stop\n'
+
+    def stream(self, channel, interval_ms):
+        return f'stream {channel} {interval_ms}\n'.encode()
+
+    #Text replies carry no sequence number, every event may answer a command
+    def answers(self, data):
+        return _any_reply
+
+
+#Framed binary protocol with sequence numbers. decode turns received bytes into the
+# same FirmwareEvents the text protocol produces, tagged with the sequence number of
+# the command they answer, and answers(frame) lets a caller wait for the replies to
+# one particular command.
+class BinaryProtocol:
+    name = "binary"
+
+    def __init__(self):
+        self._seq = itertools.count(1)
+        self._seq_lock = threading.Lock()
+        self._decoder = FrameDecoder()
+        self.stop_seq = None  # Sequence number of the last stop sent
+
+    def _frame(self, op, payload=b""):
+        with self._seq_lock:
+            return encode_frame(next(self._seq) & 0xFF, op, payload)
+
+    def ping(self):
+        return self._frame(OP_PING)
+
+    def home(self):
+        return self._frame(OP_HOME)
+
+    def motion_profile(self, max_speed=0, acceleration=0):
+        return self._frame(OP_MOTION_PROFILE, struct.pack("<HH", int(max_speed), int(acceleration)))
+
+    def homing_profile(self, fast_speed=0, slow_speed=0, acceleration=0, timeout=0):
+        return self._frame(OP_HOMING_PROFILE, struct.pack("<HHHH", int(fast_speed), int(slow_speed),
+                                                          int(acceleration), int(timeout)))
+
+    def select_mode(self, mode_index):
+        return self._frame(OP_MODE, bytes((mode_index,)))
+
+    def wavelength(self, wavelength):
+        return self._frame(OP_WAVELENGTH, struct.pack("<i", int(round(float(wavelength) * 100))))
+
+    def steps(self, steps):
+        return self._frame(OP_STEPS, struct.pack("<i", int(steps)))
+
+    def state(self):
+        return self._frame(OP_STATE)
+
+    def stop(self):
+        frame = self._frame(OP_STOP)
+        self.stop_seq = frame[1]
+        return frame
+
+    def stream(self, channel, interval_ms):
+        return self._frame(OP_STREAM, struct.pack("<BH", channel, interval_ms))
+
+    #Predicate for SerialReader.wait_for telling whether an event replies to frame: it
+    # carries the frame's sequence number, or that of a stop sent after it (the
+    # firmware answers a stop in place of the move it interrupts). Late replies to
+    # earlier commands do not match.
+    def answers(self, frame):
+        seq, stop_before = frame[1], self.stop_seq
+        return lambda event: event.seq is None or event.seq == seq or event.seq == self.stop_seq != stop_before
+
+    def decode(self, data):
+        events = []
+        for seq, op, payload in self._decoder.feed(data):
+            try:
+                replies = status_events(op, payload)
+            except (struct.error, IndexError):
+                replies = [(MESSAGE, f"Malformed status frame 0x{op:02X}.", None)]
+            events.extend(FirmwareEvent(kind, line, value, seq=seq) for kind, line, value in replies)
+        return events
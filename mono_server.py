@@ -0,0 +1,469 @@
+import argparse
+import asyncio
+import inspect
+import itertools
+import json
+import os
+import signal
+import sys
+import time
+from collections import deque
+
+from async_mono import AsyncMonochromatorControl, MonochromatorError
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 7654
+MAX_REQUEST_BYTES = 1 << 20  # Longest request line, enough for a sweep over ~50000 wavelengths
+OUTBOX_SIZE = 10000  # Messages waiting for a slow client before its broadcasts are dropped
+
+# Broadcast topics a client can subscribe to
+TOPICS = ("status", "samples", "scan", "server")
+
+# Commands that move the motor or change the firmware's settings. They run one at a
+# time in the order they arrive, from a queue shared by all clients.
+QUEUED_COMMANDS = ("home", "set_homing_profile", "select_grating", "set_wavelength", "move_to_steps",
+                   "set_motion_profile", "sweep", "start_streaming", "stop_streaming")
+# Answered right away, also while a queued command runs
+IMMEDIATE_COMMANDS = ("ping", "state", "status", "move_times", "subscribe", "unsubscribe", "lock", "unlock", "stop")
+
+# JSON type every request argument must have; null is accepted where the command's
+# default is None. Arguments not listed here cannot be sent.
+NUMBER = (int, float)
+ARGUMENT_TYPES = {
+    "wavelength": NUMBER, "start": NUMBER, "stop": NUMBER, "step": NUMBER, "wavelengths": list, "dwell": NUMBER,
+    "optimize_order": bool, "approach": str, "profile": str, "max_settle": NUMBER, "steps": int, "mode": str,
+    "fast_speed": int, "slow_speed": int, "acceleration": int, "timeout": int, "channel": int, "interval_ms": int,
+    "lines": int, "topics": list, "read_only": bool,
+}
+TYPE_NAMES = {NUMBER: "a number", int: "an integer", str: "a string", bool: "true or false", list: "a list"}
+
+
+#A queued command and the client that sent it
+class _Request:
+    def __init__(self, client, request_id, command, args):
+        self.client = client
+        self.id = request_id
+        self.command = command
+        self.args = args
+
+
+#One connection. Everything sent to it goes through a bounded outbox drained by its
+# own writer task, so a slow client holds up neither the instrument nor the other
+# clients: once the outbox is full broadcasts to it are dropped (and counted) while
+# replies wait for room.
+class _Client:
+    def __init__(self, number, writer):
+        self.number = number
+        self.writer = writer
+        self.topics = set()
+        self.read_only = False
+        self.connected = True
+        self.dropped = 0  # Broadcasts lost because the client did not keep up
+        self.outbox = asyncio.Queue(OUTBOX_SIZE)
+
+    def post(self, message):
+        try:
+            self.outbox.put_nowait(message)
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    async def reply(self, request_id, result=None, error=None):
+        if not self.connected:
+            return
+        if error is None:
+            await self.outbox.put({"id": request_id, "ok": True, "result": result})
+        else:
+            await self.outbox.put({"id": request_id, "ok": False, "error": error})
+
+    async def send_loop(self):
+        try:
+            while True:
+                messages = [await self.outbox.get()]
+                while not self.outbox.empty() and len(messages) < 1000:
+                    messages.append(self.outbox.get_nowait())
+                self.writer.write(b"".join(json.dumps(message).encode() + b"\n" for message in messages))
+                await self.writer.drain()
+        except (ConnectionError, OSError):
+            self.connected = False
+
+
+#Shares one monochromator between any number of local clients over TCP and/or a
+# Unix socket. Clients send one JSON object per line, {"id": ..., "cmd": ...,
+# "args": {...}}, and may pipeline requests without waiting for the replies; every
+# reply carries the id of its request: {"id": ..., "ok": true, "result": ...} or
+# {"id": ..., "ok": false, "error": "..."}. Queries are answered in order right
+# away. Commands that move the motor (QUEUED_COMMANDS) are queued and answered when
+# they finish, so their replies may overtake earlier ones.
+# A client holding the lock is the only one allowed to queue motion commands; stop
+# works for every client that is not read only and also empties the queue.
+# Subscribers get {"event": ...} broadcasts: status lines, streamed samples, sweep
+# points and progress, and server events (lock changes, commands starting and
+# finishing). on_status(message) additionally gets every status line.
+class MonochromatorServer:
+    def __init__(self, unit, port_name=None, max_status_lines=1000, on_status=None):
+        self.unit = unit  # Connected and initialized AsyncMonochromatorControl
+        self.port_name = port_name
+        self.on_status = on_status
+        self.unit.on_status = self._on_status
+        self.unit.on_sample = self._on_sample
+        self.clients = {}  # number -> _Client
+        self.lock_owner = None  # Number of the client holding the motion lock
+        self.status_lines = deque(maxlen=max_status_lines)
+        self.running = None  # _Request being executed
+        self.commands_run = 0
+        self._queue = deque()
+        self._queue_ready = asyncio.Event()
+        self._numbers = itertools.count(1)
+        self._servers = []
+        self._worker = None
+        self._unix_path = None
+
+    async def start(self, host=DEFAULT_HOST, port=DEFAULT_PORT, unix_path=None):
+        if port is not None:
+            self._servers.append(await asyncio.start_server(self._serve_client, host, port,
+                                                            limit=MAX_REQUEST_BYTES))
+        if unix_path:
+            self._servers.append(await asyncio.start_unix_server(self._serve_client, unix_path,
+                                                                 limit=MAX_REQUEST_BYTES))
+            self._unix_path = unix_path
+        self._worker = asyncio.ensure_future(self._run_queue())
+
+    #Addresses the server listens on, as (host, port) tuples or socket paths
+    def addresses(self):
+        addresses = []
+        for server in self._servers:
+            for sock in server.sockets:
+                name = sock.getsockname()
+                addresses.append(name[:2] if isinstance(name, tuple) else name)
+        return addresses
+
+    async def close(self):
+        for server in self._servers:
+            server.close()
+        if self._worker:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+        for client in list(self.clients.values()):
+            client.writer.close()
+        for server in self._servers:
+            await server.wait_closed()
+        self._servers = []
+        if self._unix_path and os.path.exists(self._unix_path):
+            os.unlink(self._unix_path)
+
+    def broadcast(self, topic, message):
+        for client in self.clients.values():
+            if topic in client.topics:
+                client.post(message)
+
+    def _on_status(self, message):
+        self.status_lines.append(message)
+        if self.on_status:
+            self.on_status(message)
+        self.broadcast("status", {"event": "status", "message": message})
+
+    def _on_sample(self, event):
+        millis, steps, reading = event.value
+        self.broadcast("samples", {"event": "sample", "millis": millis, "steps": steps, "reading": reading})
+
+    async def _serve_client(self, reader, writer):
+        client = _Client(next(self._numbers), writer)
+        self.clients[client.number] = client
+        sender = asyncio.ensure_future(client.send_loop())
+        client.post({"event": "hello", "client": client.number, "topics": TOPICS,
+                     "commands": IMMEDIATE_COMMANDS + QUEUED_COMMANDS})
+        try:
+            while client.connected:
+                try:
+                    line = await reader.readline()
+                except ValueError:
+                    await client.reply(None, error=f"Request longer than {MAX_REQUEST_BYTES} bytes.")
+                    break
+                except ConnectionError:
+                    break
+                if not line:
+                    break
+                if line.strip():
+                    await self._dispatch(client, line)
+            # Give the replies already in the outbox a moment to go out before hanging up
+            for _ in range(100):
+                if not client.connected or client.outbox.empty():
+                    break
+                await asyncio.sleep(0.01)
+        finally:
+            client.connected = False
+            del self.clients[client.number]
+            self._forget(client)
+            sender.cancel()
+            writer.close()
+
+    #Drop what a client that went away left behind: its lock and its queued commands.
+    # A command of it that is already running finishes.
+    def _forget(self, client):
+        if self.lock_owner == client.number:
+            self._set_lock(None)
+        self._queue = deque(request for request in self._queue if request.client is not client)
+
+    async def _dispatch(self, client, line):
+        try:
+            request = json.loads(line)
+        except ValueError as e:
+            await client.reply(None, error=f"Invalid JSON: {e}")
+            return
+        if not isinstance(request, dict):
+            await client.reply(None, error="A request must be a JSON object.")
+            return
+        request_id = request.get("id")
+        command = request.get("cmd")
+        args = request.get("args") or {}
+        if not isinstance(args, dict):
+            await client.reply(request_id, error="args must be a JSON object.")
+            return
+        if command in IMMEDIATE_COMMANDS:
+            try:
+                handler = getattr(self, f"_cmd_{command}")
+                _check_arguments(command, handler, args)
+                result = handler(client, **args)
+                if asyncio.iscoroutine(result):
+                    result = await result
+            except Exception as e:
+                await client.reply(request_id, error=str(e) if isinstance(e, MonochromatorError)
+                                   else f"{type(e).__name__}: {e}")
+                return
+            await client.reply(request_id, result)
+        elif command in QUEUED_COMMANDS:
+            error = self._motion_refused(client)
+            if not error:
+                try:
+                    _check_arguments(command, getattr(self.unit, command), args)
+                except MonochromatorError as e:
+                    error = str(e)
+            if error:
+                await client.reply(request_id, error=error)
+                return
+            self._queue.append(_Request(client, request_id, command, args))
+            self._queue_ready.set()
+        else:
+            await client.reply(request_id, error=f"Unknown command {command!r}.")
+
+    def _motion_refused(self, client):
+        if client.read_only:
+            return "This client is read only."
+        if self.lock_owner not in (None, client.number):
+            return f"The instrument is locked by client {self.lock_owner}."
+        return None
+
+    #Runs the queued commands one after the other
+    async def _run_queue(self):
+        while True:
+            while not self._queue:
+                self._queue_ready.clear()
+                await self._queue_ready.wait()
+            request = self._queue.popleft()
+            error = self._motion_refused(request.client)
+            if error:
+                # The lock changed hands while the command was waiting
+                await request.client.reply(request.id, error=error)
+                continue
+            await self._execute(request)
+
+    async def _execute(self, request):
+        self.running = request
+        self.broadcast("server", {"event": "command", "client": request.client.number, "id": request.id,
+                                  "cmd": request.command, "state": "started"})
+        args = dict(request.args)
+        if request.command == "sweep":
+            args["on_point"] = lambda index, wavelength: self.broadcast("scan", {
+                "event": "point", "client": request.client.number, "id": request.id,
+                "index": index, "wavelength": wavelength})
+            args["on_progress"] = lambda done, total, elapsed, eta: self.broadcast("scan", {
+                "event": "progress", "client": request.client.number, "id": request.id,
+                "done": done, "total": total, "elapsed": elapsed, "eta": eta})
+        error = None
+        result = None
+        try:
+            result = await getattr(self.unit, request.command)(**args)
+        except Exception as e:
+            # Whatever a request does wrong fails that request only; the worker goes on
+            error = str(e) if isinstance(e, MonochromatorError) else f"{type(e).__name__}: {e}"
+        finally:
+            self.running = None
+            self.commands_run += 1
+        self.broadcast("server", {"event": "command", "client": request.client.number, "id": request.id,
+                                  "cmd": request.command, "state": "failed" if error else "done"})
+        await request.client.reply(request.id, result, error)
+
+    def _set_lock(self, number):
+        self.lock_owner = number
+        self.broadcast("server", {"event": "lock", "client": number})
+
+    def _cmd_ping(self, client):
+        return "pong"
+
+    def _cmd_state(self, client):
+        unit = self.unit
+        return {
+            "port": self.port_name,
+            "connected": unit.ser is not None,
+            "initialized": unit.arduino_initialized,
+            "homed": unit.motor_homed,
+            "grating_mode": unit.grating_mode,
+            "current_steps": unit.current_steps,
+            "motion_profile": unit.motion_profile.name,
+            "homing_duration": unit.homing_duration,
+            "protocol": unit.protocol.name,
+            "running": self.running.command if self.running else None,
+            "queued": len(self._queue),
+            "lock": self.lock_owner,
+            "clients": len(self.clients),
+            "client": client.number,
+            "dropped": client.dropped,
+            "commands_run": self.commands_run,
+        }
+
+    #The last lines status messages
+    def _cmd_status(self, client, lines=50):
+        return list(self.status_lines)[-lines:] if lines > 0 else []
+
+    def _cmd_move_times(self, client):
+        return self.unit.move_times.summary()
+
+    #topics: list of TOPICS (default all). read_only gives up motion commands, stop
+    # and the lock for the rest of the connection.
+    def _cmd_subscribe(self, client, topics=None, read_only=False):
+        topics = TOPICS if topics is None else topics
+        unknown = [topic for topic in topics if topic not in TOPICS]
+        if unknown:
+            raise MonochromatorError(f"Unknown topics {unknown}, expected some of {list(TOPICS)}.")
+        client.topics.update(topics)
+        if read_only:
+            client.read_only = True
+            if self.lock_owner == client.number:
+                self._set_lock(None)
+        return sorted(client.topics)
+
+    def _cmd_unsubscribe(self, client, topics=None):
+        client.topics.difference_update(TOPICS if topics is None else topics)
+        return sorted(client.topics)
+
+    def _cmd_lock(self, client):
+        if client.read_only:
+            raise MonochromatorError("This client is read only.")
+        if self.lock_owner not in (None, client.number):
+            raise MonochromatorError(f"The instrument is locked by client {self.lock_owner}.")
+        if self.lock_owner is None:
+            self._set_lock(client.number)
+        return client.number
+
+    def _cmd_unlock(self, client):
+        if self.lock_owner != client.number:
+            raise MonochromatorError("This client does not hold the lock.")
+        self._set_lock(None)
+
+    #Emergency stop: goes out at once, cancels the queued commands and ends the running one
+    async def _cmd_stop(self, client):
+        if client.read_only:
+            raise MonochromatorError("This client is read only.")
+        cancelled, self._queue = self._queue, deque()
+        for request in cancelled:
+            await request.client.reply(request.id, error=f"Cancelled by an emergency stop from client {client.number}.")
+        await self.unit.stop()
+        return len(cancelled)
+
+
+#Raises MonochromatorError unless args are arguments func takes, of the types in
+# ARGUMENT_TYPES, with none of the required ones missing
+def _check_arguments(command, func, args):
+    parameters = {name: parameter for name, parameter in inspect.signature(func).parameters.items()
+                  if name in ARGUMENT_TYPES}
+    for name, value in args.items():
+        if name not in parameters and not parameters:
+            raise MonochromatorError(f"{command} takes no arguments.")
+        if name not in parameters:
+            raise MonochromatorError(f"{command} takes no argument {name!r}, expected some of {list(parameters)}.")
+        if value is None and parameters[name].default is None:
+            continue
+        expected = ARGUMENT_TYPES[name]
+        if not isinstance(value, expected) or isinstance(value, bool) and expected is not bool:
+            raise MonochromatorError(f"{command}: {name} must be {TYPE_NAMES[expected]}, not {json.dumps(value)}.")
+    missing = [name for name, parameter in parameters.items()
+               if parameter.default is inspect.Parameter.empty and name not in args]
+    if missing:
+        raise MonochromatorError(f"{command} needs {', '.join(missing)}.")
+
+
+#"host:port" or ":port" to (host, port)
+def parse_tcp_address(text):
+    host, _, port = text.rpartition(":")
+    return host or DEFAULT_HOST, int(port)
+
+
+async def serve(port, baud_rate=9600, binary_baud_rate=None, home=False, host=DEFAULT_HOST, tcp_port=DEFAULT_PORT,
+                unix_path=None, verbose=False):
+    log = lambda message: print(f"{time.strftime('%H:%M:%S')} {message}", flush=True)
+    unit = AsyncMonochromatorControl(on_status=log if verbose else None)  # Until the server takes over
+    await unit.connect(port, baud_rate)
+    try:
+        if not await unit.identify():
+            log(f"No monochromator answered on {port}.")
+            return 1
+        if binary_baud_rate and not await unit.use_binary_protocol(binary_baud_rate):
+            log("The firmware does not support the binary protocol, staying with text.")
+        if home and unit.motor_homed:
+            log("The motor is still homed, not homing again.")
+        elif home:
+            log(f"Homed in {await unit.home():.1f} s.")
+        server = MonochromatorServer(unit, port, on_status=log if verbose else None)
+        await server.start(host, tcp_port, unix_path)
+        log(f"Serving {port} on {', '.join(map(str, server.addresses()))}.")
+
+        stopped = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(signum, stopped.set)
+            except (NotImplementedError, RuntimeError):
+                # No add_signal_handler (Windows): Ctrl+C ends up as KeyboardInterrupt
+                pass
+        try:
+            await stopped.wait()
+        finally:
+            log("Shutting down.")
+            if server.running:
+                await unit.stop()
+            await server.close()
+        return 0
+    finally:
+        await unit.disconnect()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Share one monochromator with local clients over TCP or a Unix socket.")
+    parser.add_argument("port", help="serial port, or EMULATOR for the emulator")
+    parser.add_argument("--baud-rate", type=int, default=9600)
+    parser.add_argument("--binary-baud-rate", type=int, help="switch to the binary protocol at this baud rate")
+    parser.add_argument("--home", action="store_true", help="home the motor before serving")
+    parser.add_argument("--tcp", default=f"{DEFAULT_HOST}:{DEFAULT_PORT}",
+                        help="host:port to listen on, 'off' for none (default %(default)s)")
+    parser.add_argument("--unix", help="also listen on this Unix socket path")
+    parser.add_argument("--verbose", action="store_true", help="print every line from the firmware")
+    args = parser.parse_args(argv)
+
+    host, tcp_port = (None, None) if args.tcp == "off" else parse_tcp_address(args.tcp)
+    if tcp_port is None and not args.unix:
+        parser.error("nothing to listen on, give --tcp or --unix")
+    try:
+        return asyncio.run(serve(args.port, args.baud_rate, args.binary_baud_rate, args.home, host, tcp_port,
+                                 args.unix, args.verbose))
+    except (OSError, MonochromatorError) as e:
+        print(f"Could not serve {args.port}: {e}", file=sys.stderr)
+        return 1
+    except KeyboardInterrupt:
+        return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
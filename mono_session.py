@@ -0,0 +1,553 @@
+import time
+
+from instrumentation import Instrumentation, NULL_SPAN
+from mono_model import (GRATING_MODES, HOMING_TIMEOUT, HOMING_FAST_SPEED, HOMING_SLOW_SPEED, HOMING_ACCELERATION,
+                        homing_time, is_valid_wavelength, sweep_wavelengths, wavelength_to_steps)
+from mono_protocol import BinaryProtocol, TextProtocol
+from motion_profile import DEFAULT_PROFILE, MOTION_PROFILES, MotionProfile, MoveTimeLog, profiles_for_moves
+from move_planner import plan_moves
+from state_cache import StateCache
+from serial_reader import (INITIALIZED, HOMED, MODE_SELECTED, INVALID_MODE, MOVING, TARGET_REACHED, READY,
+                           INVALID_WAVELENGTH, EMERGENCY_STOP, STREAMING, POSITION_REACHED, INVALID_POSITION, STATE, HOMING_FAILED,
+                           HOMING_PROFILE, MOTION_PROFILE, BINARY_MODE, PONG)
+
+HOMING_REPLY_MARGIN = 5  # s on top of the firmware's homing timeout before giving up on a reply
+# Replies to a move command, up to the target reached report
+MOVE_REPLIES = (MOVING, TARGET_REACHED, POSITION_REACHED, INVALID_WAVELENGTH, INVALID_POSITION, EMERGENCY_STOP)
+
+
+class MonochromatorError(Exception):
+    pass
+
+
+#A command the firmware rejected; its reply is already in the status log
+class FirmwareError(MonochromatorError):
+    pass
+
+
+#What a command generator asks its driver to do. The driver sends the result back
+# into the generator.
+
+#Handle firmware events until one of kinds arrives that answers (see
+# SerialReader.wait_for). Result: that event, None after timeout seconds. The driver
+# raises MonochromatorError when the connection is lost.
+class WaitFor:
+    def __init__(self, kinds, timeout=None, answers=None):
+        self.kinds = (kinds,) if isinstance(kinds, str) else kinds
+        self.timeout = timeout
+        self.answers = answers
+
+
+#Sleep for seconds, or until a stop is requested
+class Pause:
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+
+#Call a user callback; the asyncio driver also awaits it when it returns an awaitable.
+# Result: its return value.
+class Callback:
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+
+#The protocol state machine shared by MonochromatorCore (blocking, on a worker
+# thread) and AsyncMonochromatorControl (asyncio): it builds the commands, matches the
+# replies, plans sweeps and keeps the motor, grating, profile and calibration state,
+# the state cache and the instrumentation. Every command is a generator that writes
+# through _send and yields WaitFor, Pause and Callback to its driver, so the two
+# controllers only differ in how they wait. Errors are raised as MonochromatorError.
+# A driver provides _run(command), _write_port(data), _expect_binary(decode),
+# _stop_requested() and _clear_stop().
+class MonochromatorSession:
+    def __init__(self, on_status=None, on_event=None, on_sample=None, state_cache_path=None):
+        self.ser = None
+        self.port = None
+        self.protocol = TextProtocol()  # Encodes commands; use_binary_protocol switches to frames
+        self.on_status = on_status  # Called with every status message
+        self.on_event = on_event  # Called with every FirmwareEvent from the Arduino
+        self.on_sample = on_sample  # Called with every streamed SAMPLE event
+
+        self.arduino_initialized = False  # Flag to track Arduino initialization
+        self.motor_homed = False #Flag to track the initial homing of the motor
+        self.grating_selected = False #Flag to track if grating mode is selected
+        self.grating_mode = None  # Name of the selected grating mode
+        self.current_steps = None  # Step position of the last reached target, None if unknown
+        self.state_cache = StateCache(state_cache_path) if state_cache_path else None
+        self.homing = False  # A homing is running; an emergency stop may abort it
+        self.homing_duration = None  # Seconds the last successful homing took
+        self.homing_timeout = HOMING_TIMEOUT  # Firmware homing timeout, see set_homing_profile
+        self.homing_speeds = (HOMING_FAST_SPEED, HOMING_SLOW_SPEED, HOMING_ACCELERATION)  # Likewise
+        self.motion_profiles = dict(MOTION_PROFILES)  # name -> MotionProfile, add measured ones here
+        self.motion_profile = DEFAULT_PROFILE  # Profile the firmware is moving with
+        self.move_times = MoveTimeLog()  # Predicted against measured move times
+        self.calibration = None  # calibration.Calibration; when set, moves are sent as absolute step targets
+        self.stop_latencies = []  # Seconds from writing stop to the firmware's acknowledgement
+        # Per-command timings; call instrumentation.enable() to start collecting
+        self.instrumentation = Instrumentation()
+        self._span = NULL_SPAN  # Span of the command being run
+        self._move_timing = None  # (write time, profile name, distance, predicted) of the running move
+        self._move_target = None  # Step position the running move was commanded to
+        self._stop_sent_at = None
+
+    def _require(self, connected=False, initialized=False, homed=False, grating=False):
+        if connected and not self.ser:
+            raise MonochromatorError("COM port is not selected.")
+        if initialized and not self.arduino_initialized:
+            raise MonochromatorError("The Arduino is off, please press START.")
+        if homed and not self.motor_homed:
+            raise MonochromatorError("Please home the motor first to start operation.")
+        if grating and not self.grating_selected:
+            raise MonochromatorError("Please select prefered grating ro work with and then move to desired wavelength.")
+
+    #Wait up to timeout seconds for the startup banner (it may already have arrived)
+    # and take over what the firmware still knows
+    def _initialize(self, timeout):
+        self._require(connected=True)
+        yield WaitFor(INITIALIZED, timeout)
+        self.arduino_initialized = True
+        return (yield from self._restore_state())
+
+    #Find out whether a monochromator is on the port: either its startup banner
+    # arrives (the Arduino was reset, by power-up or by DTR on boards that reset when
+    # the port is opened) or it answers a harmless "stream off". Marks it initialized
+    # when it is one and takes over what the firmware still knows.
+    def _identify(self, timeout):
+        self._require(connected=True)
+        if (yield WaitFor(INITIALIZED, timeout)) is None:
+            answers = self._send(self.protocol.stream(0, 0))
+            if (yield WaitFor(STREAMING, timeout, answers)) is None:
+                return False
+        self.arduino_initialized = True
+        yield from self._restore_state()
+        return True
+
+    #Ask the firmware what it still knows (homed, grating mode, position), so that after
+    # a reconnect without a reset of the Arduino the motor does not have to be homed
+    # again. Firmware without the state command does not answer and nothing changes.
+    # Returns whether the state was taken over.
+    def _restore_state(self):
+        answers = self._send(self.protocol.state())
+        event = yield WaitFor(STATE, 1, answers)
+        cached = self.state_cache.get(self.port) if self.state_cache else None
+        if event is None or not event.value or not event.value["homed"]:
+            if cached and cached.get("homed"):
+                self._add_status("The Arduino has been reset since the last session, please home the motor again.")
+            self.motion_profile = DEFAULT_PROFILE  # The Arduino was reset
+            return False
+        state = event.value
+        self.motor_homed = True
+        self.current_steps = state["position"]
+        if state["mode"] is not None:
+            self.grating_selected = True
+            self.grating_mode = GRATING_MODES[state["mode"]]
+        if cached and cached.get("current_steps") not in (None, state["position"]):
+            self._add_status(f"The motor is at {state['position']} steps, the last session left it at "
+                             f"{cached['current_steps']} steps.")
+        self._add_status(f"The motor is still homed, at {state['position']} steps"
+                         + (f" with the {self.grating_mode}" if self.grating_selected else "")
+                         + ". Homing is not needed.")
+        self._save_state()
+        yield from self._read_profiles()
+        return True
+
+    #Take over the motion and homing profiles the firmware is still using, which an
+    # earlier session may have changed. Settings of 0 only report the current ones.
+    def _read_profiles(self):
+        answers = self._send(self.protocol.motion_profile(0, 0))
+        event = yield WaitFor(MOTION_PROFILE, 1, answers)
+        if event is not None and event.value:
+            speed, acceleration = event.value["speed"], event.value["acceleration"]
+            known = [profile for profile in self.motion_profiles.values()
+                     if (profile.max_speed, profile.acceleration) == (speed, acceleration)]
+            self.motion_profile = known[0] if known else MotionProfile("firmware", speed, acceleration)
+        answers = self._send(self.protocol.homing_profile(0, 0, 0, 0))
+        event = yield WaitFor(HOMING_PROFILE, 1, answers)
+        if event is not None and event.value:
+            self._use_homing_profile(event.value)
+
+    def _save_state(self):
+        if self.state_cache and self.port:
+            self.state_cache.update(self.port, homed=self.motor_homed, grating_mode=self.grating_mode,
+                                    current_steps=self.current_steps)
+
+    #Returns the homing duration in seconds. A failure reported by the firmware
+    # (timeout, stop, sensor not found) leaves the motor not homed.
+    def _home(self):
+        self._require(connected=True, initialized=True)
+        self._span = self.instrumentation.start("home")
+        self.homing = True
+        started = time.monotonic()
+        # The coarse search starts from the last known position; without one its length is unknown
+        expected = None if self.current_steps is None else homing_time(self.current_steps, *self.homing_speeds)
+        # Log every line, progress reports included, until the firmware reports the outcome
+        try:
+            answers = self._send(self.protocol.home())
+            event = yield WaitFor((HOMED, HOMING_FAILED), self.homing_timeout + HOMING_REPLY_MARGIN, answers)
+        finally:
+            self.homing = False
+        self._finish_span(event is not None and event.kind == HOMED)
+        if event is None:
+            raise MonochromatorError("The Arduino did not report the end of the homing.")
+        if event.kind == HOMING_FAILED:
+            self.motor_homed = False
+            self._save_state()
+            raise MonochromatorError(f"Homing failed ({event.value}), please home the motor again before operating it.")
+        self.motor_homed = True
+        self.homing_duration = event.timestamp - started
+        if expected is None:
+            self._add_status(f"Homed in {self.homing_duration:.1f} s.")
+        else:
+            self._add_status(f"Homed in {self.homing_duration:.1f} s, {expected:.1f} s expected.")
+        self._save_state()
+        return self.homing_duration
+
+    #Speeds of the two homing phases in steps/s, acceleration in steps/s^2 and the
+    # timeout after which the firmware gives up, in seconds. None keeps a setting.
+    # Returns the profile the firmware now uses.
+    def _set_homing_profile(self, fast_speed=None, slow_speed=None, acceleration=None, timeout=None):
+        self._require(connected=True, initialized=True)
+        answers = self._send(self.protocol.homing_profile(fast_speed or 0, slow_speed or 0, acceleration or 0,
+                                                          timeout or 0))
+        event = yield WaitFor(HOMING_PROFILE, 2, answers)
+        if event is None:
+            raise MonochromatorError("The Arduino did not confirm the homing profile; its firmware may not support it.")
+        if event.value:
+            self._use_homing_profile(event.value)
+        return event.value
+
+    def _use_homing_profile(self, settings):
+        self.homing_speeds = (settings["fast"], settings["slow"], settings["acceleration"])
+        self.homing_timeout = settings["timeout"]
+
+    def _select_grating(self, mode):
+        self._require(connected=True, initialized=True, homed=True)
+        if mode not in GRATING_MODES:
+            raise MonochromatorError(f"Invalid grating mode {mode!r}, expected one of {GRATING_MODES}.")
+        # The mode selection command and the mode go out in one write so nothing (such
+        # as an emergency stop) can end up between them
+        self._span = self.instrumentation.start("select_mode")
+        answers = self._send(self.protocol.select_mode(GRATING_MODES.index(mode)))
+        event = yield WaitFor((MODE_SELECTED, INVALID_MODE), 5, answers)
+        self._finish_span(event is not None and event.kind == MODE_SELECTED)
+        if event is None or event.kind != MODE_SELECTED:
+            raise MonochromatorError("The Arduino did not confirm the grating mode.")
+        self.grating_selected = True
+        self.grating_mode = mode
+        self._save_state()
+        return True
+
+    #profile (a MotionProfile or the name of one in motion_profiles) switches the
+    # firmware to that profile for this and the following moves. Returns True when the
+    # target was reached, False after an emergency stop.
+    def _set_wavelength(self, wavelength, profile=None):
+        self._require(connected=True, initialized=True, homed=True, grating=True)
+        try:
+            commands, targets = self._move_commands([wavelength])
+        except (TypeError, ValueError) as e:
+            raise MonochromatorError(str(e) if self.calibration else f"Invalid wavelength {wavelength!r}.")
+        if targets[0] is not None and targets[0] == self.current_steps:
+            self._add_status(f"Already at {wavelength} nm, no move needed.")
+            return True
+        return (yield from self._move(commands[0], targets[0], profile, "set_wavelength"))
+
+    #Move to an absolute step position, bypassing the wavelength fits
+    def _move_to_steps(self, steps, profile=None):
+        self._require(connected=True, initialized=True, homed=True)
+        try:
+            steps = int(steps)
+        except (TypeError, ValueError):
+            raise MonochromatorError(f"Invalid step position {steps!r}.")
+        if steps == self.current_steps:
+            self._add_status(f"Already at {steps} steps, no move needed.")
+            return True
+        return (yield from self._move(self.protocol.steps(steps), steps, profile, "move_to_steps"))
+
+    def _move(self, command, target, profile, span_name):
+        profile = self._motion_profile(profile)
+        self._span = self.instrumentation.start(span_name)
+        self._use_profile(profile)
+        self._start_move_timing(target, self.current_steps)
+        answers = self._send(command, MOVE_REPLIES + (READY,))
+        event = yield WaitFor((TARGET_REACHED, POSITION_REACHED, INVALID_WAVELENGTH, INVALID_POSITION, EMERGENCY_STOP),
+                              None, answers)
+        if event.kind in (INVALID_WAVELENGTH, INVALID_POSITION):
+            self._finish_span(False)
+            raise FirmwareError(event.line)
+        # Both a reached target and an emergency stop are followed by the ready prompt
+        yield WaitFor(READY, 2, answers)
+        self._finish_span(event.kind != EMERGENCY_STOP)
+        self._save_state()
+        return event.kind != EMERGENCY_STOP
+
+    #Make profile (a MotionProfile or the name of one in motion_profiles) the one the
+    # firmware moves with and wait for its confirmation
+    def _set_motion_profile(self, profile):
+        self._require(connected=True, initialized=True)
+        profile = self._motion_profile(profile)
+        answers = self._send(self.protocol.motion_profile(profile.max_speed, profile.acceleration))
+        if (yield WaitFor(MOTION_PROFILE, 2, answers)) is None:
+            raise MonochromatorError("The Arduino did not confirm the motion profile; its firmware may not support it.")
+        self.motion_profile = profile
+        self._add_status(f"Moving with the {profile.name} profile.")
+
+    def _motion_profile(self, profile):
+        if profile is None:
+            return self.motion_profile
+        if isinstance(profile, str):
+            if profile not in self.motion_profiles:
+                raise MonochromatorError(f"Unknown motion profile {profile!r}, "
+                                         f"expected one of {list(self.motion_profiles)}.")
+            return self.motion_profiles[profile]
+        if not isinstance(profile, MotionProfile):
+            raise MonochromatorError(f"A motion profile is a MotionProfile or one of {list(self.motion_profiles)}, "
+                                     f"not {profile!r}.")
+        return profile
+
+    #Switch the firmware to profile ahead of the next move command, without waiting for
+    # the reply; the confirmation is logged while the move is being waited for. The
+    # write is not timed as part of the move.
+    def _use_profile(self, profile):
+        if not profile.same_motion(self.motion_profile):
+            self._write_port(self.protocol.motion_profile(profile.max_speed, profile.acceleration))
+        self.motion_profile = profile
+
+    #Remember the target of the move just sent, when it was sent and how long it should
+    # take, to compare with the target reached report (see _handle_event)
+    def _start_move_timing(self, target, position):
+        self._move_target = target
+        if target is None or position is None:
+            self._move_timing = None
+            return
+        distance = abs(target - position)
+        predicted = self.motion_profile.move_time(distance)
+        self._move_timing = (time.monotonic(), self.motion_profile.name, distance, predicted)
+        self._span.moving(predicted, (TARGET_REACHED, POSITION_REACHED))
+
+    #Commands moving to each of the wavelengths and the step positions they end at:
+    # absolute step targets converted in one call when a calibration is loaded,
+    # otherwise wavelength_selected. Targets the firmware will reject are None. Raises
+    # ValueError for wavelengths that cannot be converted.
+    def _move_commands(self, wavelengths):
+        if self.calibration:
+            steps = self.calibration.wavelengths_to_steps([float(wavelength) for wavelength in wavelengths],
+                                                          self.grating_mode)
+            return [self.protocol.steps(target) for target in steps], [int(target) for target in steps]
+        return ([self.protocol.wavelength(wavelength) for wavelength in wavelengths],
+                [self._firmware_steps(wavelength) for wavelength in wavelengths])
+
+    #Position moveToWavelength() will drive to, None if it will reject the wavelength
+    def _firmware_steps(self, wavelength):
+        try:
+            return wavelength_to_steps(float(wavelength), self.grating_mode)
+        except (TypeError, ValueError):
+            return None
+
+    #Move through a list of wavelengths, either given explicitly or as a start/stop/step
+    # range. The next command is written as soon as the firmware reports the current
+    # target reached (after the optional dwell and on_point(index, wavelength) callback),
+    # without waiting for the "new wavelength" prompt. on_progress(done, total, elapsed,
+    # eta) is called after every point. With optimize_order the points are visited in
+    # the order move_planner.plan_moves finds fastest, optionally always approaching
+    # from one direction. Moves use profile (default: the current one) or, with
+    # max_settle, each the profile from motion_profiles that gives a reading soonest
+    # while settling within max_settle seconds; every point waits out its profile's
+    # settle_time before on_point. Returns the wavelengths that were reached, in
+    # visiting order.
+    def _sweep(self, start=None, stop=None, step=None, wavelengths=None, dwell=0.0, on_point=None, on_progress=None,
+               optimize_order=False, approach=None, profile=None, max_settle=None):
+        self._require(connected=True, initialized=True, homed=True, grating=True)
+        if wavelengths is None:
+            try:
+                wavelengths = sweep_wavelengths(start, stop, step)
+            except (TypeError, ValueError):
+                raise MonochromatorError("Please enter a valid scan start, stop and step.")
+        try:
+            wavelengths = [float(wavelength) for wavelength in wavelengths]
+        except (TypeError, ValueError):
+            raise MonochromatorError(f"The scan wavelengths must be a list of numbers, not {wavelengths!r}.")
+        if not wavelengths:
+            raise MonochromatorError("The scan has no points.")
+        # The firmware rejects these one by one, so refuse the whole scan up front
+        invalid = [wavelength for wavelength in wavelengths if not is_valid_wavelength(wavelength, self.grating_mode)]
+        if invalid:
+            raise MonochromatorError(f"Scan contains wavelengths outside the {self.grating_mode} range: {invalid[:5]}")
+        profile = self._motion_profile(profile)
+
+        # (wavelength, index in the request) pairs; approach moves have no index
+        if optimize_order or approach:
+            try:
+                plan = plan_moves(wavelengths, self.grating_mode, self.current_steps or 0, approach=approach,
+                                  max_speed=profile.max_speed, acceleration=profile.acceleration,
+                                  calibration=self.calibration)
+            except ValueError as e:
+                raise MonochromatorError(str(e))
+            self._add_status(f"Planned scan: {plan.summary()}.")
+            moves = [(move.wavelength, move.index) for move in plan.moves]
+            # The planned step targets are sent as they are when calibrated, so the
+            # approach move ends exactly where it was planned
+            targets = [move.steps for move in plan.moves]
+            commands = ([self.protocol.steps(target) for target in targets] if self.calibration else
+                        [self.protocol.wavelength(wavelength) for wavelength, _ in moves])
+        else:
+            moves = [(wavelength, index) for index, wavelength in enumerate(wavelengths)]
+            commands, targets = self._move_commands(wavelengths)
+        if max_settle is None:
+            profiles = [profile] * len(moves)
+        else:
+            try:
+                profiles = profiles_for_moves(targets, self.current_steps or 0, self.motion_profiles.values(),
+                                              max_settle)
+            except ValueError as e:
+                raise MonochromatorError(str(e))
+
+        self._clear_stop()
+        reached = []
+        started = time.monotonic()
+        event = None  # Reply to the last command actually sent
+        sent = None  # Reply predicate of that command
+        # Points at the position the motor is already at (the current one for the first
+        # point, repeated points later on) are taken as reached without a command
+        answers = self._start_sweep_move(commands[0], targets[0], self.current_steps, profiles[0])
+        for position, (wavelength, index) in enumerate(moves):
+            if answers:
+                sent = answers
+                event = yield WaitFor((TARGET_REACHED, POSITION_REACHED, INVALID_WAVELENGTH, INVALID_POSITION,
+                                       EMERGENCY_STOP), None, answers)
+                self._finish_span(event.kind in (TARGET_REACHED, POSITION_REACHED))
+                if event.kind not in (TARGET_REACHED, POSITION_REACHED):
+                    break
+                if index is not None and profiles[position].settle_time:
+                    yield Pause(profiles[position].settle_time)
+            if index is not None:
+                reached.append(wavelength)
+                if on_point:
+                    yield Callback(on_point, index, wavelength)
+                if dwell:
+                    yield Pause(dwell)
+            if self._stop_requested():
+                break
+            # The firmware is back in loop() once it has reported the target, so the
+            # next command can go out while the ready prompt is still on the wire
+            if position + 1 < len(moves):
+                answers = self._start_sweep_move(commands[position + 1], targets[position + 1], targets[position],
+                                                 profiles[position + 1])
+            if index is not None and on_progress:
+                elapsed = time.monotonic() - started
+                done = len(reached)
+                yield Callback(on_progress, done, len(wavelengths), elapsed, elapsed / done * (len(wavelengths) - done))
+
+        # Both a reached target and an emergency stop are followed by the ready prompt
+        if event is not None and event.kind not in (INVALID_WAVELENGTH, INVALID_POSITION):
+            yield WaitFor(READY, 2, sent)
+        if len(reached) < len(wavelengths):
+            self._add_status(f"Scan stopped after {len(reached)} of {len(wavelengths)} points.")
+        else:
+            self._add_status(f"Scan finished: {len(reached)} points in {time.monotonic() - started:.1f} s.")
+        self._save_state()
+        return reached
+
+    #Send one sweep move unless the motor is already at its target. Returns the
+    # protocol's predicate for its replies, None when no command went out.
+    def _start_sweep_move(self, command, target, position, profile):
+        if target is not None and target == position:
+            return None
+        self._use_profile(profile)
+        # One "sweep_point" span per move, from its command to its target being reached
+        self._span = self.instrumentation.start("sweep_point")
+        self._start_move_timing(target, position)
+        # The ready prompt of the previous point may still arrive, it is not a reply
+        return self._send(command, MOVE_REPLIES)
+
+    #Have the firmware send a photodiode sample every interval_ms during moves;
+    # channel 1 is S1 (A0), 2 is S2 (A5), 0 switches streaming off
+    def _stream(self, channel, interval_ms):
+        self._require(connected=True)
+        answers = self._send(self.protocol.stream(channel, interval_ms))
+        if (yield WaitFor(STREAMING, 2, answers)) is None:
+            raise MonochromatorError("The Arduino did not confirm the streaming setting.")
+
+    #Switch the link to the framed binary protocol at baud_rate. Returns False, and
+    # keeps the text protocol, when the firmware does not know the binary command.
+    def _use_binary_protocol(self, baud_rate, timeout=2.0):
+        self._require(connected=True)
+        protocol = BinaryProtocol()
+        self._expect_binary(protocol.decode)
+        self._send(f'binary {baud_rate}\n'.encode())
+        if (yield WaitFor(BINARY_MODE, timeout)) is None:
+            self._expect_binary(None)
+            return False
+        yield Pause(0.01)  # The Arduino restarts its UART after flushing the reply
+        self.ser.baudrate = baud_rate
+        ping = protocol.ping()
+        self._write_port(ping)
+        if (yield WaitFor(PONG, timeout, protocol.answers(ping))) is None:
+            # The firmware only goes back to text on a reset, so the link is unusable
+            # either way; drop it rather than leave it half switched
+            yield Callback(self.disconnect)
+            raise MonochromatorError(f"The Arduino switched to {baud_rate} baud but does not answer; "
+                                     "reconnect to reset it.")
+        self.protocol = protocol
+        self._add_status(f"Using the binary protocol at {baud_rate} baud.")
+        return True
+
+    #Write data now, timing it for the running command's span; replies, if given, are
+    # the event kinds the span counts as replies to it. Returns the protocol's
+    # predicate for its replies, for WaitFor.
+    def _send(self, data, replies=None):
+        answers = self.protocol.answers(data)
+        if self._span.active:
+            started = time.monotonic()
+            self._write_port(data)
+            self._span.wrote(started, time.monotonic(), answers if replies is None else
+                             lambda event: event.kind in replies and answers(event))
+        else:
+            self._write_port(data)
+        return answers
+
+    #Put a stop on the wire right away, also while a command is running; it stays out
+    # of that command's span. The acknowledgement ends the running move.
+    def _send_stop(self):
+        self._stop_sent_at = time.monotonic()
+        self._write_port(self.protocol.stop())
+
+    def _finish_span(self, ok):
+        span, self._span = self._span, NULL_SPAN
+        span.finish(ok)
+
+    def _add_status(self, message):
+        if self.on_status:
+            self.on_status(message)
+
+    #Log a firmware event and keep track of where the motor is
+    def _handle_event(self, event):
+        self._span.event(event)
+        if self.on_event:
+            self.on_event(event)
+        if event.kind == HOMED:
+            self.current_steps = 0
+        elif event.kind == TARGET_REACHED:
+            # The commanded target: the reported wavelength is rounded and converting it
+            # back can fall outside the grating's range
+            self.current_steps = self._move_target
+        elif event.kind == POSITION_REACHED:
+            self.current_steps = event.value
+        elif event.kind == EMERGENCY_STOP:
+            self.current_steps = None
+        if event.kind in (TARGET_REACHED, POSITION_REACHED) and self._move_timing:
+            started, profile, distance, predicted = self._move_timing
+            self.move_times.add(profile, distance, predicted, event.timestamp - started)
+            self._move_timing = None
+        elif event.kind in (EMERGENCY_STOP, INVALID_WAVELENGTH, INVALID_POSITION):
+            self._move_timing = None
+        if event.kind in (TARGET_REACHED, POSITION_REACHED, EMERGENCY_STOP, INVALID_WAVELENGTH, INVALID_POSITION):
+            self._move_target = None
+        self._add_status(event.line)
+        if event.kind == EMERGENCY_STOP and self._stop_sent_at is not None:
+            latency = event.timestamp - self._stop_sent_at
+            self._stop_sent_at = None
+            self.stop_latencies.append(latency)
+            self.instrumentation.record({"command": "emergency_stop", "time": time.time(), "ok": True,
+                                         "first_reply": latency, "total": latency})
+            self._add_status(f"Emergency stop acknowledged after {latency * 1000:.0f} ms.")
@@ -20,6 +20,97 @@ AccelStepper myStepper(motorInterfaceType, stepPin, dirPin);
 
 bool emergencyStop = false; // Variable to track emergency stop state
 int gratingMode = 0; // 0: VIS, 1: IR, 2: Both with switch at 650 nm
+bool motorHomed = false; // Reported by the state command so the host can skip homing
+
+// Speed profile of wavelength and step moves, changed with
+// motion_profile <max speed steps/s> <acceleration steps/s^2>
+float moveMaxSpeed = 500;
+float moveAcceleration = 50;
+const long MAX_PROFILE_SPEED = 4000; // About the most AccelStepper manages on an Uno
+const long MAX_PROFILE_ACCELERATION = 20000;
+
+// Homing: a coarse search at homingFastSpeed until S2 blocks, a short back-off out of
+// the sensor and a fine approach at homingSlowSpeed that sets the home position.
+// Changed with homing_profile <fast steps/s> <slow steps/s> <acceleration> <timeout s>
+float homingFastSpeed = 500;
+float homingSlowSpeed = 50;
+float homingAcceleration = 200;
+unsigned long homingTimeout = 60000; // ms
+const int HOMING_THRESHOLD = 300; // S2 reads at least this much when blocked
+const long HOMING_BACKOFF = 30; // Steps moved out of the sensor before the fine approach
+const long HOMING_MAX_TRAVEL = 20000; // The coarse search gives up after this many steps
+const unsigned long HOMING_PROGRESS_INTERVAL = 250; // ms between progress reports
+unsigned long lastHomingProgress = 0;
+byte homingFault = 0;
+const byte HOMING_PHASE_COARSE = 1;
+const byte HOMING_PHASE_FINE = 2;
+const byte HOMING_TIMEOUT = 1; // Fault reasons
+const byte HOMING_STOPPED = 2;
+const byte HOMING_NO_SENSOR = 3;
+bool gratingSelected = false;
+
+int streamChannel = 0; // Photodiode streamed during moves: 0: off, 1: S1, 2: S2
+unsigned long streamInterval = 50; // Milliseconds between streamed samples
+unsigned long lastSampleTime = 0;
+
+// Highest absolute target accepted by steps_selected; a little past 2000 nm on the IR
+// fit so a host-side calibration can correct the fits near the end of the range
+const long MAX_TARGET_STEPS = 13500;
+
+///////////////////////////////////////////////////////
+//Binary protocol
+//Switched on from the text protocol with "binary <baud>". Every frame, in both
+//directions, is: 0xA5, sequence number, opcode, payload length, payload, CRC-8
+//(polynomial 0x07) over sequence number..payload. Numbers are little endian.
+//Replies carry the sequence number of the command they answer.
+///////////////////////////////////////////////////////
+
+bool binaryMode = false;
+
+const byte FRAME_START = 0xA5;
+const byte MAX_PAYLOAD = 16;
+
+// Commands (host to Arduino)
+const byte OP_PING = 0x01;
+const byte OP_HOME = 0x02;
+const byte OP_MODE = 0x03;        // payload: mode (byte)
+const byte OP_WAVELENGTH = 0x04;  // payload: wavelength in 1/100 nm (int32)
+const byte OP_STOP = 0x05;
+const byte OP_STREAM = 0x06;      // payload: channel (byte), interval in ms (uint16)
+const byte OP_STEPS = 0x07;       // payload: absolute step position (int32)
+const byte OP_STATE = 0x08;
+const byte OP_HOMING_PROFILE = 0x09; // payload: fast, slow (steps/s), acceleration (steps/s^2), timeout (s), all uint16
+const byte OP_MOTION_PROFILE = 0x0A; // payload: max speed (steps/s), acceleration (steps/s^2), both uint16
+
+// Status codes (Arduino to host)
+const byte ST_PONG = 0x80;
+const byte ST_HOMING = 0x81;
+const byte ST_HOMED = 0x82;              // payload: photodiode S2 reading (uint16)
+const byte ST_MODE_SELECTED = 0x83;      // payload: mode (byte)
+const byte ST_INVALID_MODE = 0x84;
+const byte ST_TARGET_REACHED = 0x85;     // payload: wavelength in 1/100 nm (int32)
+const byte ST_INVALID_WAVELENGTH = 0x86;
+const byte ST_EMERGENCY_STOP = 0x87;
+const byte ST_SAMPLE = 0x88;             // payload: millis (uint32), position (int32), reading (uint16)
+const byte ST_STREAMING = 0x89;          // payload: channel (byte), interval in ms (uint16)
+const byte ST_BUSY = 0x8A;               // command received during a move and ignored
+const byte ST_BAD_FRAME = 0x8B;          // CRC mismatch
+const byte ST_UNKNOWN_COMMAND = 0x8C;
+const byte ST_POSITION_REACHED = 0x8D;   // payload: step position (int32)
+const byte ST_INVALID_POSITION = 0x8E;
+const byte ST_STATE = 0x8F;              // payload: homed (byte), mode or 255 if none (byte), position (int32)
+const byte ST_HOMING_PROGRESS = 0x90;    // payload: phase (byte), position (int32)
+const byte ST_HOMING_FAILED = 0x91;      // payload: reason (byte)
+const byte ST_HOMING_PROFILE = 0x92;     // payload: as OP_HOMING_PROFILE
+const byte ST_MOTION_PROFILE = 0x93;     // payload: as OP_MOTION_PROFILE
+
+byte frameBuffer[MAX_PAYLOAD + 5];
+byte frameLength = 0;  // Bytes of the incoming frame received so far
+byte frameSeq = 0;     // Fields of the last complete frame
+byte frameOp = 0;
+byte framePayloadLength = 0;
+byte *framePayload = frameBuffer + 4;
+byte replySeq = 0;     // Sequence number used for replies
 
 ///////////////////////////////////////////////////////
 //Setup. 
@@ -31,8 +122,8 @@ void setup() {
   Serial.begin(9600);
 
   // Stepper motor setup
-  myStepper.setMaxSpeed(500);
-  myStepper.setAcceleration(50);
+  myStepper.setMaxSpeed(moveMaxSpeed);
+  myStepper.setAcceleration(moveAcceleration);
       
   // Set pin modes
   pinMode(dirPin, OUTPUT);
@@ -56,6 +147,13 @@ void setup() {
 
 
 void loop() {
+  if (binaryMode) {
+    if (readFrame()) {
+      handleFrame();
+    }
+    return;
+  }
+
   //here we check constantly if there is some information waiting in the serial communication
   if (Serial.available() > 0) {
     String input = Serial.readStringUntil('\n'); // Read the input from Serial Monitor
@@ -71,28 +169,58 @@ void loop() {
     while (true) {
             String modeInput = Serial.readStringUntil('\n');
             modeInput.trim();
-            int modeSelection = modeInput.toInt();
-            if (modeSelection == 0 || modeSelection == 1 || modeSelection == 2) {
-                gratingMode = modeSelection;
-                Serial.print("Grating mode selected. You are now operating with the ");
-                if (gratingMode == 0) {
-                    Serial.println("VIS Grating");
-                } else if (gratingMode == 1) {
-                    Serial.println("IR Grating");
-                } else if (gratingMode == 2) {
-                    Serial.println("Switch Mode");
-                }
+            if (selectGratingMode(modeInput.toInt())) {
                 break;  // Exit the loop once a valid mode is received
-            } else {
-                Serial.println("Invalid selection. Please choose an existing operating mode:");
             }
       }
+    } else if (input.startsWith("stream")) {
+      //stream <channel> <interval_ms> switches sample streaming during moves on or off
+      int separator = input.indexOf(' ', 7);
+      unsigned long interval = 0;
+      if (separator > 0) {
+        interval = input.substring(separator + 1).toInt();
+      }
+      setStreaming(input.substring(7).toInt(), interval);
+    } else if (input.startsWith("motion_profile")) {
+      //motion_profile <max speed> <acceleration>, 0 keeps a value
+      int separator = input.indexOf(' ', 15);
+      setMotionProfile(input.substring(15).toInt(), separator > 0 ? input.substring(separator + 1).toInt() : 0);
+    } else if (input.startsWith("homing_profile")) {
+      //homing_profile <fast> <slow> <acceleration> <timeout s>, 0 keeps a value
+      long values[4] = {0, 0, 0, 0};
+      int start = 15;
+      for (int i = 0; i < 4 && start > 0 && start < (int)input.length(); i++) {
+        values[i] = input.substring(start).toInt();
+        start = input.indexOf(' ', start) + 1;
+      }
+      setHomingProfile(values[0], values[1], values[2], values[3]);
+    } else if (input == "state") {
+      //state reports whether the motor is homed, the grating mode and the position
+      sendState();
+    } else if (input.startsWith("binary")) {
+      //binary <baud> switches to the binary protocol at the given baud rate
+      long baud = input.substring(7).toInt();
+      if (baud <= 0) {
+        baud = 9600;
+      }
+      Serial.print("Binary protocol at ");
+      Serial.print(baud);
+      Serial.println(" baud.");
+      Serial.flush();  // Let the reply go out at the old rate
+      Serial.end();
+      Serial.begin(baud);
+      binaryMode = true;
+      frameLength = 0;
     } else if (input.startsWith("wavelength_selected")) {
       //receiving of command to move to a specific wavelength along with 
       //the number of the specific wavelength
       float targetWavelength = input.substring(20).toFloat(); // Extract wavelength value
       //Serial.println("command received."); //<-- command for debugging if needed
       moveToWavelength(targetWavelength); // this is move to function, defined after the loop
+    } else if (input.startsWith("steps_selected")) {
+      //steps_selected <position> moves to an absolute step position worked out by the
+      //host from its own calibration
+      moveToSteps(input.substring(15).toInt());
     }
   }
 }
@@ -103,41 +231,255 @@ void loop() {
 ///////////////////////////////////////////////////////
 
 void homeStepperMotor() {
-    // Check if the photodiode S2 is already blocked (value > 300)
-    if (analogRead(photodiodeS2Pin) > 300) {
-        // Move forward until S2 is unblocked (value <= 300)
-        while (analogRead(photodiodeS2Pin) > 300) {
-            myStepper.move(100);
-            myStepper.run();
-        }
-        // Move a little more to ensure proper unblocking
-        myStepper.move(50);
-        while (myStepper.distanceToGo() != 0) {
-            myStepper.run();
-        }
-        // Now move backward until S2 is blocked (value < 300)
-        while (analogRead(photodiodeS2Pin) < 300 && !emergencyStop) {
-            myStepper.move(-1000000);
-            myStepper.run();
+    unsigned long started = millis();
+    lastHomingProgress = started;
+    homingFault = 0;
+    myStepper.setMaxSpeed(homingFastSpeed);
+    myStepper.setAcceleration(homingAcceleration);
+
+    // If S2 is already blocked get out of it first, then search backwards at full
+    // speed until it blocks, back off again and approach the edge slowly
+    bool homed = (!sensorBlocked() || homingSearch(1, false, HOMING_PHASE_COARSE, started))
+        && homingSearch(-1, true, HOMING_PHASE_COARSE, started)
+        && homingSearch(1, false, HOMING_PHASE_FINE, started)
+        && homingBackoff(started)
+        && homingSearch(-1, true, HOMING_PHASE_FINE, started);
+
+    // Back to the speed profile used for wavelength moves
+    myStepper.setMaxSpeed(moveMaxSpeed);
+    myStepper.setAcceleration(moveAcceleration);
+    if (!homed) {
+        motorHomed = false;
+        if (binaryMode) {
+            byte payload[1] = {homingFault};
+            sendFrame(ST_HOMING_FAILED, payload, 1);
+            return;
         }
-    } else {
-        // Move backward until S2 is blocked (value < 300)
-        while (analogRead(photodiodeS2Pin) < 300 && !emergencyStop) {
-            myStepper.move(-1000000);
-            myStepper.run();
+        Serial.print("Homing failed: ");
+        if (homingFault == HOMING_TIMEOUT) {
+            Serial.println("timeout.");
+        } else if (homingFault == HOMING_STOPPED) {
+            Serial.println("stopped.");
+        } else {
+            Serial.println("sensor not found.");
         }
+        return;
     }
-    // Print the value of photodiode S2 for debugging
-    Serial.print("Photodiode S2: "); //this value should be around 300 for proper work
-    Serial.println(analogRead(photodiodeS2Pin));
+    int photodiodeValue = analogRead(photodiodeS2Pin);
 
     // Reset the stepper position to zero (home)
     myStepper.setCurrentPosition(0);
+    motorHomed = true;
+
+    if (binaryMode) {
+        byte payload[2];
+        writeUInt16(payload, photodiodeValue);
+        sendFrame(ST_HOMED, payload, 2);
+        return;
+    }
+
+    // Print the value of photodiode S2 for debugging
+    Serial.print("Photodiode S2: "); //this value should be around 300 for proper work
+    Serial.println(photodiodeValue);
     
     Serial.println("Homed to initial position.");
     Serial.println("You can now select the grating you wish to operate with.");
 }
 
+bool sensorBlocked() {
+    return analogRead(photodiodeS2Pin) >= HOMING_THRESHOLD;
+}
+
+// Runs in direction (1 forward, -1 backward) until S2 is blocked (untilBlocked) or
+// clear. The coarse phase uses the accelerating profile, the fine phase a constant
+// homingSlowSpeed. Stops on the spot once the sensor changes, as the original search
+// did. Returns false on a fault, with the reason in homingFault.
+bool homingSearch(int direction, bool untilBlocked, byte phase, unsigned long started) {
+    if (phase == HOMING_PHASE_FINE) {
+        myStepper.setSpeed(direction * homingSlowSpeed);
+    } else {
+        myStepper.moveTo(myStepper.currentPosition() + direction * HOMING_MAX_TRAVEL);
+    }
+    while (sensorBlocked() != untilBlocked) {
+        if (phase == HOMING_PHASE_FINE) {
+            myStepper.runSpeed();
+        } else if (!myStepper.run()) {
+            homingFault = HOMING_NO_SENSOR;
+            return false;
+        }
+        if (!homingCheck(phase, started)) {
+            return false;
+        }
+    }
+    myStepper.setCurrentPosition(myStepper.currentPosition()); // Stop right here
+    return true;
+}
+
+// Move HOMING_BACKOFF steps further out of the sensor before the fine approach
+bool homingBackoff(unsigned long started) {
+    myStepper.move(HOMING_BACKOFF);
+    while (myStepper.distanceToGo() != 0) {
+        myStepper.run();
+        if (!homingCheck(HOMING_PHASE_FINE, started)) {
+            return false;
+        }
+    }
+    return true;
+}
+
+// Timeout, stop command and progress reports while homing. Returns false to abort.
+bool homingCheck(byte phase, unsigned long started) {
+    unsigned long now = millis();
+    if (now - started > homingTimeout) {
+        homingFault = HOMING_TIMEOUT;
+        return false;
+    }
+    if (stopRequested()) {
+        homingFault = HOMING_STOPPED;
+        return false;
+    }
+    if (now - lastHomingProgress >= HOMING_PROGRESS_INTERVAL) {
+        lastHomingProgress = now;
+        if (binaryMode) {
+            byte payload[5];
+            payload[0] = phase;
+            writeInt32(payload + 1, myStepper.currentPosition());
+            sendFrame(ST_HOMING_PROGRESS, payload, 5);
+        } else {
+            Serial.print(phase == HOMING_PHASE_COARSE ? "Homing: coarse search, position " : "Homing: fine approach, position ");
+            Serial.println(myStepper.currentPosition());
+        }
+    }
+    return true;
+}
+
+// Values of 0 keep the current setting, others are limited to what the board can step
+void setMotionProfile(long maxSpeed, long acceleration) {
+    if (maxSpeed > 0) {
+        moveMaxSpeed = min(maxSpeed, MAX_PROFILE_SPEED);
+    }
+    if (acceleration > 0) {
+        moveAcceleration = min(acceleration, MAX_PROFILE_ACCELERATION);
+    }
+    myStepper.setMaxSpeed(moveMaxSpeed);
+    myStepper.setAcceleration(moveAcceleration);
+    if (binaryMode) {
+        byte payload[4];
+        writeUInt16(payload, moveMaxSpeed);
+        writeUInt16(payload + 2, moveAcceleration);
+        sendFrame(ST_MOTION_PROFILE, payload, 4);
+        return;
+    }
+    Serial.print("Motion profile: speed ");
+    Serial.print((long)moveMaxSpeed);
+    Serial.print(", acceleration ");
+    Serial.println((long)moveAcceleration);
+}
+
+// Values of 0 keep the current setting
+void setHomingProfile(long fast, long slow, long acceleration, long timeoutSeconds) {
+    if (fast > 0) {
+        homingFastSpeed = fast;
+    }
+    if (slow > 0) {
+        homingSlowSpeed = slow;
+    }
+    if (acceleration > 0) {
+        homingAcceleration = acceleration;
+    }
+    if (timeoutSeconds > 0) {
+        homingTimeout = timeoutSeconds * 1000UL;
+    }
+    if (binaryMode) {
+        byte payload[8];
+        writeUInt16(payload, homingFastSpeed);
+        writeUInt16(payload + 2, homingSlowSpeed);
+        writeUInt16(payload + 4, homingAcceleration);
+        writeUInt16(payload + 6, homingTimeout / 1000);
+        sendFrame(ST_HOMING_PROFILE, payload, 8);
+        return;
+    }
+    Serial.print("Homing profile: fast ");
+    Serial.print((long)homingFastSpeed);
+    Serial.print(", slow ");
+    Serial.print((long)homingSlowSpeed);
+    Serial.print(", acceleration ");
+    Serial.print((long)homingAcceleration);
+    Serial.print(", timeout ");
+    Serial.println(homingTimeout / 1000);
+}
+
+// Checks for a stop command without holding up the motor. Binary frames other than
+// stop are answered with ST_BUSY. After a stop replySeq is the stop's sequence number.
+bool stopRequested() {
+  if (binaryMode) {
+    byte commandSeq = replySeq;
+    if (readFrame()) {
+      replySeq = frameSeq;
+      if (frameOp == OP_STOP) {
+        return true;
+      }
+      // Anything else has to wait until the current command is over
+      sendFrame(ST_BUSY, 0, 0);
+      replySeq = commandSeq;
+    }
+    return false;
+  }
+  if (Serial.available() > 0) {
+    String stopCommand = Serial.readStringUntil('\n');
+    stopCommand.trim();
+    return stopCommand == "stop";
+  }
+  return false;
+}
+
+bool selectGratingMode(int modeSelection) {
+  if (modeSelection != 0 && modeSelection != 1 && modeSelection != 2) {
+    if (binaryMode) {
+      sendFrame(ST_INVALID_MODE, 0, 0);
+    } else {
+      Serial.println("Invalid selection. Please choose an existing operating mode:");
+    }
+    return false;
+  }
+  gratingMode = modeSelection;
+  gratingSelected = true;
+  if (binaryMode) {
+    byte payload[1] = {(byte)gratingMode};
+    sendFrame(ST_MODE_SELECTED, payload, 1);
+    return true;
+  }
+  Serial.print("Grating mode selected. You are now operating with the ");
+  if (gratingMode == 0) {
+      Serial.println("VIS Grating");
+  } else if (gratingMode == 1) {
+      Serial.println("IR Grating");
+  } else if (gratingMode == 2) {
+      Serial.println("Switch Mode");
+  }
+  return true;
+}
+
+void setStreaming(int channel, unsigned long interval) {
+  if (interval > 0) {
+    streamInterval = interval;
+  }
+  streamChannel = (channel == 1 || channel == 2) ? channel : 0;
+  if (binaryMode) {
+    byte payload[3] = {(byte)streamChannel};
+    writeUInt16(payload + 1, streamInterval);
+    sendFrame(ST_STREAMING, payload, 3);
+  } else if (streamChannel != 0) {
+    Serial.print("Streaming photodiode S");
+    Serial.print(streamChannel);
+    Serial.print(" every ");
+    Serial.print(streamInterval);
+    Serial.println(" ms.");
+  } else {
+    Serial.println("Streaming off.");
+  }
+}
+
 void moveToWavelength(float targetWavelength) {
   int targetSteps;
   bool validInput = true;
@@ -145,23 +487,25 @@ void moveToWavelength(float targetWavelength) {
   // Check if the input wavelength is within the valid range for the selected mode
   if (gratingMode == 0) { // VIS Grating only
     if (targetWavelength < 350 || targetWavelength > 1000) {
-      Serial.println("Invalid wavelength for VIS Grating. Please enter a wavelength between 350 and 1000 nm:");
+      if (!binaryMode) Serial.println("Invalid wavelength for VIS Grating. Please enter a wavelength between 350 and 1000 nm:");
       validInput = false;
     } else {
-      Serial.print("Moving to wavelength: ");
-      Serial.println(targetWavelength);
+      if (!binaryMode) {
+        Serial.print("Moving to wavelength: ");
+        Serial.println(targetWavelength);
+      }
       targetSteps = (targetWavelength + 389.2407) / 1.1127;
     }
   } else if (gratingMode == 1) { // IR Grating only
     if (targetWavelength < 587 || targetWavelength > 2000) {
-      Serial.println("Invalid wavelength for IR Grating. Please enter a wavelength between 587 and 2000 nm:");
+      if (!binaryMode) Serial.println("Invalid wavelength for IR Grating. Please enter a wavelength between 587 and 2000 nm:");
       validInput = false;
     } else {
       targetSteps = (targetWavelength + 4715.4390) / 0.5099;
     }
   } else if (gratingMode == 2) { // Switching between gratings mode
     if (targetWavelength < 350 || targetWavelength > 2000) {
-      Serial.println("Invalid wavelength for switching mode. Please enter a wavelength between 350 and 2000 nm:");
+      if (!binaryMode) Serial.println("Invalid wavelength for switching mode. Please enter a wavelength between 350 and 2000 nm:");
       validInput = false;
     } else {
       if (targetWavelength < 650) {
@@ -172,38 +516,230 @@ void moveToWavelength(float targetWavelength) {
     }
   }
 
+  if (!validInput && binaryMode) {
+    sendFrame(ST_INVALID_WAVELENGTH, 0, 0);
+  }
+
   if (validInput) {
+    if (!runToTarget(targetSteps)) {
+      return; // Emergency stop, already reported
+    }
+    if (binaryMode) {
+      byte payload[4];
+      writeInt32(payload, (long)(targetWavelength * 100 + 0.5));
+      sendFrame(ST_TARGET_REACHED, payload, 4);
+      return;
+    }
+    // Only print this if the stepper has successfully finished its move
+    Serial.print("Target wavelength reached. Current wavelength is: ");
+    Serial.println(targetWavelength);
+    Serial.println("You can now enter a new wavelength or choose another grating to work with.");
+  }
+}
+
+void moveToSteps(long targetSteps) {
+  if (targetSteps < 0 || targetSteps > MAX_TARGET_STEPS) {
+    if (binaryMode) {
+      sendFrame(ST_INVALID_POSITION, 0, 0);
+    } else {
+      Serial.print("Invalid position. Please enter a step position between 0 and ");
+      Serial.println(MAX_TARGET_STEPS);
+    }
+    return;
+  }
+  if (!runToTarget(targetSteps)) {
+    return;
+  }
+  if (binaryMode) {
+    byte payload[4];
+    writeInt32(payload, myStepper.currentPosition());
+    sendFrame(ST_POSITION_REACHED, payload, 4);
+    return;
+  }
+  Serial.print("Target position reached. Current position is: ");
+  Serial.println(myStepper.currentPosition());
+  Serial.println("You can now enter a new wavelength or choose another grating to work with.");
+}
+
+// Runs the motor to targetSteps, streaming samples and watching for an emergency
+// stop. Returns false if the move was stopped (the stop has been reported).
+bool runToTarget(long targetSteps) {
     myStepper.moveTo(targetSteps);
     //Serial.println("Moving to steps"); //<-- command for debugging if needed
+    sendSample();
     while (myStepper.distanceToGo() != 0) {
       myStepper.run(); // Continuously run the stepper
 
+      if (streamChannel != 0 && millis() - lastSampleTime >= streamInterval) {
+        sendSample();
+      }
+
       // Check for an emergency stop command
-      if (Serial.available() > 0) {
-        String stopCommand = Serial.readStringUntil('\n');
-        stopCommand.trim();
-        if (stopCommand == "stop") {
-          Serial.println("Emergency stop initiated.");
-          myStepper.stop();
-          Serial.println("You can now enter a new wavelength or choose another grating to work with.");
-          return; // Exit the function early
+      if (stopRequested()) {
+        myStepper.stop();
+        if (binaryMode) {
+          sendFrame(ST_EMERGENCY_STOP, 0, 0);
+          sendSample();
+          return false;
         }
+        Serial.println("Emergency stop initiated.");
+        sendSample();
+        Serial.println("You can now enter a new wavelength or choose another grating to work with.");
+        return false; // Exit the function early
       }
     }
 
-    // Only print this if the stepper has successfully finished its move
-    Serial.print("Target wavelength reached. Current wavelength is: ");
-    Serial.println(targetWavelength);
-    Serial.println("You can now enter a new wavelength or choose another grating to work with.");
+    sendSample();
+    return true;
+}
+
+// State line: State: homed <0|1>, mode <0-2, -1 if none selected>, position <steps>
+void sendState() {
+  if (binaryMode) {
+    byte payload[6];
+    payload[0] = motorHomed ? 1 : 0;
+    payload[1] = gratingSelected ? gratingMode : 255;
+    writeInt32(payload + 2, myStepper.currentPosition());
+    sendFrame(ST_STATE, payload, 6);
+    return;
   }
+  Serial.print("State: homed ");
+  Serial.print(motorHomed ? 1 : 0);
+  Serial.print(", mode ");
+  Serial.print(gratingSelected ? gratingMode : -1);
+  Serial.print(", position ");
+  Serial.println(myStepper.currentPosition());
 }
 
+// Streamed sample line: S,<millis>,<step position>,<photodiode reading>
+// Kept short so that at 9600 baud a sample every 50 ms never fills the TX buffer
+// and blocks the run() loop.
+void sendSample() {
+  if (streamChannel == 0) {
+    return;
+  }
+  lastSampleTime = millis();
+  int reading = analogRead(streamChannel == 1 ? photodiodeS1Pin : photodiodeS2Pin);
+  if (binaryMode) {
+    byte payload[10];
+    writeInt32(payload, lastSampleTime);
+    writeInt32(payload + 4, myStepper.currentPosition());
+    writeUInt16(payload + 8, reading);
+    sendFrame(ST_SAMPLE, payload, 10);
+    return;
+  }
+  Serial.print("S,");
+  Serial.print(lastSampleTime);
+  Serial.print(',');
+  Serial.print(myStepper.currentPosition());
+  Serial.print(',');
+  Serial.println(reading);
+}
 
+//////////////////////////////////////////////////////
+// Binary protocol helpers
+///////////////////////////////////////////////////////
 
+void handleFrame() {
+  replySeq = frameSeq;
+  if (frameOp == OP_PING) {
+    sendFrame(ST_PONG, 0, 0);
+  } else if (frameOp == OP_HOME) {
+    sendFrame(ST_HOMING, 0, 0);
+    homeStepperMotor();
+  } else if (frameOp == OP_MODE && framePayloadLength == 1) {
+    selectGratingMode(framePayload[0]);
+  } else if (frameOp == OP_WAVELENGTH && framePayloadLength == 4) {
+    moveToWavelength(readInt32(framePayload) / 100.0);
+  } else if (frameOp == OP_STEPS && framePayloadLength == 4) {
+    moveToSteps(readInt32(framePayload));
+  } else if (frameOp == OP_MOTION_PROFILE && framePayloadLength == 4) {
+    setMotionProfile(readUInt16(framePayload), readUInt16(framePayload + 2));
+  } else if (frameOp == OP_HOMING_PROFILE && framePayloadLength == 8) {
+    setHomingProfile(readUInt16(framePayload), readUInt16(framePayload + 2), readUInt16(framePayload + 4),
+                     readUInt16(framePayload + 6));
+  } else if (frameOp == OP_STATE) {
+    sendState();
+  } else if (frameOp == OP_STREAM && framePayloadLength == 3) {
+    setStreaming(framePayload[0], readUInt16(framePayload + 1));
+  } else if (frameOp != OP_STOP) { // stop outside a move is ignored as in the text protocol
+    sendFrame(ST_UNKNOWN_COMMAND, 0, 0);
+  }
+}
+
+// Collects bytes from Serial without blocking. Returns true once a complete frame
+// with a valid CRC is in frameSeq/frameOp/framePayload.
+bool readFrame() {
+  while (Serial.available() > 0) {
+    byte value = Serial.read();
+    if (frameLength == 0 && value != FRAME_START) {
+      continue; // Resynchronise on the start byte
+    }
+    frameBuffer[frameLength++] = value;
+    if (frameLength == 4 && frameBuffer[3] > MAX_PAYLOAD) {
+      frameLength = 0;
+      continue;
+    }
+    if (frameLength >= 4 && frameLength == frameBuffer[3] + 5) {
+      frameLength = 0;
+      if (crc8(frameBuffer + 1, frameBuffer[3] + 3) != frameBuffer[frameBuffer[3] + 4]) {
+        replySeq = frameBuffer[1];
+        sendFrame(ST_BAD_FRAME, 0, 0);
+        continue;
+      }
+      frameSeq = frameBuffer[1];
+      frameOp = frameBuffer[2];
+      framePayloadLength = frameBuffer[3];
+      return true;
+    }
+  }
+  return false;
+}
 
+void sendFrame(byte op, const byte *payload, byte length) {
+  byte header[4] = {FRAME_START, replySeq, op, length};
+  byte crc = crc8(header + 1, 3);
+  crc = crc8Update(crc, payload, length);
+  Serial.write(header, 4);
+  if (length > 0) {
+    Serial.write(payload, length);
+  }
+  Serial.write(crc);
+}
 
+byte crc8Update(byte crc, const byte *data, byte length) {
+  for (byte i = 0; i < length; i++) {
+    crc ^= data[i];
+    for (byte bit = 0; bit < 8; bit++) {
+      crc = (crc & 0x80) ? (crc << 1) ^ 0x07 : crc << 1;
+    }
+  }
+  return crc;
+}
 
+byte crc8(const byte *data, byte length) {
+  return crc8Update(0, data, length);
+}
 
+void writeUInt16(byte *buffer, unsigned int value) {
+  buffer[0] = value & 0xFF;
+  buffer[1] = (value >> 8) & 0xFF;
+}
 
+void writeInt32(byte *buffer, long value) {
+  for (byte i = 0; i < 4; i++) {
+    buffer[i] = (value >> (8 * i)) & 0xFF;
+  }
+}
 
+unsigned int readUInt16(const byte *buffer) {
+  return buffer[0] | ((unsigned int)buffer[1] << 8);
+}
 
+long readInt32(const byte *buffer) {
+  long value = 0;
+  for (byte i = 0; i < 4; i++) {
+    value |= (long)buffer[i] << (8 * i);
+  }
+  return value;
+}
\ No newline at end of file
@@ -0,0 +1,113 @@
+import threading
+from collections import deque
+
+from mono_model import MAX_SPEED, ACCELERATION, MAX_PROFILE_SPEED, MAX_PROFILE_ACCELERATION, move_time
+
+
+#Speed (steps/s) and acceleration (steps/s^2) the firmware uses for moves, plus the
+# time the grating needs to stop ringing after a move made with them. Faster
+# profiles arrive sooner but need longer to settle; settle_time is what has to be
+# waited before a reading, so measure it for the instrument at hand.
+class MotionProfile:
+    def __init__(self, name, max_speed, acceleration, settle_time=0.0):
+        if not 1 <= max_speed <= MAX_PROFILE_SPEED:
+            raise ValueError(f"Speed must be between 1 and {MAX_PROFILE_SPEED} steps/s.")
+        if not 1 <= acceleration <= MAX_PROFILE_ACCELERATION:
+            raise ValueError(f"Acceleration must be between 1 and {MAX_PROFILE_ACCELERATION} steps/s^2.")
+        self.name = name
+        self.max_speed = max_speed
+        self.acceleration = acceleration
+        self.settle_time = settle_time
+
+    #Predicted duration of a move over distance steps (trapezoidal profile)
+    def move_time(self, distance):
+        return move_time(distance, self.max_speed, self.acceleration)
+
+    #Move plus settling, i.e. until a reading can be taken
+    def total_time(self, distance):
+        return self.move_time(distance) + self.settle_time
+
+    def same_motion(self, other):
+        return other is not None and (self.max_speed, self.acceleration) == (other.max_speed, other.acceleration)
+
+    def __repr__(self):
+        return (f"MotionProfile({self.name!r}, {self.max_speed} steps/s, {self.acceleration} steps/s^2, "
+                f"settle {self.settle_time} s)")
+
+
+# What setup() configures, and what the firmware uses until told otherwise
+DEFAULT_PROFILE = MotionProfile("default", MAX_SPEED, ACCELERATION)
+
+# Starting points; the settle times are estimates, replace them with measured ones
+MOTION_PROFILES = {
+    "default": DEFAULT_PROFILE,
+    "fast slew": MotionProfile("fast slew", 2000, 2000, settle_time=0.3),
+    "fine scan": MotionProfile("fine scan", 300, 600, settle_time=0.05),
+}
+
+
+#The profile that gets a reading soonest after a move over distance steps, among
+# those settling within max_settle seconds (any when None). Raises ValueError when
+# no profile settles fast enough.
+def fastest_profile(distance, profiles, max_settle=None):
+    candidates = [profile for profile in profiles if max_settle is None or profile.settle_time <= max_settle]
+    if not candidates:
+        raise ValueError(f"No motion profile settles within {max_settle} s.")
+    return min(candidates, key=lambda profile: profile.total_time(distance))
+
+
+#fastest_profile for every move of a sequence of step targets, starting at start
+def profiles_for_moves(targets, start, profiles, max_settle=None):
+    profiles = list(profiles)
+    chosen = []
+    position = start
+    for target in targets:
+        target = position if target is None else target
+        chosen.append(fastest_profile(abs(target - position), profiles, max_settle))
+        position = target
+    return chosen
+
+
+#Predicted against measured move times. measured runs from writing the command to
+# the firmware's target reached report, so it includes the serial round trip the
+# prediction leaves out.
+class MoveTimeLog:
+    def __init__(self, max_records=10000):
+        self.records = deque(maxlen=max_records)  # (profile name, distance, predicted, measured)
+        self._lock = threading.Lock()
+
+    def add(self, profile, distance, predicted, measured):
+        with self._lock:
+            self.records.append((profile, distance, predicted, measured))
+
+    #{profile name: {"count", "predicted", "measured", "error", "ratio"}} with the
+    # totals in seconds, error the mean of measured - predicted and ratio
+    # measured / predicted over all moves
+    def summary(self):
+        with self._lock:
+            records = list(self.records)
+        summary = {}
+        for profile, distance, predicted, measured in records:
+            entry = summary.setdefault(profile, {"count": 0, "predicted": 0.0, "measured": 0.0})
+            entry["count"] += 1
+            entry["predicted"] += predicted
+            entry["measured"] += measured
+        for entry in summary.values():
+            entry["error"] = (entry["measured"] - entry["predicted"]) / entry["count"]
+            entry["ratio"] = entry["measured"] / entry["predicted"] if entry["predicted"] else None
+        return summary
+
+    def report(self):
+        summary = self.summary()
+        if not summary:
+            return "No moves timed."
+        lines = [f"{'profile':<14}{'moves':>7}{'predicted s':>13}{'measured s':>12}{'error ms':>10}{'ratio':>7}"]
+        for profile, entry in sorted(summary.items()):
+            ratio = f"{entry['ratio']:>7.2f}" if entry["ratio"] is not None else f"{'-':>7}"
+            lines.append(f"{profile:<14}{entry['count']:>7}{entry['predicted']:>13.2f}{entry['measured']:>12.2f}"
+                         f"{entry['error'] * 1000:>10.0f}{ratio}")
+        return "\n".join(lines)
+
+    def clear(self):
+        with self._lock:
+            self.records.clear()
@@ -0,0 +1,122 @@
+from mono_model import (MAX_SPEED, ACCELERATION, SWITCH_WAVELENGTH, VIS_MODE, GRATING_MODES, grating_for,
+                        grating_range, wavelength_to_steps, steps_to_wavelength, move_time, transfer_time)
+
+# Wire time of one "wavelength_selected" command plus its "Target wavelength reached" reply
+COMMAND_OVERHEAD = transfer_time(len("wavelength_selected 1234.56\n") + len(
+    "Target wavelength reached. Current wavelength is: 1234.56\r\n"))
+
+
+class PlannedMove:
+    def __init__(self, wavelength, steps, grating, index=None):
+        self.wavelength = wavelength
+        self.steps = steps
+        self.grating = grating
+        self.index = index  # Position in the requested list, None for an extra approach move
+
+    @property
+    def is_approach(self):
+        return self.index is None
+
+    def __repr__(self):
+        kind = "approach" if self.is_approach else f"#{self.index}"
+        return f"PlannedMove({self.wavelength} nm, {self.steps} steps, {GRATING_MODES[self.grating]}, {kind})"
+
+
+class MovePlan:
+    def __init__(self, moves, start_position, max_speed=MAX_SPEED, acceleration=ACCELERATION):
+        self.moves = moves
+        self.start_position = start_position
+        self.max_speed = max_speed
+        self.acceleration = acceleration
+
+    @property
+    def wavelengths(self):
+        return [move.wavelength for move in self.moves]
+
+    @property
+    def total_travel(self):
+        travel = 0
+        position = self.start_position
+        for move in self.moves:
+            travel += abs(move.steps - position)
+            position = move.steps
+        return travel
+
+    @property
+    def grating_crossings(self):
+        return sum(1 for previous, move in zip(self.moves, self.moves[1:]) if previous.grating != move.grating)
+
+    #Predicted wall-clock time from the AccelStepper profile of every move plus the
+    # serial wire time of each command and reply
+    def predicted_time(self, command_overhead=COMMAND_OVERHEAD):
+        total = 0.0
+        position = self.start_position
+        for move in self.moves:
+            total += move_time(move.steps - position, self.max_speed, self.acceleration) + command_overhead
+            position = move.steps
+        return total
+
+    def summary(self):
+        return (f"{len(self.moves)} moves, {self.total_travel} steps of travel, "
+                f"{self.grating_crossings} VIS/IR crossings, about {self.predicted_time():.1f} s")
+
+
+#Order the requested wavelengths so the stepper visits their step positions in one
+# sweep. On a single axis that minimises both total travel and the number of times
+# a Switch Mode job jumps between the VIS and IR parts of the range. With approach
+# set to "up" or "down" every target is reached moving in that direction, adding one
+# move of backlash_steps past the first target if the motor starts on the wrong side.
+# Without it both directions are tried and the faster one is kept. With a
+# calibration (calibration.Calibration) the step targets, the approach move
+# included, come from it instead of the firmware's fits.
+def plan_moves(wavelengths, mode, start_position=0, approach=None, backlash_steps=20,
+               max_speed=MAX_SPEED, acceleration=ACCELERATION, calibration=None):
+    if approach not in (None, "up", "down"):
+        raise ValueError("approach must be None, 'up' or 'down'.")
+    if calibration is None:
+        steps = [wavelength_to_steps(wavelength, mode) for wavelength in wavelengths]
+    else:
+        steps = calibration.wavelengths_to_steps(wavelengths, mode)
+    targets = [PlannedMove(wavelength, int(target), grating_for(wavelength, mode), index)
+               for index, (wavelength, target) in enumerate(zip(wavelengths, steps))]
+    ascending = sorted(targets, key=lambda move: move.steps)
+
+    candidates = []
+    if approach in (None, "up"):
+        candidates.append(_with_approach(ascending, mode, start_position, -backlash_steps if approach else 0,
+                                         calibration))
+    if approach in (None, "down"):
+        candidates.append(_with_approach(ascending[::-1], mode, start_position, backlash_steps if approach else 0,
+                                         calibration))
+    plans = [MovePlan(moves, start_position, max_speed, acceleration) for moves in candidates]
+    return min(plans, key=lambda plan: plan.predicted_time())
+
+
+#Prepend a move to offset steps from the first target when the motor would otherwise
+# reach it from the wrong side. The offset is applied in steps and converted to a
+# wavelength once, with the calibration when there is one.
+def _with_approach(moves, mode, start_position, offset, calibration=None):
+    if not moves or offset == 0:
+        return moves
+    first = moves[0]
+    target = first.steps + offset
+    # Already on the side the targets are approached from
+    if (offset < 0 and start_position <= target) or (offset > 0 and start_position >= target):
+        return moves
+    # Stay on the same grating so the extra move does not jump across the range
+    low, high = grating_range(first.grating, mode)
+    if first.grating == VIS_MODE and high == SWITCH_WAVELENGTH:
+        high -= 0.01
+    if calibration is None:
+        lowest, highest = wavelength_to_steps(low, mode), wavelength_to_steps(high, mode)
+        target = min(max(target, lowest), highest)
+        # wavelength_selected takes 0.01 nm, the firmware converts it back itself
+        wavelength = round(min(max(steps_to_wavelength(target, first.grating), low), high), 2)
+        steps = wavelength_to_steps(wavelength, mode)
+    else:
+        lowest, highest = calibration.wavelengths_to_steps([low, high], mode)
+        steps = int(min(max(target, lowest), highest))
+        wavelength = float(calibration.steps_to_wavelengths([steps], first.grating)[0])
+    if steps == first.steps:
+        return moves
+    return [PlannedMove(wavelength, steps, first.grating)] + moves
@@ -0,0 +1,386 @@
+import argparse
+import asyncio
+import json
+import os
+import signal
+import sys
+import time
+
+from async_mono import AsyncMonochromatorControl, MonochromatorError
+from mono_model import GRATING_MODES, is_valid_wavelength, sweep_wavelengths
+from motion_profile import MOTION_PROFILES, MotionProfile
+from move_planner import plan_moves
+from scan_store import ScanWriter
+
+# Everything a job can set. Top-level keys of a recipe are defaults for all of its
+# jobs; a recipe without "jobs" is a single job.
+JOB_DEFAULTS = {
+    "name": None,
+    "port": None,  # Serial port, or EMULATOR for a dry run against the emulator
+    "baud_rate": 9600,
+    "binary_baud_rate": None,  # Switch to the binary protocol at this baud rate
+    "calibration": None,  # calibration.Calibration JSON file; firmware fits if None
+    "home": "once",  # "once" per port and run, "always" before the job, or "never"
+    "grating": None,  # One of GRATING_MODES
+    "sweeps": [],  # {"start", "stop", "step"} or {"wavelengths": [...]} ranges, run in order
+    "dwell": 0.0,  # s at every point
+    "optimize_order": False,
+    "approach": None,  # "up" or "down", see move_planner.plan_moves
+    "profile": None,  # Motion profile name, see motion_profile.py
+    "max_settle": None,  # s; pick the fastest profile per move instead
+    "profiles": {},  # Extra profiles: name -> {"max_speed", "acceleration", "settle_time"}
+    "stream_channel": 1,  # Photodiode recorded during the sweeps, 0 for none
+    "stream_interval_ms": 50,
+    "output": None,  # Scan file for the streamed samples; {name}, {job} and {time} are filled in
+}
+HOME_MODES = ("once", "always", "never")
+APPROACHES = (None, "up", "down")
+
+
+#One unattended init -> home -> mode -> sweep run, validated when the recipe is loaded
+class Job:
+    def __init__(self, settings, recipe_dir, index):
+        unknown = set(settings) - set(JOB_DEFAULTS)
+        if unknown:
+            raise ValueError(f"Unknown recipe keys: {', '.join(sorted(unknown))}")
+        values = dict(JOB_DEFAULTS, **settings)
+        self.name = values["name"] or f"job {index + 1}"
+        self.port = values["port"]
+        if not self.port:
+            raise ValueError(f"{self.name}: no port given.")
+        if values["grating"] not in GRATING_MODES:
+            raise ValueError(f"{self.name}: grating must be one of {GRATING_MODES}.")
+        if values["home"] not in HOME_MODES:
+            raise ValueError(f"{self.name}: home must be one of {HOME_MODES}.")
+        if values["approach"] not in APPROACHES:
+            raise ValueError(f"{self.name}: approach must be one of {APPROACHES}.")
+        self.baud_rate = values["baud_rate"]
+        self.binary_baud_rate = values["binary_baud_rate"]
+        self.home = values["home"]
+        self.grating = values["grating"]
+        self.dwell = values["dwell"]
+        self.optimize_order = values["optimize_order"]
+        self.approach = values["approach"]
+        self.profile = values["profile"]
+        self.max_settle = values["max_settle"]
+        self.profiles = [MotionProfile(name, profile["max_speed"], profile["acceleration"],
+                                       profile.get("settle_time", 0.0))
+                         for name, profile in values["profiles"].items()]
+        profile_names = list(MOTION_PROFILES) + [profile.name for profile in self.profiles]
+        if self.profile is not None and self.profile not in profile_names:
+            raise ValueError(f"{self.name}: profile must be one of {profile_names}.")
+        self.stream_channel = values["stream_channel"]
+        self.stream_interval_ms = values["stream_interval_ms"]
+        self.calibration_path = _resolve(values["calibration"], recipe_dir)
+        self.calibration = self._load_calibration()
+        self.output = _resolve(values["output"], recipe_dir)
+        self.index = index
+        self.sweeps = [self._wavelengths(sweep) for sweep in values["sweeps"]]
+        if not self.sweeps:
+            raise ValueError(f"{self.name}: no sweeps given.")
+        if self.calibration:
+            # Also builds the lookup tables, which fails for a calibration that cannot be inverted
+            try:
+                self.calibration.wavelengths_to_steps([wavelength for sweep in self.sweeps for wavelength in sweep],
+                                                      self.grating)
+            except ValueError as e:
+                raise ValueError(f"{self.name}: {e}")
+
+    def _load_calibration(self):
+        if not self.calibration_path:
+            return None
+        # numpy is only needed once a calibration is used
+        from calibration import Calibration
+        try:
+            return Calibration.load(self.calibration_path)
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            raise ValueError(f"{self.name}: could not load the calibration {self.calibration_path}: {e}")
+
+    def _wavelengths(self, sweep):
+        if "wavelengths" in sweep:
+            wavelengths = [float(wavelength) for wavelength in sweep["wavelengths"]]
+        else:
+            wavelengths = sweep_wavelengths(sweep["start"], sweep["stop"], sweep["step"])
+        invalid = [wavelength for wavelength in wavelengths if not is_valid_wavelength(wavelength, self.grating)]
+        if invalid or not wavelengths:
+            raise ValueError(f"{self.name}: sweep {sweep} has no points or points outside the {self.grating} "
+                             f"range: {invalid[:5]}")
+        return wavelengths
+
+    @property
+    def points(self):
+        return sum(len(wavelengths) for wavelengths in self.sweeps)
+
+    def output_path(self):
+        if not self.output:
+            return None
+        return self.output.format(name=self.name.replace(" ", "_"), job=self.index + 1,
+                                  time=time.strftime("%Y%m%d-%H%M%S"))
+
+
+def _resolve(path, recipe_dir):
+    if path is None or os.path.isabs(path):
+        return path
+    return os.path.join(recipe_dir, path)
+
+
+#Jobs of every recipe file, in order. Raises ValueError for an invalid recipe so a
+# queue fails before the first job starts rather than halfway through the night.
+def load_recipes(paths):
+    jobs = []
+    for path in paths:
+        with open(path) as f:
+            recipe = json.load(f)
+        recipe_dir = os.path.dirname(os.path.abspath(path))
+        defaults = {key: value for key, value in recipe.items() if key != "jobs"}
+        for settings in recipe.get("jobs", [{}]):
+            try:
+                jobs.append(Job(dict(defaults, **settings), recipe_dir, len(jobs)))
+            except (KeyError, TypeError, ValueError) as e:
+                raise ValueError(f"{path}: {e}")
+    return jobs
+
+
+class JobResult:
+    def __init__(self, job):
+        self.job = job
+        self.status = "skipped"  # running, done, stopped, failed or skipped
+        self.error = None
+        self.points = 0  # Points reached
+        self.samples = 0  # Samples written to the scan file
+        self.output = None
+        self.setup_time = 0.0  # s connecting, homing and selecting the grating
+        self.sweep_time = 0.0
+        self.homing_time = None
+
+    def to_dict(self):
+        return {"name": self.job.name, "port": self.job.port, "status": self.status, "error": self.error,
+                "points": self.points, "points_requested": self.job.points, "samples": self.samples,
+                "output": self.output, "setup_time": self.setup_time, "sweep_time": self.sweep_time,
+                "homing_time": self.homing_time}
+
+
+#Runs jobs one after the other without an operator. Connections are kept open and
+# reused by later jobs on the same port, so a port is homed once per run. The first
+# SIGINT/SIGTERM stops the motor and skips the remaining jobs; a second one aborts
+# right away.
+class RecipeRunner:
+    def __init__(self, jobs, verbose=False):
+        self.jobs = jobs
+        self.verbose = verbose  # Also print every firmware line
+        self.units = {}  # port -> connected AsyncMonochromatorControl
+        self.move_times = {}  # port -> MoveTimeLog of every connection to it
+        self.results = []
+        self.stopping = False
+        self._active = None  # Unit running the current job
+        self._task = None
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self._task = asyncio.current_task()
+        signals = self._install_signal_handlers(loop)
+        self.results = [JobResult(job) for job in self.jobs]
+        try:
+            for result in self.results:
+                if self.stopping:
+                    break
+                await self._run_job(result)
+        finally:
+            for signum in signals:
+                loop.remove_signal_handler(signum)
+            units, self.units = self.units, {}
+            for unit in units.values():
+                await unit.disconnect()
+        return self.results
+
+    def _install_signal_handlers(self, loop):
+        installed = []
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(signum, self._on_signal, signum)
+                installed.append(signum)
+            except (NotImplementedError, RuntimeError):
+                # No add_signal_handler (Windows): Ctrl+C ends up as KeyboardInterrupt
+                pass
+        return installed
+
+    def _on_signal(self, signum):
+        if self.stopping:
+            self.log(f"{signal.Signals(signum).name} again, aborting.")
+            self._task.cancel()
+            return
+        self.stopping = True
+        self.log(f"{signal.Signals(signum).name} received, stopping the current job and skipping the rest.")
+        if self._active and self._active.ser:
+            asyncio.ensure_future(self._active.stop())
+
+    def log(self, message):
+        print(f"{time.strftime('%H:%M:%S')} {message}", flush=True)
+
+    #Move to the first point the job's first sweep will visit, planned the way
+    # unit.sweep plans it
+    async def _move_to_start(self, unit, job):
+        wavelengths = job.sweeps[0]
+        if not (job.optimize_order or job.approach):
+            await unit.set_wavelength(wavelengths[0], job.profile)
+            return
+        profile = unit.motion_profiles.get(job.profile, unit.motion_profile)
+        plan = plan_moves(wavelengths, unit.grating_mode, unit.current_steps or 0, approach=job.approach,
+                          max_speed=profile.max_speed, acceleration=profile.acceleration,
+                          calibration=unit.calibration)
+        await unit.move_to_steps(plan.moves[0].steps, job.profile)
+
+    async def _run_job(self, result):
+        job = result.job
+        self.log(f"Starting {job.name}: {job.points} points on {job.port} with the {job.grating}.")
+        started = time.monotonic()
+        sweep_started = None
+        writer = None
+        unit = None
+        result.status = "running"
+        try:
+            unit = await self._unit(job)
+            self._active = unit
+            unit.calibration = job.calibration
+            for profile in job.profiles:
+                unit.motion_profiles[profile.name] = profile
+            if job.home == "always" or not unit.motor_homed:
+                if job.home == "never":
+                    raise MonochromatorError("The motor is not homed and the recipe does not allow homing.")
+                result.homing_time = await unit.home()
+                self.log(f"Homed in {result.homing_time:.1f} s.")
+            if not unit.grating_selected or unit.grating_mode != job.grating:
+                await unit.select_grating(job.grating)
+            result.output = job.output_path()
+            if result.output:
+                os.makedirs(os.path.dirname(os.path.abspath(result.output)), exist_ok=True)
+                writer = ScanWriter(result.output, job.grating, unit.calibration,
+                                    metadata={"job": job.name, "port": job.port})
+                unit.on_sample = writer.append_event
+            if job.stream_channel:
+                # Only the sweeps are recorded, not the slew to where the first one starts
+                await self._move_to_start(unit, job)
+                await unit.start_streaming(job.stream_channel, job.stream_interval_ms)
+            sweep_started = time.monotonic()
+            result.setup_time = sweep_started - started
+            for wavelengths in job.sweeps:
+                if self.stopping:
+                    break
+                reached = await unit.sweep(wavelengths=wavelengths, dwell=job.dwell,
+                                           optimize_order=job.optimize_order, approach=job.approach,
+                                           profile=job.profile, max_settle=job.max_settle)
+                result.points += len(reached)
+                if len(reached) < len(wavelengths) and not self.stopping:
+                    raise MonochromatorError(f"Sweep ended after {len(reached)} of {len(wavelengths)} points.")
+            if job.stream_channel:
+                await unit.stop_streaming()
+            result.status = "stopped" if self.stopping else "done"
+        except (MonochromatorError, OSError, ValueError, asyncio.TimeoutError) as e:
+            result.status = "stopped" if self.stopping else "failed"
+            result.error = str(e)
+            self.log(f"{job.name} {result.status}: {e}")
+            # Start the next job on this port from a fresh connection
+            if unit is not None:
+                self.units.pop(job.port, None)
+                await unit.disconnect()
+        finally:
+            if result.status == "running":
+                result.status = "stopped"  # Aborted by a second signal
+            self._active = None
+            if sweep_started is not None:
+                result.sweep_time = time.monotonic() - sweep_started
+            else:
+                result.setup_time = time.monotonic() - started
+            if unit is not None:
+                unit.on_sample = None
+            if writer:
+                writer.header["metadata"]["result"] = {"status": result.status, "points": result.points,
+                                                       "points_requested": job.points}
+                writer.close()
+                result.samples = writer.count
+        self.log(f"Finished {job.name}: {result.status}, {result.points}/{job.points} points, "
+                 f"{result.samples} samples in {time.monotonic() - started:.1f} s.")
+
+    async def _unit(self, job):
+        unit = self.units.get(job.port)
+        if unit is not None:
+            return unit
+        unit = AsyncMonochromatorControl(on_status=self._firmware_line if self.verbose else None)
+        try:
+            await unit.connect(job.port, job.baud_rate)
+            await unit.initialize()
+            if job.binary_baud_rate and not await unit.use_binary_protocol(job.binary_baud_rate):
+                self.log(f"{job.port} does not support the binary protocol, staying with text commands.")
+        except Exception:
+            await unit.disconnect()
+            raise
+        self.units[job.port] = unit
+        if job.port in self.move_times:
+            unit.move_times = self.move_times[job.port]
+        self.move_times[job.port] = unit.move_times
+        return unit
+
+    def _firmware_line(self, message):
+        self.log(f"  {message}")
+
+    #Per-job table plus totals and the predicted against measured move times
+    def report(self):
+        lines = [f"{'job':<20}{'status':<9}{'points':>11}{'samples':>9}{'setup s':>9}{'sweep s':>9}"
+                 f"{'points/min':>12}{'samples/s':>11}"]
+        for result in self.results:
+            points_rate = result.points / result.sweep_time * 60 if result.sweep_time else 0.0
+            samples_rate = result.samples / result.sweep_time if result.sweep_time else 0.0
+            lines.append(f"{result.job.name[:19]:<20}{result.status:<9}"
+                         f"{f'{result.points}/{result.job.points}':>11}{result.samples:>9}"
+                         f"{result.setup_time:>9.1f}{result.sweep_time:>9.1f}{points_rate:>12.1f}{samples_rate:>11.1f}")
+        done = sum(1 for result in self.results if result.status == "done")
+        total_time = sum(result.setup_time + result.sweep_time for result in self.results)
+        total_points = sum(result.points for result in self.results)
+        lines.append(f"{done} of {len(self.results)} jobs done, {total_points} points and "
+                     f"{sum(result.samples for result in self.results)} samples in {total_time:.1f} s.")
+        for port, move_times in sorted(self.move_times.items()):
+            lines.append(f"Move times on {port}, predicted against measured:")
+            lines.append(move_times.report())
+        return "\n".join(lines)
+
+
+async def _run(runner):
+    try:
+        return await runner.run()
+    except asyncio.CancelledError:
+        return runner.results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run monochromator recipe files without an operator.")
+    parser.add_argument("recipes", nargs="+", help="recipe JSON files, run in the order given")
+    parser.add_argument("--check", action="store_true", help="only validate the recipes")
+    parser.add_argument("--verbose", action="store_true", help="print every line from the firmware")
+    parser.add_argument("--report", help="also write the results to this JSON file")
+    args = parser.parse_args(argv)
+
+    try:
+        jobs = load_recipes(args.recipes)
+    except (OSError, ValueError) as e:
+        print(f"Invalid recipe: {e}", file=sys.stderr)
+        return 2
+    if args.check:
+        for job in jobs:
+            print(f"{job.name}: {job.points} points on {job.port} with the {job.grating}"
+                  + (f", calibrated by {job.calibration_path}" if job.calibration else ""))
+        return 0
+
+    runner = RecipeRunner(jobs, verbose=args.verbose)
+    started = time.monotonic()
+    asyncio.run(_run(runner))
+    print(runner.report())
+    print(f"Wall time {time.monotonic() - started:.1f} s.")
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump({"results": [result.to_dict() for result in runner.results],
+                       "wall_time": time.monotonic() - started}, f, indent=2)
+    return 0 if all(result.status == "done" for result in runner.results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
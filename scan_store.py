@@ -0,0 +1,223 @@
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+from mono_model import GRATING_MODES, mode_index
+from spectrum_stream import positions_to_wavelengths
+
+# File layout: MAGIC, a JSON header padded with spaces to its "header_size" (a
+# multiple of HEADER_BLOCK bytes, 4096 in format 1 files, chosen when the file is
+# created), then fixed-size RECORD_DTYPE records appended until the file is closed.
+# The record count follows from the file size, so a file cut short by a crash loses
+# at most the last unflushed chunk and is still readable.
+MAGIC = b"MONOSCAN"
+FORMAT_VERSION = 2
+READABLE_FORMATS = (1, 2)
+HEADER_BLOCK = 4096
+HEADER_RESERVE = 4096  # Room left in the header for what close() and its callers add
+HEADER_SUFFIX = ".header.json"  # Sidecar taking the header when it outgrows the reserve
+RECORD_DTYPE = np.dtype([("time", "<f8"), ("steps", "<i4"), ("reading", "<u2"), ("wavelength", "<f8")])
+INDEX_SUFFIX = ".idx.npy"  # Sidecar holding records sorted by wavelength
+INDEX_DTYPE = np.dtype([("wavelength", "<f8"), ("record", "<i8")])
+
+
+#Appends streamed (millis, steps, reading) samples to a scan file. Samples are
+# collected into chunks of chunk_size records and each chunk is written as soon as it
+# is full, so memory use stays constant however long the acquisition runs.
+class ScanWriter:
+    def __init__(self, path, mode, calibration=None, chunk_size=256, metadata=None):
+        self.path = path
+        self.mode = GRATING_MODES[mode_index(mode)]
+        self.calibration = calibration  # calibration.Calibration for the wavelengths, firmware fits if None
+        self.chunk_size = chunk_size
+        self.count = 0  # Records written to the file so far
+        self._chunk = np.zeros(chunk_size, dtype=RECORD_DTYPE)
+        self._pending = []  # (millis, steps, reading) not yet in a written chunk
+        self._lock = threading.Lock()
+        self.header = {
+            "format": FORMAT_VERSION,
+            "header_size": 0,
+            "grating_mode": self.mode,
+            "calibration": calibration.to_dict() if calibration else None,
+            "started": time.time(),
+            "finished": None,
+            "metadata": metadata or {},
+        }
+        # Sized for the calibration and metadata, plus room for the finishing time and
+        # results; the records start on a block boundary
+        needed = len(MAGIC) + len(json.dumps(self.header).encode()) + HEADER_RESERVE
+        self.header["header_size"] = -(-needed // HEADER_BLOCK) * HEADER_BLOCK
+        self._file = open(path, "wb")
+        self._write_header()
+
+    #Header that outgrew its space (metadata added after the file was created) goes
+    # to a sidecar file; the one in the scan file then only points to it
+    def _write_header(self):
+        size = self.header["header_size"]
+        header = json.dumps(self.header).encode()
+        if len(MAGIC) + len(header) > size:
+            with open(self.path + HEADER_SUFFIX, "w") as f:
+                json.dump(self.header, f)
+            header = json.dumps({"format": FORMAT_VERSION, "header_size": size,
+                                 "header_file": os.path.basename(self.path + HEADER_SUFFIX)}).encode()
+        self._file.seek(0)
+        self._file.write(MAGIC + header.ljust(size - len(MAGIC)))
+        self._file.seek(0, os.SEEK_END)
+
+    def append(self, millis, steps, reading):
+        with self._lock:
+            self._pending.append((millis, steps, reading))
+            if len(self._pending) == self.chunk_size:
+                self._write_chunk()
+
+    #SerialReader on_sample hook
+    def append_event(self, event):
+        self.append(*event.value)
+
+    def _write_chunk(self):
+        if not self._pending:
+            return
+        chunk = self._chunk[:len(self._pending)]
+        millis, steps, reading = np.array(self._pending, dtype=np.int64).T
+        chunk["time"] = millis / 1000
+        chunk["steps"] = steps
+        chunk["reading"] = reading
+        chunk["wavelength"] = positions_to_wavelengths(chunk["steps"], self.mode, self.calibration)
+        self._file.write(chunk.tobytes())
+        self.count += len(self._pending)
+        self._pending = []
+
+    def flush(self):
+        with self._lock:
+            self._write_chunk()
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file.closed:
+                return
+            self._write_chunk()
+            self.header["finished"] = time.time()
+            self._write_header()
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+#Read side of a scan file. The records are memory-mapped, so opening is instant and
+# only the pages that are actually sliced are read from disk. Columns are views into
+# the map: scan["reading"][1000:2000] copies nothing.
+class ScanFile:
+    def __init__(self, path):
+        self.path = path
+        self.header, header_size = _read_header(path)
+        count = (os.path.getsize(path) - header_size) // RECORD_DTYPE.itemsize
+        if count:
+            self.records = np.memmap(path, dtype=RECORD_DTYPE, mode="r", offset=header_size, shape=(count,))
+        else:
+            self.records = np.zeros(0, dtype=RECORD_DTYPE)
+        self._index = None
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, key):
+        return self.records[key]
+
+    @property
+    def grating_mode(self):
+        return self.header["grating_mode"]
+
+    #Records sorted by wavelength, as a structured (wavelength, record number) array.
+    # None when the samples are already in ascending wavelength order (a single
+    # upward sweep), which needs no index. Built on first use and kept next to the
+    # scan file until the scan grows.
+    def wavelength_index(self):
+        if self._index is None:
+            wavelength = self.records["wavelength"]
+            valid = ~np.isnan(wavelength)
+            if valid.all() and np.all(wavelength[1:] >= wavelength[:-1]):
+                self._index = False
+            else:
+                self._index = self._load_index()
+        return self._index if self._index is not False else None
+
+    def _load_index(self):
+        index_path = self.path + INDEX_SUFFIX
+        try:
+            index = np.load(index_path, mmap_mode="r")
+            if index.dtype == INDEX_DTYPE and len(index) == np.count_nonzero(~np.isnan(self.records["wavelength"])):
+                return index
+        except (OSError, ValueError):
+            pass
+        wavelength = self.records["wavelength"]
+        records = np.flatnonzero(~np.isnan(wavelength))
+        order = np.argsort(wavelength[records], kind="stable")
+        index = np.empty(len(records), dtype=INDEX_DTYPE)
+        index["record"] = records[order]
+        index["wavelength"] = wavelength[index["record"]]
+        try:
+            np.save(index_path, index)
+        except OSError:
+            return index  # Read-only location, keep it in memory
+        return np.load(index_path, mmap_mode="r")
+
+    #Records with low <= wavelength <= high, in ascending wavelength order. A view
+    # into the map when the scan needs no index, a copy of just those records otherwise.
+    def between(self, low, high):
+        index = self.wavelength_index()
+        if index is None:
+            wavelength = self.records["wavelength"]
+            return self.records[np.searchsorted(wavelength, low, "left"):np.searchsorted(wavelength, high, "right")]
+        start = np.searchsorted(index["wavelength"], low, "left")
+        stop = np.searchsorted(index["wavelength"], high, "right")
+        return self.records[index["record"][start:stop]]
+
+    #(wavelength, reading) of the whole scan or of low..high nm, sorted by wavelength
+    def spectrum(self, low=-np.inf, high=np.inf):
+        records = self.between(low, high)
+        return records["wavelength"], records["reading"]
+
+    #Drops the map; it is unmapped once no slice taken from it is in use any more
+    def close(self):
+        self.records = np.zeros(0, dtype=RECORD_DTYPE)
+        self._index = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+#(header, header size in bytes) of the scan file at path
+def _read_header(path):
+    with open(path, "rb") as f:
+        raw = f.read(HEADER_BLOCK)
+        if not raw.startswith(MAGIC) or len(raw) < HEADER_BLOCK:
+            raise ValueError(f"{path} is not a scan file.")
+        # The header is padded with spaces, so its JSON ends within the first block or
+        # the block is full of it and the rest follows
+        while True:
+            try:
+                header, _ = json.JSONDecoder().raw_decode(raw[len(MAGIC):].decode())
+                break
+            except ValueError:
+                more = f.read(HEADER_BLOCK)
+                if not more:
+                    raise ValueError(f"{path} has a damaged header.")
+                raw += more
+    if header.get("format") not in READABLE_FORMATS:
+        raise ValueError(f"{path} uses scan format {header.get('format')}, expected one of {READABLE_FORMATS}.")
+    header_size = header.get("header_size", HEADER_BLOCK)
+    if "header_file" in header:
+        with open(os.path.join(os.path.dirname(path), header["header_file"])) as f:
+            header = json.load(f)
+    return header, header_size
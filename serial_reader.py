@@ -0,0 +1,223 @@
+import queue
+import threading
+import time
+
+# Event kinds produced from the lines the Arduino prints
+INITIALIZED = "initialized"
+HOMING_STARTED = "homing_started"
+HOMED = "homed"
+HOMING_PROGRESS = "homing_progress"  # value is (phase, step position), phase "coarse" or "fine"
+HOMING_FAILED = "homing_failed"  # value is the reason: "timeout", "stopped" or "sensor not found"
+HOMING_PROFILE = "homing_profile"  # Reply to homing_profile, value is a dict of the settings
+MOTION_PROFILE = "motion_profile"  # Reply to motion_profile, value is {"speed": ..., "acceleration": ...}
+MODE_SELECTED = "mode_selected"
+INVALID_MODE = "invalid_mode"
+MOVING = "moving"
+TARGET_REACHED = "target_reached"
+POSITION_REACHED = "position_reached"  # Reply to steps_selected, value is the step position
+READY = "ready"
+INVALID_WAVELENGTH = "invalid_wavelength"
+INVALID_POSITION = "invalid_position"
+STATE = "state"  # Reply to the state query, value is a dict with homed, mode and position
+EMERGENCY_STOP = "emergency_stop"
+SAMPLE = "sample"  # Streamed photodiode sample, value is (millis, step position, reading)
+STREAMING = "streaming"  # Reply to the stream command
+BINARY_MODE = "binary_mode"  # The firmware switched to the binary protocol
+PONG = "pong"
+MESSAGE = "message"
+DISCONNECTED = "disconnected"  # Put on the queue by the reader itself when it exits
+
+
+class FirmwareEvent:
+    def __init__(self, kind, line, value=None, timestamp=None, seq=None):
+        self.kind = kind
+        self.line = line
+        self.value = value  # Parsed payload (wavelength, grating mode, ...) if the line carries one
+        self.timestamp = timestamp if timestamp is not None else time.monotonic()
+        self.seq = seq  # Sequence number of the command answered, binary protocol only
+
+    def __repr__(self):
+        return f"FirmwareEvent({self.kind!r}, {self.line!r}, value={self.value!r})"
+
+
+def _trailing_number(line):
+    try:
+        return float(line.rsplit(":", 1)[1])
+    except (IndexError, ValueError):
+        return None
+
+
+#"State: homed 1, mode 2, position 1234" -> {"homed": True, "mode": 2, "position": 1234};
+# mode is None when no grating has been selected
+def _parse_state(line):
+    try:
+        fields = dict(field.split() for field in line[len("State:"):].split(","))
+        mode = int(fields["mode"])
+        return {"homed": fields["homed"] == "1", "mode": None if mode < 0 else mode,
+                "position": int(fields["position"])}
+    except (KeyError, ValueError):
+        return None
+
+
+#"Homing profile: fast 500, slow 50, acceleration 200, timeout 60" -> dict of ints
+def _parse_profile(line):
+    try:
+        return {name: int(value) for name, value in
+                (field.split() for field in line.split(":", 1)[1].split(","))}
+    except ValueError:
+        return None
+
+
+#Turn one line of firmware output into a typed event
+def parse_line(line):
+    if line.startswith("S,"):
+        try:
+            millis, steps, reading = (int(field) for field in line[2:].split(","))
+        except ValueError:
+            return FirmwareEvent(MESSAGE, line)
+        return FirmwareEvent(SAMPLE, line, value=(millis, steps, reading))
+    if line.startswith("Streaming"):
+        return FirmwareEvent(STREAMING, line)
+    if line.startswith("Binary protocol at"):
+        return FirmwareEvent(BINARY_MODE, line)
+    if line == "Pong.":
+        return FirmwareEvent(PONG, line)
+    if line.startswith("State:"):
+        return FirmwareEvent(STATE, line, value=_parse_state(line))
+    if line.startswith("Before starting operation please first home the motor."):
+        return FirmwareEvent(INITIALIZED, line)
+    if line.startswith("Homing command received."):
+        return FirmwareEvent(HOMING_STARTED, line)
+    if line.startswith("You can now select the grating you wish to operate with."):
+        return FirmwareEvent(HOMED, line)
+    if line.startswith("Homing:"):
+        try:
+            position = int(line.rsplit(" ", 1)[1])
+        except (IndexError, ValueError):
+            position = None
+        return FirmwareEvent(HOMING_PROGRESS, line, value=("coarse" if "coarse" in line else "fine", position))
+    if line.startswith("Homing failed:"):
+        return FirmwareEvent(HOMING_FAILED, line, value=line[len("Homing failed:"):].strip().rstrip("."))
+    if line.startswith("Homing profile:"):
+        return FirmwareEvent(HOMING_PROFILE, line, value=_parse_profile(line))
+    if line.startswith("Motion profile:"):
+        return FirmwareEvent(MOTION_PROFILE, line, value=_parse_profile(line))
+    if line.startswith("Grating mode selected."):
+        return FirmwareEvent(MODE_SELECTED, line, value=line.rsplit("with the ", 1)[-1])
+    if line.startswith("Invalid selection."):
+        return FirmwareEvent(INVALID_MODE, line)
+    if line.startswith("Moving to wavelength:"):
+        return FirmwareEvent(MOVING, line, value=_trailing_number(line))
+    if line.startswith("Target wavelength reached."):
+        return FirmwareEvent(TARGET_REACHED, line, value=_trailing_number(line))
+    if line.startswith("Target position reached."):
+        steps = _trailing_number(line)
+        return FirmwareEvent(POSITION_REACHED, line, value=None if steps is None else int(steps))
+    if line.startswith("Invalid position"):
+        return FirmwareEvent(INVALID_POSITION, line)
+    if line.startswith("You can now enter a new wavelength"):
+        return FirmwareEvent(READY, line)
+    if line.startswith("Invalid wavelength"):
+        return FirmwareEvent(INVALID_WAVELENGTH, line)
+    if line.startswith("Emergency stop initiated."):
+        return FirmwareEvent(EMERGENCY_STOP, line)
+    return FirmwareEvent(MESSAGE, line)
+
+
+#Owns ser.readline() for the lifetime of a connection. The thread blocks inside
+# readline (up to the port timeout) instead of polling in_waiting, and hands every
+# parsed line over to the waiting caller through a queue, or to on_event instead when
+# it is given. Streamed samples go to on_sample when it is set so they do not flood
+# the queue of command replies.
+class SerialReader(threading.Thread):
+    def __init__(self, ser, on_event=None, on_sample=None):
+        super().__init__(name="SerialReader", daemon=True)
+        self.ser = ser
+        self.events = queue.Queue()
+        self.on_sample = on_sample
+        self.decode = None  # Set once the binary protocol is active: bytes -> list of events
+        self._pending_decode = None
+        self._emit = on_event or self.events.put
+        self._stop_event = threading.Event()
+        self.closed = False  # The port is gone and no more events will arrive
+
+    #Switch to decode(bytes) -> events as soon as the firmware confirms the binary
+    # protocol. The switch has to happen on this thread, before it goes back into
+    # readline() and could swallow the first frames.
+    def expect_binary(self, decode):
+        self._pending_decode = decode
+
+    def run(self):
+        while not self._stop_event.is_set():
+            try:
+                if self.decode:
+                    events = self.decode(self.ser.read(self.ser.in_waiting or 1))
+                else:
+                    raw = self.ser.readline()
+                    line = raw.decode(errors="replace").strip()
+                    events = [parse_line(line)] if line else []
+            except Exception:
+                # Port closed or unplugged underneath us
+                break
+            for event in events:
+                if event.kind == BINARY_MODE and self._pending_decode:
+                    self.decode, self._pending_decode = self._pending_decode, None
+                if event.kind == SAMPLE and self.on_sample:
+                    self.on_sample(event)
+                else:
+                    self._emit(event)
+        self.closed = True
+        self._emit(FirmwareEvent(DISCONNECTED, ""))
+
+    def stop(self):
+        self._stop_event.set()
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join(timeout=2)
+
+    #Block until an event of one of the given kinds arrives. Every event taken off
+    # the queue on the way (including the matching one) is passed to on_event.
+    # on_idle, if given, is called every idle_interval seconds while nothing arrives
+    # (GUI refresh, keyboard check). answers, if given, is the protocol's predicate for
+    # the replies to the command waited on (see BinaryProtocol.answers); events of the
+    # given kinds it rejects answer an earlier command and are passed on without
+    # ending the wait. Returns None on timeout or disconnect.
+    def wait_for(self, kinds, timeout=None, on_event=None, on_idle=None, idle_interval=0.05, answers=None):
+        if isinstance(kinds, str):
+            kinds = (kinds,)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = None if deadline is None else deadline - time.monotonic()
+            if wait is not None and wait <= 0:
+                return None
+            if on_idle is not None:
+                wait = idle_interval if wait is None else min(idle_interval, wait)
+            try:
+                event = self.events.get(timeout=wait)
+            except queue.Empty:
+                if on_idle is not None:
+                    on_idle()
+                continue
+            if event.kind == DISCONNECTED:
+                # Leave it for the next waiter as well
+                self.events.put(event)
+                return None
+            if on_event:
+                on_event(event)
+            if event.kind in kinds and (answers is None or answers(event)):
+                return event
+
+    #Take everything that has already arrived, waiting up to quiet seconds for
+    # more lines after the last one
+    def drain(self, quiet=0.0, on_event=None):
+        drained = []
+        while True:
+            try:
+                event = self.events.get(timeout=quiet) if quiet else self.events.get_nowait()
+            except queue.Empty:
+                return drained
+            if event.kind == DISCONNECTED:
+                self.events.put(event)
+                return drained
+            drained.append(event)
+            if on_event:
+                on_event(event)
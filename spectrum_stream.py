@@ -0,0 +1,89 @@
+import threading
+
+import numpy as np
+
+from mono_model import (VIS_MODE, IR_MODE, SWITCH_MODE, VIS_OFFSET, VIS_SLOPE, IR_OFFSET, IR_SLOPE,
+                        SWITCH_VIS_MAX_STEPS, SWITCH_IR_MIN_STEPS, mode_index)
+
+
+#Vectorised position_to_wavelength for a whole array of step positions; positions
+# between the VIS and IR halves of Switch Mode come out as NaN
+def steps_to_wavelengths(steps, mode):
+    steps = np.asarray(steps, dtype=float)
+    vis = steps * VIS_SLOPE - VIS_OFFSET
+    ir = steps * IR_SLOPE - IR_OFFSET
+    mode = mode_index(mode)
+    if mode == VIS_MODE:
+        return vis
+    if mode == IR_MODE:
+        return ir
+    return np.where(steps <= SWITCH_VIS_MAX_STEPS, vis, np.where(steps >= SWITCH_IR_MIN_STEPS, ir, np.nan))
+
+
+#Wavelengths of step positions from calibration (a calibration.Calibration) when one
+# is loaded, otherwise from the firmware's linear fits
+def positions_to_wavelengths(steps, mode, calibration=None):
+    if calibration:
+        return calibration.positions_to_wavelengths(steps, mode)
+    return steps_to_wavelengths(steps, mode)
+
+
+#Preallocated ring buffer of streamed (time, step position, reading) samples. Once
+# capacity samples have been stored the oldest ones are overwritten.
+class SpectrumBuffer:
+    def __init__(self, capacity=100000, mode=SWITCH_MODE, calibration=None):
+        self.capacity = capacity
+        self.mode = mode  # Grating mode used to turn step positions into wavelengths
+        self.calibration = calibration  # calibration.Calibration used instead of the firmware fits when set
+        self.time = np.zeros(capacity)  # Firmware clock, seconds
+        self.steps = np.zeros(capacity, dtype=np.int32)
+        self.reading = np.zeros(capacity, dtype=np.uint16)
+        self.count = 0  # Samples currently held, at most capacity
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self.count
+
+    def append(self, millis, steps, reading):
+        with self._lock:
+            index = self._next
+            self.time[index] = millis / 1000
+            self.steps[index] = steps
+            self.reading[index] = reading
+            self._next = (index + 1) % self.capacity
+            self.count = min(self.count + 1, self.capacity)
+
+    #SerialReader on_sample hook
+    def append_event(self, event):
+        self.append(*event.value)
+
+    def clear(self):
+        with self._lock:
+            self._next = 0
+            self.count = 0
+
+    #Copies of the held samples, oldest first, as a dict of arrays including wavelength
+    def snapshot(self):
+        with self._lock:
+            if self.count < self.capacity:
+                order = slice(0, self.count)
+                time, steps, reading = self.time[order].copy(), self.steps[order].copy(), self.reading[order].copy()
+            else:
+                time = np.roll(self.time, -self._next)
+                steps = np.roll(self.steps, -self._next)
+                reading = np.roll(self.reading, -self._next)
+        return {
+            "time": time,
+            "steps": steps,
+            "reading": reading,
+            "wavelength": positions_to_wavelengths(steps, self.mode, self.calibration),
+        }
+
+    #(wavelength, reading) sorted by wavelength, without samples taken between gratings
+    def spectrum(self):
+        data = self.snapshot()
+        valid = ~np.isnan(data["wavelength"])
+        wavelength, reading = data["wavelength"][valid], data["reading"][valid]
+        order = np.argsort(wavelength, kind="stable")
+        return wavelength[order], reading[order]
@@ -0,0 +1,39 @@
+import json
+import os
+import threading
+import time
+
+
+#Last known state of every instrument (homed, grating mode, step position), by port,
+# in a small JSON file. A new session compares it with what the firmware reports.
+class StateCache:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        try:
+            with open(path) as f:
+                self.states = json.load(f)
+        except (OSError, ValueError):
+            self.states = {}
+
+    def get(self, port):
+        with self._lock:
+            state = self.states.get(port)
+            return dict(state) if state else None
+
+    def update(self, port, **state):
+        with self._lock:
+            self.states.setdefault(port, {}).update(state, updated=time.time())
+            self._save()
+
+    def forget(self, port):
+        with self._lock:
+            if self.states.pop(port, None) is not None:
+                self._save()
+
+    def _save(self):
+        # Write a new file and swap it in so a crash never leaves half a cache behind
+        temporary = self.path + ".tmp"
+        with open(temporary, "w") as f:
+            json.dump(self.states, f, indent=2)
+        os.replace(temporary, self.path)
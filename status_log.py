@@ -0,0 +1,43 @@
+import threading
+from collections import deque
+
+
+#Status messages kept in a ring buffer of at most max_lines entries. Messages that
+# have not been drawn yet are collected separately so a frontend can render only what
+# is new (also capped at max_lines, so nobody has to take them when running headless),
+# and the complete history can be streamed to history_path instead of memory. close()
+# releases the history file; it is reopened (appending) by the next message.
+class StatusLog:
+    def __init__(self, max_lines=1000, history_path=None):
+        self.max_lines = max_lines
+        self.lines = deque(maxlen=max_lines)
+        self._pending = deque(maxlen=max_lines)
+        self._lock = threading.Lock()
+        self.history_path = history_path
+        self._history = open(history_path, "a", buffering=1) if history_path else None
+
+    def append(self, message):
+        with self._lock:
+            self.lines.append(message)
+            self._pending.append(message)
+            if self.history_path and not self._history:
+                self._history = open(self.history_path, "a", buffering=1)
+            if self._history:
+                self._history.write(message + "\n")
+
+    #Messages appended since the last call
+    def take_pending(self):
+        with self._lock:
+            pending = list(self._pending)
+            self._pending.clear()
+        return pending
+
+    def text(self):
+        with self._lock:
+            return "\n".join(self.lines)
+
+    def close(self):
+        with self._lock:
+            if self._history:
+                self._history.close()
+                self._history = None
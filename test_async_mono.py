@@ -0,0 +1,83 @@
+import asyncio
+
+import pytest
+
+import async_mono
+from async_mono import AsyncMonochromatorControl, MonochromatorError
+from mono_emulator import EmulatedSerial
+from mono_model import wavelength_to_steps
+
+TIME_SCALE = 0.02  # Emulated moves run 50 times faster than the real motor
+
+
+@pytest.fixture(autouse=True)
+def emulator(monkeypatch):
+    monkeypatch.setattr(async_mono, "open_port",
+                        lambda port, baud_rate, timeout: EmulatedSerial(port, baud_rate, timeout, TIME_SCALE))
+
+
+#Run test(unit) against a connected, homed unit on the VIS grating
+def run(test):
+    async def main():
+        async with AsyncMonochromatorControl() as unit:
+            await unit.connect("EMULATOR", timeout=0.1)
+            await unit.initialize()
+            await unit.home()
+            await unit.select_grating("VIS Grating")
+            return await test(unit)
+    return asyncio.run(main())
+
+
+def test_sweep():
+    async def test(unit):
+        points = []
+        reached = await unit.sweep(wavelengths=[450, 500, 550], on_point=lambda index, wavelength: points.append(index))
+        assert reached == [450, 500, 550]
+        assert points == [0, 1, 2]
+        assert unit.current_steps == unit.ser.position == wavelength_to_steps(550, "VIS Grating")
+        assert await unit.sweep(400, 420, 10) == [400, 410, 420]
+    run(test)
+
+
+def test_sweep_validates_arguments():
+    async def test(unit):
+        with pytest.raises(MonochromatorError):
+            await unit.sweep(wavelengths=[500, 1500])
+        with pytest.raises(MonochromatorError):
+            await unit.sweep(400, 500, 0)
+        with pytest.raises(MonochromatorError):
+            await unit.sweep(wavelengths=["red"])
+    run(test)
+
+
+def test_stop():
+    async def test(unit):
+        move = asyncio.ensure_future(unit.set_wavelength(1000))
+        await asyncio.sleep(0.05)  # The move takes 0.2 s here
+        await unit.stop()
+        assert await move is False
+        assert unit.current_steps is None
+        assert len(unit.stop_latencies) == 1
+        assert await unit.set_wavelength(500)
+        assert unit.current_steps == wavelength_to_steps(500, "VIS Grating")
+    run(test)
+
+
+def test_stop_ends_sweep():
+    async def test(unit):
+        sweep = asyncio.ensure_future(unit.sweep(wavelengths=[1000, 400, 1000, 400]))
+        await asyncio.sleep(0.05)
+        await unit.stop()
+        assert await sweep == []
+    run(test)
+
+
+def test_binary_protocol():
+    async def test(unit):
+        assert await unit.use_binary_protocol(115200)
+        assert unit.protocol.name == "binary"
+        assert unit.ser.baudrate == 115200
+        assert await unit.sweep(wavelengths=[450, 500]) == [450, 500]
+        assert await unit.move_to_steps(900)
+        assert unit.current_steps == 900
+    run(test)
@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+
+from calibration import Calibration
+from mono_model import wavelength_to_steps
+
+
+def test_default_matches_firmware_fits():
+    calibration = Calibration()
+    wavelengths = [400, 650.5, 999.99]
+    assert np.all(np.abs(calibration.wavelengths_to_steps(wavelengths, "VIS Grating")
+                         - [wavelength_to_steps(w, "VIS Grating") for w in wavelengths]) <= 1)
+
+
+def test_round_trip(tmp_path):
+    calibration = Calibration()
+    calibration.fit("VIS Grating", [350, 600, 1000], [500, 900, 1600], kind="poly", degree=2)
+    calibration.fit("IR Grating", [600, 900, 1300, 2000], [10400, 10900, 11700, 13200], kind="spline")
+    path = tmp_path / "calibration.json"
+    calibration.save(path)
+    loaded = Calibration.load(path)
+    wavelengths = [400, 500, 640, 700, 1200, 1999]
+    assert np.array_equal(loaded.wavelengths_to_steps(wavelengths, "Switch Mode"),
+                          calibration.wavelengths_to_steps(wavelengths, "Switch Mode"))
+    steps = [10500, 11000.5, 13000]
+    assert np.array_equal(loaded.steps_to_wavelengths(steps, "IR Grating"),
+                          calibration.steps_to_wavelengths(steps, "IR Grating"))
+
+
+def test_rejects_out_of_range():
+    with pytest.raises(ValueError):
+        Calibration().wavelengths_to_steps([500, 1500], "VIS Grating")
+
+
+def test_rejects_non_monotonic_fit():
+    with pytest.raises(ValueError):
+        Calibration().fit("VIS Grating", [350, 600, 1000], [500, 1600, 900], kind="spline")
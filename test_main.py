@@ -1,6 +1,10 @@
+import sys
+
 from mono_class_update import MonochromatorControl
 
 def main():
+    sys.stdout.reconfigure(line_buffering=True)  # Show the Arduino's replies as they arrive
+
     # Initialize MonochromatorControl
     mono = MonochromatorControl()
 
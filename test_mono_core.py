@@ -0,0 +1,75 @@
+import threading
+import time
+
+import pytest
+
+import mono_core
+from mono_emulator import EmulatedSerial
+from mono_model import wavelength_to_steps
+
+TIME_SCALE = 0.02  # Emulated moves run 50 times faster than the real motor
+
+
+@pytest.fixture
+def core(monkeypatch):
+    monkeypatch.setattr(mono_core, "open_port",
+                        lambda port, baud_rate, timeout: EmulatedSerial(port, baud_rate, timeout, TIME_SCALE))
+    unit = mono_core.MonochromatorCore()
+    unit.connect_to_monochromator("EMULATOR", timeout=0.1)  # The reader stops within one timeout
+    unit.initialize_arduino()
+    unit.home_motor()
+    unit.select_grating_mode("VIS Grating")
+    yield unit
+    unit.disconnect()
+    unit.scheduler.shutdown()
+
+
+def test_sweep(core):
+    points = []
+    reached = core.sweep(wavelengths=[450, 500, 550], on_point=lambda index, wavelength: points.append(index))
+    assert reached == [450, 500, 550]
+    assert points == [0, 1, 2]
+    assert core.current_steps == wavelength_to_steps(550, "VIS Grating")
+    assert core.ser.position == core.current_steps
+
+
+def test_sweep_optimized_order(core):
+    reached = core.sweep(wavelengths=[600, 450, 500], optimize_order=True)
+    assert reached == [450, 500, 600]
+
+
+def test_sweep_refuses_out_of_range(core):
+    assert core.sweep(wavelengths=[500, 1500]) == []
+    assert "outside the VIS Grating range" in core.status_messages[-1]
+    assert core.current_steps == 0
+
+
+def test_emergency_stop(core):
+    result = []
+    move = threading.Thread(target=lambda: result.append(core.set_wavelength(1000)))
+    move.start()
+    time.sleep(0.05)  # The move takes 0.2 s here
+    core.emergency_stop()
+    move.join(5)
+    assert result == [False]
+    assert core.current_steps is None
+    assert 0 < core.ser.position < wavelength_to_steps(1000, "VIS Grating")
+    assert len(core.stop_latencies) == 1
+    # The motor moves again afterwards
+    assert core.set_wavelength(500)
+    assert core.current_steps == wavelength_to_steps(500, "VIS Grating")
+
+
+def test_emergency_stop_ends_sweep(core):
+    reached = core.sweep(wavelengths=[450, 500, 550, 600], on_point=lambda index, wavelength: index == 1 and
+                         core.emergency_stop())
+    assert reached == [450, 500]
+
+
+def test_binary_protocol(core):
+    core.use_binary_protocol(115200)
+    assert core.protocol.name == "binary"
+    assert core.ser.baudrate == 115200
+    assert core.sweep(wavelengths=[450, 500]) == [450, 500]
+    assert core.move_to_steps(900)
+    assert core.current_steps == 900
@@ -0,0 +1,47 @@
+import struct
+
+from mono_protocol import (crc8, encode_frame, status_events, FrameDecoder, FRAME_START, OP_PING, ST_TARGET_REACHED,
+                           ST_SAMPLE, ST_STATE)
+from serial_reader import parse_line, TARGET_REACHED, READY
+
+
+def test_crc8():
+    # CRC-8 with polynomial 0x07 and no reflection, the firmware's frame check
+    assert crc8(b"123456789") == 0xF4
+    assert crc8(b"") == 0
+    assert crc8(b"6789", crc8(b"12345")) == 0xF4
+
+
+def test_frame_round_trip():
+    decoder = FrameDecoder()
+    frames = decoder.feed(encode_frame(7, OP_PING) + encode_frame(300, ST_SAMPLE, struct.pack("<IiH", 1, 2, 3)))
+    assert frames == [(7, OP_PING, b""), (300 & 0xFF, ST_SAMPLE, struct.pack("<IiH", 1, 2, 3))]
+    assert decoder.bad_frames == 0
+
+
+def test_frame_split_across_reads():
+    decoder = FrameDecoder()
+    frame = encode_frame(1, ST_TARGET_REACHED, struct.pack("<i", 50012))
+    assert decoder.feed(b"noise" + frame[:3]) == []
+    assert decoder.feed(frame[3:]) == [(1, ST_TARGET_REACHED, struct.pack("<i", 50012))]
+
+
+def test_bad_crc_resynchronises():
+    decoder = FrameDecoder()
+    good = encode_frame(2, OP_PING)
+    corrupted = bytearray(encode_frame(1, OP_PING))
+    corrupted[-1] ^= 0xFF
+    assert decoder.feed(bytes(corrupted) + good) == [(2, OP_PING, b"")]
+    assert decoder.bad_frames == 1
+    # An impossible length is skipped without waiting for that many bytes
+    assert decoder.feed(bytes((FRAME_START, 3, OP_PING, 200)) + good) == [(2, OP_PING, b"")]
+
+
+def test_status_events_match_text_replies():
+    for op, payload in ((ST_TARGET_REACHED, struct.pack("<i", 50012)), (ST_SAMPLE, struct.pack("<IiH", 1234, 709, 305)),
+                        (ST_STATE, struct.pack("<BBi", 1, 2, 709)), (ST_STATE, struct.pack("<BBi", 0, 255, 0))):
+        for kind, line, value in status_events(op, payload):
+            event = parse_line(line)
+            assert (event.kind, event.value) == (kind, value)
+    kinds = [kind for kind, _, _ in status_events(ST_TARGET_REACHED, struct.pack("<i", 50012))]
+    assert kinds == [TARGET_REACHED, READY]
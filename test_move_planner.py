@@ -0,0 +1,61 @@
+import pytest
+
+from calibration import Calibration
+from mono_model import wavelength_to_steps
+from move_planner import plan_moves
+
+
+def test_orders_by_step_position():
+    plan = plan_moves([600, 450, 500], "VIS Grating", start_position=0)
+    assert plan.wavelengths == [450, 500, 600]
+    assert [move.index for move in plan.moves] == [1, 2, 0]
+    assert [move.steps for move in plan.moves] == [wavelength_to_steps(w, "VIS Grating") for w in (450, 500, 600)]
+
+
+def test_starts_from_the_nearer_end():
+    plan = plan_moves([600, 450, 500], "VIS Grating", start_position=5000)
+    assert plan.wavelengths == [600, 500, 450]
+    assert plan.total_travel == 5000 - wavelength_to_steps(450, "VIS Grating")
+
+
+def test_switch_mode_crosses_once():
+    plan = plan_moves([1200, 400, 1500, 500], "Switch Mode", start_position=0)
+    assert plan.wavelengths == [400, 500, 1200, 1500]
+    assert plan.grating_crossings == 1
+
+
+def test_approach_adds_backlash_move():
+    first = wavelength_to_steps(450, "VIS Grating")
+    plan = plan_moves([500, 450], "VIS Grating", start_position=5000, approach="up", backlash_steps=20)
+    approach, *targets = plan.moves
+    assert approach.is_approach
+    # The firmware takes 0.01 nm, so the approach lands within a step of the offset
+    assert abs(approach.steps - (first - 20)) <= 1
+    assert [move.wavelength for move in targets] == [450, 500]
+    # Already below the first target: no extra move
+    plan = plan_moves([500, 450], "VIS Grating", start_position=0, approach="up")
+    assert not any(move.is_approach for move in plan.moves)
+    plan = plan_moves([500, 450], "VIS Grating", start_position=0, approach="down")
+    assert plan.moves[0].is_approach and plan.wavelengths[1:] == [500, 450]
+
+
+def test_approach_with_calibration_is_exact():
+    calibration = Calibration()
+    calibration.fit("VIS Grating", [350, 600, 1000], [500, 900, 1600], kind="poly", degree=2)
+    plan = plan_moves([500, 450], "VIS Grating", start_position=5000, approach="up", backlash_steps=20,
+                      calibration=calibration)
+    first = calibration.wavelengths_to_steps([450], "VIS Grating")[0]
+    assert plan.moves[0].steps == first - 20
+    assert [move.steps for move in plan.moves[1:]] == list(calibration.wavelengths_to_steps([450, 500],
+                                                                                            "VIS Grating"))
+
+
+def test_approach_stays_on_the_grating():
+    plan = plan_moves([350], "VIS Grating", start_position=5000, approach="up", backlash_steps=20)
+    # 350 nm is the bottom of the range, there is no room below it
+    assert [move.wavelength for move in plan.moves] == [350]
+
+
+def test_rejects_unknown_approach():
+    with pytest.raises(ValueError):
+        plan_moves([500], "VIS Grating", approach="sideways")
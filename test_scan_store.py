@@ -0,0 +1,65 @@
+import json
+
+import numpy as np
+
+from calibration import Calibration
+from mono_model import wavelength_to_steps
+from scan_store import ScanWriter, ScanFile, HEADER_BLOCK, HEADER_SUFFIX
+
+
+def _samples(count):
+    steps = np.linspace(wavelength_to_steps(400, "VIS Grating"), wavelength_to_steps(700, "VIS Grating"), count)
+    return [(millis * 20, int(position), millis % 1024) for millis, position in enumerate(steps)]
+
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path / "scan.scan")
+    samples = _samples(1000)
+    with ScanWriter(path, "VIS Grating", chunk_size=64, metadata={"job": "test"}) as writer:
+        for sample in samples:
+            writer.append(*sample)
+    with ScanFile(path) as scan:
+        assert len(scan) == len(samples)
+        assert scan.grating_mode == "VIS Grating"
+        assert scan.header["metadata"] == {"job": "test"}
+        assert scan.header["finished"] is not None
+        assert list(scan["steps"]) == [steps for _, steps, _ in samples]
+        assert list(scan["reading"]) == [reading for _, _, reading in samples]
+        assert np.allclose(scan["time"], [millis / 1000 for millis, _, _ in samples])
+        # A single upward sweep needs no wavelength index
+        assert scan.wavelength_index() is None
+        wavelength, reading = scan.spectrum(500, 600)
+        assert len(wavelength) and wavelength.min() >= 500 and wavelength.max() <= 600
+
+
+def test_unordered_scan_is_indexed(tmp_path):
+    path = str(tmp_path / "scan.scan")
+    samples = _samples(500)
+    with ScanWriter(path, "VIS Grating") as writer:
+        for sample in samples[::-1] + samples:
+            writer.append(*sample)
+    with ScanFile(path) as scan:
+        assert scan.wavelength_index() is not None
+        wavelength, _ = scan.spectrum(450, 650)
+        assert np.all(np.diff(wavelength) >= 0)
+        assert len(wavelength) == 2 * np.count_nonzero((scan["wavelength"][:500] >= 450)
+                                                       & (scan["wavelength"][:500] <= 650))
+
+
+def test_calibration_and_large_header(tmp_path):
+    calibration = Calibration()
+    calibration.fit("VIS Grating", np.linspace(350, 1000, 200), np.linspace(500, 1600, 200), kind="spline")
+    path = str(tmp_path / "scan.scan")
+    writer = ScanWriter(path, "VIS Grating", calibration)
+    writer.append(0, 900, 10)
+    assert writer.header["header_size"] % HEADER_BLOCK == 0
+    # Results added after the file was created that do not fit go to a sidecar
+    writer.header["metadata"]["result"] = "x" * (writer.header["header_size"] * 2)
+    writer.close()
+    with ScanFile(path) as scan:
+        assert len(scan) == 1
+        assert scan.header["calibration"] == calibration.to_dict()
+        assert scan.header["metadata"]["result"] == "x" * (writer.header["header_size"] * 2)
+        assert np.isclose(scan["wavelength"][0], calibration.steps_to_wavelengths([900], "VIS Grating")[0])
+    with open(path + HEADER_SUFFIX) as f:
+        assert json.load(f)["calibration"] == calibration.to_dict()
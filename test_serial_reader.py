@@ -0,0 +1,36 @@
+from serial_reader import (parse_line, INITIALIZED, HOMED, HOMING_PROGRESS, HOMING_FAILED, HOMING_PROFILE,
+                           MODE_SELECTED, TARGET_REACHED, POSITION_REACHED, READY, STATE, EMERGENCY_STOP, SAMPLE,
+                           MESSAGE)
+
+
+def test_parse_replies():
+    assert parse_line("Before starting operation please first home the motor.").kind == INITIALIZED
+    assert parse_line("You can now select the grating you wish to operate with.").kind == HOMED
+    assert parse_line("You can now enter a new wavelength or choose another grating to work with.").kind == READY
+    assert parse_line("Emergency stop initiated.").kind == EMERGENCY_STOP
+
+
+def test_parse_values():
+    event = parse_line("Target wavelength reached. Current wavelength is: 1234.56")
+    assert (event.kind, event.value) == (TARGET_REACHED, 1234.56)
+    event = parse_line("Target position reached. Current position is: 889")
+    assert (event.kind, event.value) == (POSITION_REACHED, 889)
+    event = parse_line("Grating mode selected. You are now operating with the IR Grating")
+    assert (event.kind, event.value) == (MODE_SELECTED, "IR Grating")
+    event = parse_line("State: homed 1, mode 2, position 709")
+    assert (event.kind, event.value) == (STATE, {"homed": True, "mode": 2, "position": 709})
+    event = parse_line("Homing: coarse search, position 1500")
+    assert (event.kind, event.value) == (HOMING_PROGRESS, ("coarse", 1500))
+    event = parse_line("Homing failed: sensor not found.")
+    assert (event.kind, event.value) == (HOMING_FAILED, "sensor not found")
+    event = parse_line("Homing profile: fast 500, slow 50, acceleration 200, timeout 60")
+    assert event.kind == HOMING_PROFILE
+    assert event.value == {"fast": 500, "slow": 50, "acceleration": 200, "timeout": 60}
+
+
+def test_parse_samples():
+    event = parse_line("S,1234,709,305")
+    assert (event.kind, event.value) == (SAMPLE, (1234, 709, 305))
+    # A sample cut short on the wire is kept as a plain message
+    assert parse_line("S,1234,70").kind == MESSAGE
+    assert parse_line("Something else").kind == MESSAGE